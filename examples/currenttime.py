@@ -9,7 +9,7 @@ import longshot
 import time
 import datetime
 
-d = longshot.LongshotDevice('long1', 'long1')
+d = longshot.Device('long1', 'long1')
 
 hour = longshot.pathpoint_from_functions('Whour', d,
                                          on_read_requested=lambda: datetime.datetime.now().hour,
@@ -1,4 +1,13 @@
 
 
 from .device import Device
-from .pathpoints import BasePathpoint, pathpoint_from_functions
\ No newline at end of file
+from .pathpoints import BasePathpoint, pathpoint_from_functions
+from .transport import Transport
+from .group import DeviceGroup, BatchFanOut
+from .buffers import ListBuffer, ArrayBuffer
+from .reads import ReadPool
+from .dispatch import Dispatcher
+from .filters import Reduction
+from .retry import RetryPolicy, Backoff, CircuitBreaker
+from .metrics import Metrics, prometheus_text
+from .history import History
\ No newline at end of file
@@ -0,0 +1,267 @@
+"""
+asyncio support. Requires Python 3.5+.
+
+An AsyncDevice speaks the same protocol as a Device, but instead of a thread of its own
+it runs as a task on an event loop, so a single thread can serve thousands of devices.
+"""
+import asyncio
+import concurrent.futures
+import time
+from .device import Device, _LongshotProtocol, REDEFINE_PATHS, SYNC_VALUES
+from .transport import Transport
+
+
+class AsyncTransport(object):
+    """
+    Transport for use by AsyncDevices.
+
+    Requests are carried out by a pooled Transport on a small pool of worker threads.
+    At most max_in_flight requests to a single API root will be in progress at a time - the
+    rest wait for their turn, so that a fleet of devices does not flood the server.
+
+    Share one AsyncTransport between all AsyncDevices in the process, or the limit will not
+    hold across them.
+    """
+
+    def __init__(self, max_in_flight=16, transport=None):
+        """
+        :param max_in_flight: maximum amount of concurrent requests per API root
+        :param transport: a Transport to do the requests with. If None, a new one will be created,
+            with a connection pool large enough for max_in_flight connections.
+        """
+        self.max_in_flight = max_in_flight
+        self.transport = transport or Transport(pool_maxsize=max_in_flight)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self.semaphores = {}        # api_root => asyncio.Semaphore
+
+    @property
+    def stats(self):
+        return self.transport.stats
+
+    async def post(self, api_root, endpoint, payload, encoding='json'):
+        """
+        POST a payload to an endpoint
+        :return: requests' Response
+        """
+        try:
+            semaphore = self.semaphores[api_root]
+        except KeyError:
+            semaphore = self.semaphores[api_root] = asyncio.Semaphore(self.max_in_flight)
+
+        async with semaphore:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.transport.post, api_root, endpoint, payload, encoding)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.transport.close()
+
+
+_default_transport = None
+
+
+def get_default_transport():
+    """Return the process-wide AsyncTransport used by AsyncDevices that were not given one"""
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = AsyncTransport()
+    return _default_transport
+
+
+class _AsyncLongshot(_LongshotProtocol):
+    def __init__(self, device, api_root, pathpoint_prefix):
+        _LongshotProtocol.__init__(self, device, api_root, pathpoint_prefix)
+        self.event = None           # asyncio.Event the task sleeps on
+        self.loop = None
+        self.task = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.event = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    def wake(self):
+        """Wake the task. Can be called from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    async def _post(self, endpoint, payload, encoding='json'):
+        started = time.time()
+        ok = False
+        try:
+            r = await self.device.transport.post(self.api_root, endpoint, payload, encoding)
+            ok = r.status_code == 200
+            return r
+        finally:
+            self.device.metrics.observe_call(endpoint, time.time() - started, ok)
+
+    async def _call(self, endpoint, payload, error):
+        r = await self._post(endpoint, payload)
+        if r.status_code != 200:
+            raise IOError(error)
+        try:
+            return r.json()
+        except ValueError:
+            raise IOError(error)
+
+    async def _syncpaths(self):
+        while True:
+            endpoint, payload = self._paths_request()
+            try:
+                r = await self._call(endpoint, payload, 'Failed to redefine paths')
+            except IOError:
+                self._on_paths_failed()
+                if endpoint == REDEFINE_PATHS:
+                    raise
+                continue
+
+            self._on_paths(r)
+            return
+
+    async def _check_order_queue(self):
+        r = await self._call('/v1/get_orders/', self._orders_request(), 'Failed to get orders')
+        started = time.time()
+        failed_reads = await self._read(self._on_orders(r))
+
+        confirm = self._confirm_request(r, failed_reads)
+        if confirm is not None:
+            await self._post('/v1/confirm_orders/', confirm)
+            self.device.metrics.observe_orders(time.time() - started)
+
+    async def _read_one(self, pp):
+        obtain_value_async = getattr(pp, 'obtain_value_async', None)
+        if obtain_value_async is not None:
+            v = await obtain_value_async()
+        else:
+            v = await self.loop.run_in_executor(None, pp.obtain_value)
+        self._on_read(pp, v)
+
+    async def _read(self, reads):
+        """
+        Carry out reads concurrently, waiting for them no longer than device's read_timeout.
+        Pathpoints with a coroutine method obtain_value_async() are read with it, others have their
+        obtain_value() called on the loop's default executor.
+
+        :return: list of paths that could not be read in time
+        """
+        if not reads:
+            return []
+
+        tasks = dict((asyncio.ensure_future(self._read_one(pp)), pp) for pp in reads)
+        done, pending = await asyncio.wait(list(tasks), timeout=self.device.read_timeout)
+
+        return [tasks[task].prefixed_path for task in tasks
+                if task in pending or task.exception() is not None]
+
+    async def _post_chunk(self, chunk):
+        try:
+            r = await self._post(SYNC_VALUES, chunk.payload, self.values_encoding)
+        except IOError:
+            return 0
+        return r.status_code
+
+    def _acknowledge(self, mark):
+        # Persistence layers touch the disk, so they are not called on the event loop
+        future = self.loop.run_in_executor(None, self.device.persistence.acknowledge, mark)
+        future.add_done_callback(self._on_acknowledge_done)
+
+    def _on_acknowledge_done(self, future):
+        """A failure to acknowledge fails the cycle, as it does on a Device"""
+        if future.cancelled():
+            return
+        e = future.exception()
+        if isinstance(e, IOError):
+            self._on_cycle_failed()
+        elif e is not None:
+            self.loop.call_exception_handler({'message': 'Persistence layer failed to acknowledge',
+                                              'exception': e, 'future': future})
+
+    async def _syncvalues(self):
+        self.checkpoint = await self.loop.run_in_executor(None, self.device.persistence.checkpoint)
+        chunks = self._chunks_since_checkpoint()
+        statuses = [None] * len(chunks)
+
+        # Send up to upload_pipeline chunks at once, and no more after one fails
+        depth = self.device.upload_pipeline
+        for i in range(0, len(chunks), depth):
+            sent = await asyncio.gather(*[self._post_chunk(chunk) for chunk in chunks[i:i+depth]])
+            statuses[i:i+len(sent)] = sent
+            if any(status != 200 for status in sent):
+                break
+
+        if not self._on_chunks_sent(chunks, statuses):
+            raise IOError('Failed to sync')
+
+    async def run(self):
+        device = self.device
+
+        while True:
+            while not self.terminating:
+                self.event.clear()
+                now = time.time()
+                with device.condition:
+                    timeout = self._next_deadline(now) - now
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            if self.terminating:
+                return
+
+            started = time.time()
+            try:
+                if not device.paths_synced:
+                    await self._syncpaths()
+
+                if now >= self.next_order_check:
+                    self.next_order_check = now + device.order_interval
+                    await self._check_order_queue()
+
+                if self._is_upload_due(now) and self._needs_upload():
+                    await self._syncvalues()
+
+                await self.loop.run_in_executor(None, device.persistence.sync)
+
+            except IOError:
+                self._on_cycle_failed()
+            else:
+                self._on_cycle_succeeded()
+
+            device.metrics.observe_cycle(time.time() - started)
+
+
+class AsyncDevice(Device):
+    """
+    A Device that runs as a task on an asyncio event loop instead of a thread.
+
+    Pathpoints are used exactly as with a Device. done() has to be called from within the event
+    loop. shutdown() returns an awaitable, that completes when the device has stopped.
+    """
+    _runner_class = _AsyncLongshot
+
+    def __init__(self, device_id, secret, transport=None, **kwargs):
+        """
+        Accepts the same arguments as Device.
+
+        :param transport: an AsyncTransport. If None, the process-wide default will be used.
+        """
+        Device.__init__(self, device_id, secret, transport=transport or get_default_transport(), **kwargs)
+
+    def wake(self):
+        self.thread.wake()
+
+    def shutdown(self):
+        """
+        Shut this device down
+        :return: an awaitable, to wait for the device to stop
+        """
+        self.thread.terminating = True
+        self.wake()
+        if self.thread.task is None:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(None)
+            return future
+        return self.thread.task
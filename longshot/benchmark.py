@@ -0,0 +1,268 @@
+"""
+Benchmarks of longshot against a FakeServer running in the same process.
+
+    python -m longshot.benchmark                    # run all scenarios
+    python -m longshot.benchmark high_rate outage   # run some of them
+    python -m longshot.benchmark --json             # print results as JSON, eg. to compare runs
+
+Scenarios are:
+    - many_pathpoints: a single device with thousands of pathpoints, each storing a few values
+    - many_devices: many devices sharing a Transport, each with a few pathpoints
+    - high_rate: a few threads storing to a single device as fast as they can
+    - outage: values are stored while the server fails every request, and then it recovers
+    - memory: memory taken by a sample awaiting upload, in a ListBuffer and an ArrayBuffer
+    - sharded: many devices hosted in worker processes by a Supervisor, stored to via proxies.
+      The server runs in this process, so it competes with proxying for the GIL.
+
+For every scenario these are reported, where they apply:
+    - samples_per_s: samples stored and acknowledged by the server per second of the scenario
+    - p99_latency_s: 99th percentile of time from store() until the server got the sample
+    - cpu_per_cycle_s: CPU time of the process per cycle of Longshot threads. The server runs
+      in the same process, so this includes its share.
+    - recovery_s: seconds from the end of an outage until all of the backlog was received
+    - bytes_per_sample: memory taken by a sample awaiting upload
+
+Pass scale to make scenarios bigger or smaller.
+"""
+import argparse
+import json
+import threading
+import time
+from .buffers import ListBuffer, ArrayBuffer, to_server_time
+from .device import Device
+from .pathpoints import pathpoint_from_functions
+from .retry import RetryPolicy, Backoff
+from .sharding import Supervisor
+from .testing import FakeServer
+from .transport import Transport
+
+try:
+    import tracemalloc
+except ImportError:     # Python 2
+    tracemalloc = None
+
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _wait_for(server, samples, timeout=120):
+    """Wait until the server has got this many samples"""
+    deadline = time.time() + timeout
+    while server.samples < samples:
+        if time.time() > deadline:
+            raise RuntimeError('server got %s samples out of %s in %s seconds' % (
+                server.samples, samples, timeout))
+        time.sleep(0.005)
+
+
+class _Run(object):
+    """A scenario being run: a server, devices and measurements"""
+
+    def __init__(self, latency=0, failure_rate=0):
+        self.server = FakeServer(latency=latency, failure_rate=failure_rate).start()
+        self.server.record_arrivals = True
+        self.transport = Transport(pool_maxsize=100)
+        self.devices = []
+
+    def device(self, pathpoints, **kwargs):
+        """:return: a started device, and its pathpoints"""
+        device = Device('bench%s' % (len(self.devices), ), 'secret',
+                        longshot_path=self.server.url, transport=self.transport, **kwargs)
+        points = [pathpoint_from_functions('Wp%s' % (i, ), device).register()
+                  for i in range(pathpoints)]
+        device.done()
+        self.devices.append(device)
+
+        # Let it declare its paths
+        known = self.server.device(device.device_id).paths
+        while len(known) < pathpoints:
+            time.sleep(0.005)
+            known = self.server.device(device.device_id).paths
+        return device, points
+
+    def start(self):
+        self.started = time.time()
+        self.cpu_started = _cpu_time()
+
+    def finish(self, samples):
+        _wait_for(self.server, samples)
+        duration = time.time() - self.started
+        cpu = _cpu_time() - self.cpu_started
+
+        cycles = sum(device.metrics.cycle_duration.count for device in self.devices)
+        latencies = [arrival - stored for arrival, stored in self.server.arrivals]
+
+        for device in self.devices:
+            device.shutdown()
+        self.server.stop()
+        self.transport.close()
+
+        return {'samples': samples,
+                'duration_s': duration,
+                'samples_per_s': samples / duration,
+                'p99_latency_s': _percentile(latencies, 0.99),
+                'cpu_per_cycle_s': cpu / cycles if cycles else None}
+
+
+def many_pathpoints(scale=1.0):
+    amount, per_pathpoint = int(5000 * scale), 10
+    run = _Run()
+    device, points = run.device(amount)
+
+    run.start()
+    for i in range(per_pathpoint):
+        for point in points:
+            point.store(i)
+    return run.finish(amount * per_pathpoint)
+
+
+def many_devices(scale=1.0):
+    amount, pathpoints, per_pathpoint = int(50 * scale), 5, 200
+    run = _Run()
+    points = []
+    for i in range(amount):
+        points.extend(run.device(pathpoints)[1])
+
+    run.start()
+    for i in range(per_pathpoint):
+        for point in points:
+            point.store(i)
+    return run.finish(len(points) * per_pathpoint)
+
+
+def high_rate(scale=1.0):
+    producers, per_producer = 4, int(50000 * scale)
+    run = _Run()
+    device, points = run.device(producers)
+
+    def produce(point):
+        for i in range(per_producer):
+            point.store(i)
+
+    run.start()
+    threads = [threading.Thread(target=produce, args=(point, )) for point in points]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return run.finish(producers * per_producer)
+
+
+def outage(scale=1.0, duration=2.0):
+    pathpoints, per_pathpoint = 10, int(20000 * scale)
+    run = _Run()
+    device, points = run.device(pathpoints, retry_policy=RetryPolicy(Backoff(0.05, 0.2)))
+
+    run.start()
+    run.server.failure_rate = 1.0
+    deadline = time.time() + duration
+    for i in range(per_pathpoint):
+        for point in points:
+            point.store(i)
+    time.sleep(max(0, deadline - time.time()))
+
+    run.server.failure_rate = 0
+    recovered = time.time()
+    result = run.finish(pathpoints * per_pathpoint)
+    result['recovery_s'] = result['duration_s'] - (recovered - run.started)
+    return result
+
+
+def memory(scale=1.0):
+    if tracemalloc is None:
+        return {}
+
+    amount = int(100000 * scale)
+    result = {}
+    for name, buffer in (('list', ListBuffer()), ('array', ArrayBuffer(capacity=amount))):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(amount):
+            buffer.append((to_server_time(time.time()), float(i)))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        result['bytes_per_sample_%s' % (name, )] = (after - before) / float(amount)
+    return result
+
+
+def sharded(scale=1.0, workers=4):
+    amount, pathpoints, per_pathpoint = 16, 5, int(2000 * scale)
+    server = FakeServer().start()
+    supervisor = Supervisor(workers=workers, longshot_path=server.url)
+    points = []
+    for i in range(amount):
+        device = supervisor.add_device('bench%s' % (i, ), 'secret',
+                                       ['Wp%s' % (j, ) for j in range(pathpoints)])
+        points.extend(device.pathpoints.values())
+    supervisor.start()
+
+    started = time.time()
+    for i in range(per_pathpoint):
+        for point in points:
+            point.store(i)
+    samples = len(points) * per_pathpoint
+    try:
+        _wait_for(server, samples)
+    finally:
+        duration = time.time() - started
+        supervisor.shutdown()
+        server.stop()
+
+    return {'samples': samples,
+            'duration_s': duration,
+            'samples_per_s': samples / duration}
+
+
+SCENARIOS = {
+    'many_pathpoints': many_pathpoints,
+    'many_devices': many_devices,
+    'high_rate': high_rate,
+    'outage': outage,
+    'memory': memory,
+    'sharded': sharded,
+}
+ORDER = ['many_pathpoints', 'many_devices', 'high_rate', 'outage', 'memory', 'sharded']
+
+
+def run(names=None, scale=1.0):
+    """
+    Run scenarios
+    :param names: names of scenarios to run, or None for all of them
+    :return: dict of scenario name => dict of results
+    """
+    return dict((name, SCENARIOS[name](scale)) for name in (names or ORDER))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark longshot against a fake server')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run: %s' % (', '.join(ORDER), ))
+    parser.add_argument('--scale', type=float, default=1.0, help='make scenarios bigger or smaller')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(args)
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s' % (name, ))
+
+    names = args.scenarios or ORDER
+    results = {}
+    for name in names:
+        results[name] = SCENARIOS[name](args.scale)
+        if not args.json:
+            print(name)
+            for key, value in sorted(results[name].items()):
+                print('    %-26s %s' % (key, '-' if value is None else '%.6g' % (value, )))
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""
+Buffers for samples that await upload to the server.
+
+A pathpoint keeps its buffer as .stored_values. Every buffer keeps samples as two parallel
+sequences of timestamps and values, and accepts (timestamp, value) tuples in append() and
+extend().
+
+Samples are kept the way the server wants them: timestamps are integer milliseconds (see
+to_server_time()), and samples are in order of their timestamps, so that an upload can be
+encoded straight from what peek() returns. A sample that arrives out of order is inserted where
+it belongs, but never in front of samples already peeked at - these are on their way to the
+server, and their sequence numbers must not change.
+
+Uploads peek() at the oldest samples, and trim() them once the server acknowledged them, so
+that a failed upload leaves the buffer as it was. Every sample has a sequence number, counted
+from the first sample ever appended, and .head is the sequence number of the oldest sample
+still held. peek() returns the sequence number of the first sample it copied, and trim() takes
+the one just past the last sample acknowledged. Samples dropped by an overflow policy move
+.head just like trimmed ones do, so trimming up to a sequence number never removes samples
+that were not peeked at. drain() takes all samples out at once, and is not used by uploads.
+
+Concurrency: any number of threads can append() to a buffer, while the Longshot thread peeks
+at it and trims it. Each buffer has a lock of its own, held only for the few operations it
+takes to add a sample, or to copy or remove the oldest ones, so producers storing to different
+pathpoints never contend with each other. A sample appended after a peek() is past the
+sequence numbers that the peek returned, so a trim() that follows never removes it.
+
+A producer adds a sample to the buffer before adding its path to Device.dirty, while the
+Longshot thread takes Device.dirty before peeking at the buffers. A sample that misses
+an upload therefore always has its path in the next Device.dirty. If an upload fails,
+the paths of its samples are put back in Device.dirty.
+
+Device.dirty is guarded by Device.condition, which all pathpoints of a device share, so only
+the first sample of a batch takes it. While a pathpoint's needs_sync is set its path is still
+in Device.dirty - it's set together with adding the path, and the Longshot thread clears it
+together with taking Device.dirty, both under Device.condition - so later samples skip the
+device's lock altogether.
+
+Samples are logged to the persistence layer only after their path is in Device.dirty, and the
+Longshot thread takes its checkpoint before taking Device.dirty. A sample logged before the
+checkpoint is therefore always peeked at by the upload that acknowledges the checkpoint.
+Persistence layers lock on their own, though: WALPersistenceLayer.log_sample() takes the log's
+lock for every sample, and SQLitePersistenceLayer.set_current_value() takes its lock for every
+store.
+"""
+import array
+import bisect
+import os
+import threading
+
+try:
+    array.array('q')
+    _MS = 'q'           # typecode of arrays of timestamps
+except ValueError:      # Python 2 has no 'q', but 'l' is 64 bits wide where it matters
+    _MS = 'l'
+
+
+def to_server_time(timestamp):
+    """
+    :param timestamp: UNIX timestamp, in seconds
+    :return: timestamp in integer milliseconds, as buffers keep it and the server counts it
+    """
+    return int(round(timestamp * 1000))
+
+
+class ListBuffer(object):
+    """
+    Unbounded buffer, that can hold values of any type.
+
+    This is the default.
+    """
+    __slots__ = ('lock', 'timestamps', 'values', 'head', 'peeked')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timestamps = []
+        self.values = []
+        self.head = 0           # sequence number of the oldest sample held
+        self.peeked = 0         # sequence number of the first sample not yet peeked at
+
+    def append(self, sample):
+        """
+        Add a sample
+        :param sample: tuple of (timestamp in ms, value)
+        """
+        timestamp, value = sample
+        with self.lock:
+            timestamps = self.timestamps
+            if not timestamps or timestamp >= timestamps[-1]:
+                timestamps.append(timestamp)
+                self.values.append(value)
+            else:
+                i = self._position(timestamp)
+                timestamps.insert(i, timestamp)
+                self.values.insert(i, value)
+
+    def _position(self, timestamp):
+        """
+        Index to insert a sample that arrived out of order at. Call with lock held, and
+        the buffer normalized.
+        """
+        return max(bisect.bisect_right(self.timestamps, timestamp), self.peeked - self.head)
+
+    def extend(self, samples):
+        """
+        Add samples
+        :param samples: iterable of (timestamp in ms, value)
+        """
+        for sample in samples:
+            self.append(sample)
+
+    def drain(self):
+        """
+        Remove all samples from the buffer. The sequences are handed over, not copied.
+        :return: tuple of (sequence of timestamps, sequence of values)
+        """
+        with self.lock:
+            timestamps, values = self.timestamps, self.values
+            self.timestamps, self.values = [], []
+            self.head += len(timestamps)
+        return timestamps, values
+
+    def _normalize(self):
+        """Make timestamps and values hold all the samples, oldest first. Call with lock held."""
+
+    def peek(self, limit=None):
+        """
+        Copy the oldest samples, leaving them in the buffer
+        :param limit: maximum amount of samples to copy, or None for all of them
+        :return: tuple of (sequence number of the first sample, sequence of timestamps,
+            sequence of values)
+        """
+        with self.lock:
+            self._normalize()
+            timestamps = self.timestamps[:limit]
+            self.peeked = max(self.peeked, self.head + len(timestamps))
+            return self.head, timestamps, self.values[:limit]
+
+    def trim(self, upto):
+        """
+        Remove samples that have sequence numbers lower than upto
+        """
+        with self.lock:
+            self._normalize()
+            count = min(upto - self.head, len(self.timestamps))
+            if count <= 0:
+                return
+            del self.timestamps[:count]
+            del self.values[:count]
+            self.head += count
+
+    def oldest(self):
+        """:return: timestamp in ms of the oldest sample, or None if there's none"""
+        with self.lock:
+            return self.timestamps[0] if self.timestamps else None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(zip(self.timestamps, self.values))
+
+
+DROP_OLDEST = 'drop_oldest'     #: when full, overwrite the oldest sample
+DOWNSAMPLE = 'downsample'       #: when full, drop every other sample, halving the resolution
+SPILL = 'spill'                 #: when full, move samples to a file on disk
+
+
+class ArrayBuffer(ListBuffer):
+    """
+    Bounded buffer for numeric values.
+
+    Samples are kept in an array of int64 timestamps and an array('d') of values, which takes
+    16 bytes per sample, instead of a tuple and two objects per sample. Values have to be numbers.
+
+    Spilled samples stay on disk until they are trimmed: peek() reads back only as many of them
+    as it returns, and trim() skips over them, removing the file once all of them are gone.
+    DOWNSAMPLE leaves samples that were peeked at alone, as they are on their way to the server.
+    """
+    __slots__ = ('capacity', 'overflow', 'spill_path', 'start', 'spilled', 'skipped', 'newest')
+
+    def __init__(self, capacity=100000, overflow=DROP_OLDEST, spill_path=None):
+        """
+        :param capacity: maximum amount of samples to keep in memory
+        :param overflow: what to do when the buffer is full. One of DROP_OLDEST, DOWNSAMPLE or
+            SPILL.
+        :param spill_path: name of the file to spill samples to. Required if overflow is SPILL.
+        """
+        if overflow not in (DROP_OLDEST, DOWNSAMPLE, SPILL):
+            raise ValueError('unknown overflow policy %s' % (overflow, ))
+        if overflow == SPILL and spill_path is None:
+            raise ValueError('spill_path is required to spill')
+
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.start = 0          # index of the oldest sample, nonzero once DROP_OLDEST went around
+        self.spilled = 0        # amount of samples in the spill file
+        self.skipped = 0        # amount of samples at start of the spill file that were trimmed
+        self.newest = None      # timestamp of the newest sample appended
+        self.timestamps = array.array(_MS)
+        self.values = array.array('d')
+        self.head = 0
+        self.peeked = 0
+
+    def append(self, sample):
+        timestamp, value = sample
+        with self.lock:
+            self._append(timestamp, value)
+
+    def _append(self, timestamp, value):
+        """Call with lock held"""
+        if self.newest is not None and timestamp < self.newest:
+            self._insert(timestamp, value)
+            return
+        self.newest = timestamp
+
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+            return
+
+        if self.overflow == DROP_OLDEST:
+            self.timestamps[self.start] = timestamp
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+            self.head += 1
+        elif self.overflow == DOWNSAMPLE:
+            self._downsample()
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+        else:
+            self._spill()
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+
+    def _downsample(self):
+        """
+        Drop every other sample not peeked at yet, or the oldest one if there are too few of
+        these. Call with lock held, and the buffer normalized.
+        """
+        peeked = max(0, self.peeked - self.head)
+        if len(self.timestamps) - peeked >= 2:
+            self.timestamps = self.timestamps[:peeked] + self.timestamps[peeked::2]
+            self.values = self.values[:peeked] + self.values[peeked::2]
+        else:       # it's still the oldest one that goes, so trimming stays right
+            del self.timestamps[0]
+            del self.values[0]
+            self.head += 1
+
+    def _position(self, timestamp):
+        return max(bisect.bisect_right(self.timestamps, timestamp),
+                   self.peeked - self.head - self.spilled)
+
+    def _insert(self, timestamp, value):
+        """Add a sample that arrived out of order. Call with lock held."""
+        self._normalize()
+        if self.spilled and (not self.timestamps or timestamp < self.timestamps[0]):
+            # It belongs among spilled samples - read them back, to be spilled again on next append
+            timestamps, values = self._unspill()
+            timestamps.extend(self.timestamps)
+            values.extend(self.values)
+            self.timestamps, self.values = timestamps, values
+        i = self._position(timestamp)
+        self.timestamps.insert(i, timestamp)
+        self.values.insert(i, value)
+
+        if len(self.timestamps) <= self.capacity:
+            return
+        if self.overflow == DROP_OLDEST:
+            del self.timestamps[0]
+            del self.values[0]
+            self.head += 1
+        elif self.overflow == DOWNSAMPLE:
+            self._downsample()
+
+    def _spill(self):
+        """Move all samples in memory to the spill file. Call with lock held."""
+        with open(self.spill_path, 'ab') as f:
+            array.array(_MS, [len(self.timestamps)]).tofile(f)
+            self.timestamps.tofile(f)
+            self.values.tofile(f)
+
+        self.spilled += len(self.timestamps)
+        self.timestamps = array.array(_MS)
+        self.values = array.array('d')
+
+    def _read_spilled(self, count):
+        """
+        Read the oldest samples from the spill file, past the ones that were trimmed.
+        Call with lock held.
+
+        :param count: amount of samples to read, at most .spilled
+        :return: tuple of (array of timestamps, array of values)
+        """
+        timestamps = array.array(_MS)
+        values = array.array('d')
+        ms_size, value_size = timestamps.itemsize, values.itemsize
+        skip = self.skipped
+
+        with open(self.spill_path, 'rb') as f:
+            while len(timestamps) < count:
+                header = array.array(_MS)
+                header.fromfile(f, 1)
+                length = int(header[0])
+                start = f.tell()
+                end = start + length * (ms_size + value_size)
+                if skip < length:
+                    take = min(length - skip, count - len(timestamps))
+                    f.seek(start + skip * ms_size)
+                    timestamps.fromfile(f, take)
+                    f.seek(start + length * ms_size + skip * value_size)
+                    values.fromfile(f, take)
+                    skip = 0
+                else:
+                    skip -= length
+                f.seek(end)
+
+        return timestamps, values
+
+    def _unspill(self):
+        """Read back all samples from the spill file, and remove it. Call with lock held."""
+        timestamps, values = self._read_spilled(self.spilled)
+        os.unlink(self.spill_path)
+        self.spilled = self.skipped = 0
+        return timestamps, values
+
+    def _normalize(self):
+        """Put the ring back in order. Spilled samples stay on disk."""
+        if self.start:
+            self.timestamps = self.timestamps[self.start:] + self.timestamps[:self.start]
+            self.values = self.values[self.start:] + self.values[:self.start]
+            self.start = 0
+
+    def peek(self, limit=None):
+        with self.lock:
+            self._normalize()
+            spilled = self.spilled if limit is None else min(limit, self.spilled)
+            if spilled:
+                timestamps, values = self._read_spilled(spilled)
+                rest = None if limit is None else limit - spilled
+                timestamps.extend(self.timestamps[:rest])
+                values.extend(self.values[:rest])
+            else:
+                timestamps, values = self.timestamps[:limit], self.values[:limit]
+            self.peeked = max(self.peeked, self.head + len(timestamps))
+            return self.head, timestamps, values
+
+    def trim(self, upto):
+        with self.lock:
+            self._normalize()
+            count = min(upto - self.head, len(self))
+            if count <= 0:
+                return
+
+            spilled = min(count, self.spilled)
+            if spilled:
+                self.spilled -= spilled
+                self.skipped += spilled
+                if not self.spilled:
+                    os.unlink(self.spill_path)
+                    self.skipped = 0
+
+            del self.timestamps[:count - spilled]
+            del self.values[:count - spilled]
+            self.head += count
+
+    def drain(self):
+        with self.lock:
+            timestamps, values = self.timestamps, self.values
+            self.timestamps, self.values = array.array(_MS), array.array('d')
+            start, self.start = self.start, 0
+            self.head += len(timestamps) + self.spilled
+
+            if self.spilled:
+                spilled_timestamps, spilled_values = self._unspill()
+            else:
+                spilled_timestamps = None
+
+        if start:      # ring went around - put it back in order
+            timestamps = timestamps[start:] + timestamps[:start]
+            values = values[start:] + values[:start]
+
+        if spilled_timestamps is not None:
+            spilled_timestamps.extend(timestamps)
+            spilled_values.extend(values)
+            timestamps, values = spilled_timestamps, spilled_values
+
+        return timestamps, values
+
+    def oldest(self):
+        with self.lock:
+            if self.spilled:        # spilled samples are older than the ones in memory
+                return self._read_spilled(1)[0][0]
+            return self.timestamps[self.start] if self.timestamps else None
+
+    def __len__(self):
+        return len(self.timestamps) + self.spilled
+
+    def __iter__(self):
+        """Iterate over samples kept in memory, oldest first. Spilled samples are skipped."""
+        timestamps, values = self.timestamps, self.values
+        if self.start:
+            timestamps = timestamps[self.start:] + timestamps[:self.start]
+            values = values[self.start:] + values[:self.start]
+        return iter(zip(timestamps, values))
@@ -1,41 +1,136 @@
+import hashlib
 import time
 import threading
 import warnings
-import requests
+from .buffers import to_server_time
+from .metrics import Metrics
+from .payload import PayloadBuilder
+from .priority import CRITICAL, NORMAL, BULK, PRIORITIES, TokenBucket
 from .persistence import NoPersistenceLayer
+from .retry import RetryPolicy, Backoff
+from .transport import Transport
 
 
-class _LongshotThread(threading.Thread):
+REDEFINE_PATHS = '/v1/redefine_paths/'
+UPDATE_PATHS = '/v1/update_paths/'
+SYNC_VALUES = '/v1/sync_values/'
+
+def path_hash(path):
+    """
+    Hash of a single path. Hash of a set of paths is XOR of hashes of its members, so that it can be
+    updated as paths come and go. Hashes are sent to the server as 16 hex digits.
+
+    :param path: prefixed path
+    :return: first 64 bits of MD5 of path, as an integer
+    """
+    return int(hashlib.md5(path.encode('utf8')).hexdigest()[:16], 16)
+
+
+class _LongshotProtocol(object):
+    """
+    Longshot protocol, as spoken by a single device.
+
+    Every API call is split into building the request and handling the answer, so that the
+    same logic can be driven both by a thread and by an asyncio event loop.
+    """
     def __init__(self, device, api_root, pathpoint_prefix):
-        threading.Thread.__init__(self)
         self.device = device
         self.api_root = api_root
         self.terminating = False
         self.pathpoint_prefix = pathpoint_prefix
+        self.next_order_check = 0       # UNIX timestamp of next get_orders call
+        self.retry_at = 0               # UNIX timestamp before which nothing will be retried
+        self.checkpoint = None          # persistence mark of values being uploaded
+        self.uploading = False          # are values taken out of device.dirty being uploaded?
+        self.acked_upto = None          # mark up to which all but critical samples were acknowledged
+        self.acked_urgent_upto = None   # mark up to which critical samples were acknowledged
+        self.paths_hash = None          # hash of paths being synchronized
+        self.paths_pending = False      # are paths being synchronized right now?
+        self.values_encoding = 'json'   # encoding of sync_values, as agreed with the server
+        self.lane = None                # _CriticalLane, if critical samples have one
+        self.deferred = set()           # bulk paths held back by device.bulk_budget
+
+    def _paths_request(self):
+        """
+        Prepare synchronization of paths. If the server already knows our paths, only paths
+        that were added or removed since will be sent to update_paths. Otherwise all of them
+        are sent to redefine_paths.
 
-    def _syncpaths(self):
-        """synchronize pathpoints against the server"""
-        all_pathpoints = list(self.device.pathpoints.keys())
-
-        r = requests.post(self.api_root + '/v1/redefine_paths/',
-                          json={
-                              'device_id': self.device.device_id,
-                              'secret': self.device.secret,
-                              'paths': all_pathpoints,
-                              'prefix': self.pathpoint_prefix
-                          })
-
-        if r.status_code != 200:
-            raise IOError('Failed to redefine paths')
-
-        self.device.paths_synced = True
+        :return: tuple of (endpoint, payload)
+        """
+        device = self.device
+        payload = {
+            'device_id': device.device_id,
+            'secret': device.secret,
+            'prefix': self.pathpoint_prefix
+        }
+
+        with device.condition:
+            device.paths_synced = True
+            self.paths_pending = True
+            self.paths_hash = '%016x' % (device.paths_hash, )
+
+            if device.paths_full_sync:
+                endpoint = REDEFINE_PATHS
+                payload['paths'] = list(device.pathpoints.keys())
+                payload['encodings'] = list(device.encodings) + ['json']
+            else:
+                endpoint = UPDATE_PATHS
+                payload['add'] = list(device.paths_added)
+                payload['remove'] = list(device.paths_removed)
+                payload['base_hash'] = '%016x' % (device.server_paths_hash, )
+                payload['hash'] = self.paths_hash
+
+            device.paths_added = set()
+            device.paths_removed = set()
+
+        return endpoint, payload
+
+    def _on_paths_failed(self):
+        """Paths could not be synchronized. Next time, all of them will be sent."""
+        with self.device.condition:
+            self.paths_pending = False
+            self.device.paths_synced = False
+            self.device.paths_full_sync = True
+            self.device.condition.notify_all()
+
+    def _on_paths(self, r):
+        """
+        Handle answer to redefine_paths or update_paths
+        :raises IOError: answer is not one of Longshot
+        """
+        device = self.device
 
-        r = r.json()
+        try:
+            encoding = r.get('encoding')
+            paths_hash = r.get('hash')
+            values = list(r['values'].items())
+        except (AttributeError, KeyError, TypeError):
+            self._on_paths_failed()
+            raise IOError('Unexpected answer to synchronization of paths')
+
+        # Server tells which of the encodings we offered it prefers
+        if encoding == 'json' or encoding in device.encodings:
+            self.values_encoding = encoding
+
+        with device.condition:
+            self.paths_pending = False
+            device.condition.notify_all()       # the critical lane waits for this
+            if paths_hash is None:
+                # Server did not say what it thinks our paths are, so deltas can't be based on it
+                device.paths_full_sync = True
+            elif paths_hash != self.paths_hash:
+                # Server has a different idea about what our paths are - send all of them again
+                device.paths_synced = False
+                device.paths_full_sync = True
+            else:
+                device.paths_full_sync = False
+                device.server_paths_hash = int(self.paths_hash, 16)
 
         # Now we need to check default values for sensors that are registered first time
         # in this session
 
-        for path, tsv in r['values'].iteritems():
+        for path, tsv in values:
             try:
                 p = self.device.pathpoints[path]
             except KeyError:     # it might have been deleted while we were syncing!
@@ -44,6 +139,8 @@ class _LongshotThread(threading.Thread):
             if p.declared:        # No need to check it.
                 continue
 
+            timestamp, value = p.current()
+
             try:
                 candidate_ts, candidate_v = tsv
                 candidate_ts /= 1000    # server expresses them in milliseconds
@@ -51,33 +148,47 @@ class _LongshotThread(threading.Thread):
                 did_server_value_win = False
             else:
                 did_server_value_win = False        # because if it does, we need to schedule a sync...
-                if p.value is None:     # server value automatically wins...
+                if value is None:     # server value automatically wins...
                     did_server_value_win = True
                 else: # there is a conflict
-                    if candidate_ts > p.timestamp:
+                    if candidate_ts > timestamp:
                         did_server_value_win = True
 
             if did_server_value_win:
                 p.on_write_arrived(candidate_ts, candidate_v)
             else:
-                if not (p.timestamp is None or p.value is None):
-                    p.stored_values.append((p.timestamp, p.value))
-                    p.needs_sync = True
+                if not (timestamp is None or value is None):
+                    p._queue(timestamp, value)
 
             p.declared = True
 
-    def _check_order_queue(self):
-        r = requests.post(self.api_root + '/v1/get_orders/',
-                          json={'device_id': self.device.device_id, 'secret': self.device.secret})
-        if r.status_code != 200:
-            raise IOError('Failed to get orders')
-
-        r = r.json()
-
-        for pathpoint, value in r['writes'].iteritems():
-            timestamp, value = value
-            timestamp /= 1000    # server counts in ms
+    def _orders_request(self, wait=None):
+        """
+        :param wait: seconds for the server to hold the request until there are orders,
+            or None to answer right away
+        """
+        payload = {'device_id': self.device.device_id, 'secret': self.device.secret}
+        if wait is not None:
+            payload['wait'] = wait
+        return payload
 
+    def _on_orders(self, r):
+        """
+        Handle writes from answer to get_orders
+        :return: list of pathpoints that the server wants read
+        :raises IOError: answer is not one of Longshot
+        """
+        try:
+            # server counts in ms
+            writes = [(pathpoint, timestamp / 1000, value)
+                      for pathpoint, (timestamp, value) in r['writes'].items()]
+            paths = list(r['reads'])
+            if (writes or paths) and 'pot' not in r:
+                raise KeyError('pot')
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise IOError('Unexpected answer to get_orders')
+
+        for pathpoint, timestamp, value in writes:
             try:
                 pp = self.device.pathpoints[pathpoint]
             except KeyError:
@@ -85,97 +196,639 @@ class _LongshotThread(threading.Thread):
             else:
                 pp.on_write_arrived(timestamp, value)
 
-        for pathpoint in r['reads']:
+        reads = []
+        for pathpoint in paths:
             try:
-                pp = self.device.pathpoints[pathpoint]
+                reads.append(self.device.pathpoints[pathpoint])
             except KeyError:
                 continue
+        return reads
+
+    def _on_read(self, pp, v):
+        """A value was read in response to server's read order. Can be called from any thread."""
+        if v is not None:
+            timestamp = time.time()
+            if pp.history is not None:
+                pp.history.add(timestamp, v)
+            pp._queue(timestamp, v)
 
-            v = pp.obtain_value()
-            if v is not None:
-                pp.stored_values.append((time.time(), v))
-                pp.needs_sync = True
+    def _start_reads(self, reads):
+        """
+        Order reads of pathpoints. Without a read pool they are done right away.
+        :return: list of jobs to pass to _finish_reads()
+        """
+        if self.device.read_pool is None:
+            for pp in reads:
+                try:
+                    v = pp.obtain_value()
+                except Exception:
+                    self.device.metrics.observe_callback_error()
+                    continue
+                self._on_read(pp, v)
+            return []
+
+        return [self.device.read_pool.submit(pp, self._on_read) for pp in reads]
+
+    def _finish_reads(self, jobs, deadline):
+        """
+        Wait for reads, but not past deadline
+        :return: list of prefixed paths that could not be read in time
+        """
+        if not jobs:
+            return []
+        return [job.pathpoint.prefixed_path for job in self.device.read_pool.wait(jobs, deadline)]
 
+    def _confirm_request(self, r, failed_reads):
+        """
+        :param r: answer to get_orders
+        :param failed_reads: list of paths that could not be read
+        :return: payload for confirm_orders, or None if there's nothing to confirm
+        """
         if len(r['writes']) == len(r['reads']) == 0:
-            return
-        else:
-            requests.post(self.api_root + '/v1/confirm_orders/', json={'device_id': self.device.device_id,
-                                                                       'secret': self.device.secret,
-                                                                       'pot': r['pot']})
+            return None
 
+        payload = {'device_id': self.device.device_id,
+                   'secret': self.device.secret,
+                   'pot': r['pot']}
+        if failed_reads:
+            payload['failed_reads'] = failed_reads
+        return payload
 
-    def _syncvalues(self):
-        # we did not break - this means there is a need to sync
-        sync_dict = {}
+    def _on_critical_registered(self):
+        """A critical pathpoint was registered. Call with device.condition held."""
+        pass
 
-        for pathpoint in self.device.pathpoints.values():
-            if pathpoint.stored_values:
-                    # server deals in MS
-                q = ((ts * 1000, v) for ts, v in pathpoint.stored_values)
+    def _needs_upload(self):
+        device = self.device
+        return bool(device.dirty or self.deferred or (self.lane is None and device.urgent))
 
-                sync_dict[pathpoint.prefixed_path] = sorted(q)
-                pathpoint.stored_values = []
+    def _values_chunks(self):
+        """
+        Prepare upload of all values that await it. They are split into chunks of at most
+        device.chunk_samples samples and about device.chunk_bytes bytes, each of which is sent
+        as a separate sync_values call. Samples stay in buffers until the chunk that carries
+        them is acknowledged.
 
-        r = requests.post(self.api_root + '/v1/sync_values/', json={'device_id': self.device.device_id,
-                                                                    'secret': self.device.secret,
-                                                                    'values': sync_dict})
+        Critical samples go first, unless there's a lane for them, and bulk ones last. Bulk
+        samples that don't fit in device.bulk_budget are held back until it refills.
 
-        if r.status_code != 200:
-            # If you failed syncing, return the values to pool and try another time
-            for path, values in sync_dict.iteritems():
+        :return: list of longshot.payload.Chunk
+        """
+        # Checkpoint before peeking, so that everything logged up to the mark gets uploaded
+        self.checkpoint = self.device.persistence.checkpoint()
+        return self._chunks_since_checkpoint()
+
+    def _chunks_since_checkpoint(self):
+        """_values_chunks(), for callers that set self.checkpoint by themselves"""
+        device = self.device
+
+        lanes = dict((priority, []) for priority in PRIORITIES)
+
+        # needs_sync is cleared together with taking paths out of dirty, see longshot.buffers
+        with device.condition:
+            self.uploading = True
+            dirty, device.dirty = device.dirty, set()
+            if self.lane is None:
+                dirty.update(device.urgent)
+                device.urgent = set()
+            dirty.update(self.deferred)
+            self.deferred = set()
+
+            for path in dirty:
                 try:
-                    self.device.pathpoints[path].stored_values.extend([(ts/1000, v) for ts, v in values])
-                except KeyError:
-                    pass
-            raise IOError('Failed to sync')
+                    pathpoint = device.pathpoints[path]
+                except KeyError:    # unregistered in the meantime
+                    continue
+
+                pathpoint.needs_sync = False
+                lanes[pathpoint.priority].append(pathpoint)
+
+        builder = PayloadBuilder(device)
+        for pathpoint in lanes[CRITICAL] + lanes[NORMAL]:
+            builder.add(pathpoint)
+
+        budget = device.bulk_budget
+        for pathpoint in lanes[BULK]:
+            if budget is None:
+                builder.add(pathpoint)
+                continue
+            size, complete = builder.add(pathpoint, budget.available())
+            budget.take(size)
+            if not complete:
+                self.deferred.add(pathpoint.prefixed_path)
+
+        return builder.build()
+
+    def _trim(self, chunks, statuses):
+        """
+        Trim samples of acknowledged chunks from buffers
+        :return: set of paths that have samples in chunks that were not acknowledged
+        """
+        unacknowledged = set()
+
+        sent = [status for status in statuses if status is not None]
+        self.device.metrics.observe_upload(
+            sum(chunk.samples for chunk, status in zip(chunks, statuses) if status == 200),
+            len(sent), all(status == 200 for status in sent))
+
+        for chunk, status in zip(chunks, statuses):
+            if status == 415 and self.values_encoding != 'json':
+                # Server no longer understands the encoding it agreed to
+                self.values_encoding = 'json'
+
+            for pathpoint, upto in chunk.marks:
+                if status == 200 and pathpoint.prefixed_path not in unacknowledged:
+                    pathpoint.stored_values.trim(upto)
+                    pathpoint.synced = True
+                else:
+                    unacknowledged.add(pathpoint.prefixed_path)
+
+        return unacknowledged
+
+    def _on_chunks_sent(self, chunks, statuses):
+        """
+        Trim samples of acknowledged chunks from buffers. Paths that have samples in a chunk that
+        was not acknowledged stay dirty - their samples will be sent again, starting with the
+        oldest one that was not acknowledged.
+
+        :param chunks: list of longshot.payload.Chunk
+        :param statuses: HTTP status of answer to every chunk. 0 if it wasn't answered,
+            None if it wasn't sent.
+        :return: whether no chunk failed. Chunks that weren't sent did not fail.
+        """
+        device = self.device
+        unacknowledged = self._trim(chunks, statuses)
+
+        for path in unacknowledged:
+            try:
+                pathpoint = device.pathpoints[path]
+            except KeyError:
+                continue
+            device.notify_stored(path, pathpoint.priority)
+
+        with device.condition:
+            self.uploading = False
+            # Bulk samples held back are not acknowledged yet either
+            mark = None
+            if not (unacknowledged or self.deferred):
+                mark = self._acknowledged(self.checkpoint, critical=False)
+        if mark is not None:
+            self._acknowledge(mark)
+
+        return all(status in (200, None) for status in statuses)
+
+    def _acknowledge(self, mark):
+        """Tell the persistence layer that samples logged before mark were uploaded"""
+        self.device.persistence.acknowledge(mark)
+
+    def _acknowledged(self, mark, critical):
+        """
+        All samples of one kind - critical ones, if the lane uploads them, or all the others -
+        that were logged before the checkpoint returned mark were acknowledged. Samples of the
+        other kind hold the persistence layer back, unless none of them await upload.
+        Call with device.condition held.
+
+        :return: mark to acknowledge to the persistence layer, or None
+        """
+        device = self.device
+        if mark is None:
+            return None
+
+        if critical:
+            self.acked_urgent_upto = mark
+            other, idle = self.acked_upto, not (device.dirty or self.deferred or self.uploading)
         else:
-            for pathpoint in self.device.pathpoints.values():
-                pathpoint.synced = True
+            self.acked_upto = mark
+            other, idle = self.acked_urgent_upto, self.lane is None or not device.urgent
 
+        if idle:
+            return mark
+        if other is None:
+            return None
+        return min(mark, other)
 
-    def run(self):
+    def _urgent_chunks(self):
+        """
+        Prepare upload of samples of critical pathpoints, for the critical lane. Their paths
+        stay in device.urgent until the samples are acknowledged.
+
+        :return: tuple of (persistence mark, list of paths, list of longshot.payload.Chunk)
+        """
+        device = self.device
+        checkpoint = device.persistence.checkpoint()
+        pathpoints = []
+        with device.condition:
+            paths = list(device.urgent)
+            for path in paths:
+                pathpoint = device.pathpoints.get(path)
+                if pathpoint is not None:
+                    pathpoint.needs_sync = False
+                    pathpoints.append(pathpoint)
+
+        builder = PayloadBuilder(device)
+        for pathpoint in pathpoints:
+            builder.add(pathpoint)
+        return checkpoint, paths, builder.build()
+
+    def _on_urgent_sent(self, checkpoint, paths, chunks, statuses):
+        """
+        :param checkpoint: persistence mark taken when chunks were prepared
+        :param paths: paths that chunks were prepared for
+        :return: whether all chunks were acknowledged
+        """
+        device = self.device
+        unacknowledged = self._trim(chunks, statuses)
+
+        mark = None
+        with device.condition:
+            for path in paths:
+                pathpoint = device.pathpoints.get(path)
+                if pathpoint is None or not (pathpoint.needs_sync or path in unacknowledged):
+                    device.urgent.discard(path)
+            if not unacknowledged:
+                mark = self._acknowledged(checkpoint, critical=True)
+        if mark is not None:
+            self._acknowledge(mark)
+
+        return not unacknowledged
+
+    def _on_cycle_failed(self):
+        """A call to Longshot API failed. Postpone everything as the retry policy says."""
+        self.retry_at = time.time() + self.device.retry.failed()
+
+    def _on_cycle_succeeded(self):
+        self.device.retry.succeeded()
+
+    def _next_deadline(self, now):
+        """
+        Compute when there will be something to do. Call with device.condition held.
+        :return: UNIX timestamp
+        """
+        device = self.device
+
+        if not device.paths_synced or (self.lane is None and device.urgent):
+            deadline = now
+        else:
+            deadline = self.next_order_check
+
+            if device.pending_since is not None:
+                upload_at = min(device.last_stored + device.upload_min_delay,
+                                device.pending_since + device.upload_max_latency)
+                deadline = min(deadline, upload_at)
+
+            if self.deferred:
+                deadline = min(deadline, now + device.bulk_budget.delay())
+
+            for path in device.aggregating:
+                pathpoint = device.pathpoints.get(path)
+                closes_at = pathpoint and pathpoint.reduction.closes_at
+                if closes_at is not None:
+                    deadline = min(deadline, closes_at)
+
+        return max(deadline, self.retry_at)
+
+    def _close_buckets(self, now):
+        """Queue aggregates of buckets of reductions that ended by now"""
+        device = self.device
+        with device.condition:
+            paths = list(device.aggregating)
+        for path in paths:
+            pathpoint = device.pathpoints.get(path)
+            if pathpoint is not None:
+                pathpoint._close_bucket(now)
+
+    def _is_upload_due(self, now):
+        device = self.device
+        self._close_buckets(now)
+        with device.condition:
+            due = (self.lane is None and bool(device.urgent)) or \
+                  (bool(self.deferred) and device.bulk_budget.delay() == 0)
+
+            if device.pending_since is not None and \
+               (now - device.last_stored >= device.upload_min_delay or
+                    now - device.pending_since >= device.upload_max_latency):
+                due = True
+
+            if due:
+                device.pending_since = None
+            return due
+
+
+class _LongshotThread(_LongshotProtocol, threading.Thread):
+    def __init__(self, device, api_root, pathpoint_prefix):
+        threading.Thread.__init__(self)
+        _LongshotProtocol.__init__(self, device, api_root, pathpoint_prefix)
+        self.listener = None        # _OrderListener, if orders are pushed
+
+    def start(self):
+        if self.device.push_orders:
+            self.listener = _OrderListener(self)
+            self.listener.start()
+        threading.Thread.start(self)
+
+        device = self.device
+        with device.condition:
+            if any(pathpoint.priority == CRITICAL for pathpoint in device.pathpoints.values()):
+                self._on_critical_registered()
+
+    def _on_critical_registered(self):
+        """Critical samples get a lane once there's a critical pathpoint and the thread runs"""
+        if self.lane is None and self.is_alive():
+            self.lane = _CriticalLane(self)
+            self.lane.start()
+
+    def _post(self, endpoint, payload, encoding='json'):
+        """POST to an API endpoint, and record how long it took"""
+        started = time.time()
+        ok = False
+        try:
+            r = self.device.transport.post(self.api_root, endpoint, payload, encoding)
+            ok = r.status_code == 200
+            return r
+        finally:
+            self.device.metrics.observe_call(endpoint, time.time() - started, ok)
+
+    def _call(self, endpoint, payload, error):
+        """
+        Call an API endpoint
+        :param error: message of IOError to raise if the call fails
+        :return: decoded answer
+        """
+        r = self._post(endpoint, payload)
+        if r.status_code != 200:
+            raise IOError(error)
+        try:
+            return r.json()
+        except ValueError:      # a proxy answered in its stead
+            raise IOError(error)
+
+    def _syncpaths(self):
+        """synchronize pathpoints against the server"""
         while True:
+            endpoint, payload = self._paths_request()
             try:
-                self._syncpaths()
+                r = self._call(endpoint, payload, 'Failed to redefine paths')
             except IOError:
-                time.sleep(20)
-            else:
-                break
+                self._on_paths_failed()
+                if endpoint == REDEFINE_PATHS:
+                    raise
+                continue        # fall back to redefining all of them right away
+
+            self._on_paths(r)
+            return
+
+    def _check_order_queue(self, wait=None):
+        """
+        Get orders, carry them out and confirm them
+        :param wait: see _orders_request()
+        :return: answer to get_orders
+        """
+        r = self._call('/v1/get_orders/', self._orders_request(wait), 'Failed to get orders')
+        started = time.time()
+        jobs = self._start_reads(self._on_orders(r))
+        failed_reads = self._finish_reads(jobs, time.time() + self.device.read_timeout)
+
+        confirm = self._confirm_request(r, failed_reads)
+        if confirm is not None:
+            self._post('/v1/confirm_orders/', confirm)
+            self.device.metrics.observe_orders(time.time() - started)
+        return r
+
+    def _post_chunk(self, chunk):
+        """:return: HTTP status of the answer, or 0 if there was none"""
+        try:
+            r = self._post(SYNC_VALUES, chunk.payload, self.values_encoding)
+        except IOError:     # requests' exceptions, timeouts included, are IOErrors
+            return 0
+        return r.status_code
+
+    def _post_chunks(self, chunks):
+        """
+        Send chunks, up to device.upload_pipeline of them at once over pooled connections.
+        No more chunks are sent after one fails, or once orders are due to be checked.
+        :return: list of statuses, as taken by _on_chunks_sent()
+        """
+        statuses = [None] * len(chunks)
+        lock = threading.Lock()
+        pending = iter(range(len(chunks)))
+        dispatched = []
+        failed = []
+
+        def send():
+            while True:
+                with lock:
+                    if failed or (dispatched and time.time() >= self.next_order_check):
+                        i = None
+                    else:
+                        i = next(pending, None)
+                        dispatched.append(i)
+                if i is None:
+                    return
+                status = self._post_chunk(chunks[i])
+                with lock:
+                    statuses[i] = status
+                    if status != 200:
+                        failed.append(i)
+
+        helpers = [threading.Thread(target=send)
+                   for i in range(min(self.device.upload_pipeline, len(chunks)) - 1)]
+        for helper in helpers:
+            helper.daemon = True
+            helper.start()
+        send()
+        for helper in helpers:
+            helper.join()
+        return statuses
+
+    def _syncvalues(self):
+        chunks = self._values_chunks()
+        if not self._on_chunks_sent(chunks, self._post_chunks(chunks)):
+            raise IOError('Failed to sync')
+
+    def _final_upload(self, deadline):
+        """
+        Once terminating, wait for this thread and the critical lane to finish, and upload the
+        samples that are still held
+        :param deadline: time.time() to give up waiting at
+        """
+        for thread in (self, self.lane):
+            if thread is not None:
+                thread.join(max(0, deadline - time.time()))
+                if thread.is_alive():       # stuck in a call to the server
+                    return
+
+        self.lane = None                    # critical samples go in this upload too
+        self.next_order_check = deadline
+        device = self.device
+        try:
+            if not device.paths_synced:
+                self._syncpaths()
+            if self._needs_upload():
+                self._syncvalues()
+        except IOError:
+            pass
+        device.persistence.sync()
 
-        while not self.terminating:
+    def run(self):
+        device = self.device
+
+        while True:
+            with device.condition:
+                while not self.terminating:
+                    now = time.time()
+                    timeout = self._next_deadline(now) - now
+                    if timeout <= 0:
+                        break
+                    device.condition.wait(timeout)
+
+            if self.terminating:
+                return
+
+            started = time.time()
             try:
                 # sync paths
-                if not self.device.paths_synced:
+                if not device.paths_synced:
                     self._syncpaths()
 
                 # check order queue
-                self._check_order_queue()
-
-                need_to_sync = False
-                for synced in [not pathpoint.needs_sync for pathpoint in self.device.pathpoints.values()]:
-                    if not synced:
-                        need_to_sync = True
-                        break
+                if now >= self.next_order_check:
+                    self.next_order_check = now + device.order_interval
+                    self._check_order_queue()
 
-                if need_to_sync:
+                if self._is_upload_due(now) and self._needs_upload():
                     self._syncvalues()
 
-                self.device.persistence.sync()
-                time.sleep(30)
+                device.persistence.sync()
+
+            except IOError:
+                self._on_cycle_failed()
+            else:
+                self._on_cycle_succeeded()
+
+            device.metrics.observe_cycle(time.time() - started)
+
+
+class _OrderListener(threading.Thread):
+    """
+    Long-polls get_orders, so that orders are carried out as soon as the server issues them.
+
+    While it's connected, the Longshot thread does not poll for orders. When the connection
+    drops, the Longshot thread polls right away and then every order_interval, while this
+    reconnects with backoff. If the server does not hold get_orders (its answers lack 'wait'),
+    this gives up and polling goes on as usual.
+    """
+
+    def __init__(self, runner):
+        threading.Thread.__init__(self)
+        self.daemon = True      # it might be waiting for an answer when the device shuts down
+        self.runner = runner
+        self.connected = False  #: is the server pushing orders to us?
+        self.backoff = Backoff(initial=1, maximum=60)
+
+    def _dropped(self):
+        if not self.connected:
+            return
+        self.connected = False
+        device = self.runner.device
+        with device.condition:
+            self.runner.next_order_check = 0
+        device.wake()
 
+    def run(self):
+        runner = self.runner
+        device = runner.device
+
+        while not runner.terminating:
+            try:
+                r = runner._check_order_queue(wait=device.push_wait)
             except IOError:
-                pass
+                self._dropped()
+                time.sleep(self.backoff.next_delay())
+                continue
+
+            if not r.get('wait'):
+                self._dropped()
+                return
+
+            self.backoff.reset()
+            self.connected = True
+            with device.condition:
+                runner.next_order_check = time.time() + device.order_interval
+
+
+class _CriticalLane(threading.Thread):
+    """
+    Uploads samples of critical pathpoints as soon as they are stored, so that they don't wait
+    behind other uploads or orders. It posts through the device's transport, same as the
+    Longshot thread. See longshot.priority.
+
+    It waits for paths to be synchronized, and honors the device's retry policy, failures of
+    its own included.
+    """
+
+    def __init__(self, runner):
+        threading.Thread.__init__(self)
+        self.daemon = True      # it might be waiting for an answer when the device shuts down
+        self.runner = runner
+
+    def run(self):
+        runner = self.runner
+        device = runner.device
+
+        while True:
+            with device.condition:
+                while not runner.terminating:
+                    timeout = None
+                    if device.urgent and device.paths_synced and not runner.paths_pending:
+                        timeout = runner.retry_at - time.time()
+                        if timeout <= 0:
+                            break
+                    device.condition.wait(timeout)
+            if runner.terminating:
+                return
+
+            checkpoint, paths, chunks = runner._urgent_chunks()
+            statuses = []
+            for chunk in chunks:
+                statuses.append(runner._post_chunk(chunk))
+                if statuses[-1] != 200:
+                    break
+            statuses.extend([None] * (len(chunks) - len(statuses)))
+
+            if runner._on_urgent_sent(checkpoint, paths, chunks, statuses):
+                runner._on_cycle_succeeded()
+            else:
+                runner._on_cycle_failed()
 
 
 class Device(object):
     """
     Class that presents a device registered in SMOK system.
     """
+    _runner_class = _LongshotThread
 
     def __init__(self, device_id, secret,
                                   persistence_layer=None,
                                   longshot_path='http://longshot.smok-serwis.pl/',
-                                  pathpoint_prefix='l'):
+                                  pathpoint_prefix='l',
+                                  transport=None,
+                                  order_interval=30,
+                                  upload_min_delay=0.2,
+                                  upload_max_latency=1.0,
+                                  retry_policy=None,
+                                  chunk_samples=10000,
+                                  chunk_bytes=1024*1024,
+                                  upload_pipeline=2,
+                                  push_orders=False,
+                                  push_wait=25,
+                                  history_retention=None,
+                                  history_max_samples=100000,
+                                  bulk_bandwidth=None,
+                                  group=None,
+                                  read_pool=None,
+                                  read_timeout=5,
+                                  dispatcher=None,
+                                  encodings=('lsc1', )):
         """
         Initialize the device
         :param device_id: device ID, as assigned by SMOK administrator
@@ -186,6 +839,42 @@ class Device(object):
             before call to .register() all pathpoints with matching prefixes MUST be declared, or they
             will be deleted.
             Prefix is used to support linking multiple longshots on a single device ID.
+        :param transport: a Transport to use for talking to Longshot API. Pass the same Transport to
+            multiple devices to make them share a single connection pool. If None, a new one will be
+            created for this device.
+        :param order_interval: how often, in seconds, to ask the server for orders
+        :param upload_min_delay: stored values are uploaded after no new value was stored
+            for this many seconds, so that bursts of values are sent together...
+        :param upload_max_latency: ...but no stored value will wait for upload longer than this
+            many seconds, even if new values keep arriving.
+        :param retry_policy: a RetryPolicy, that says how long to wait before retrying after a
+            failed API call. Default is RetryPolicy().
+        :param chunk_samples: maximum amount of samples to send in a single sync_values call.
+            Bigger uploads, such as of a backlog after an outage, are split into chunks, each
+            acknowledged on its own.
+        :param chunk_bytes: approximate maximum size of a single sync_values call, in bytes
+        :param upload_pipeline: maximum amount of chunks to send at once
+        :param push_orders: whether to long-poll get_orders, so that orders arrive as soon as they
+            are issued instead of every order_interval. Polling goes on while the long-poll is
+            down. Ignored by AsyncDevices and devices in a group.
+        :param push_wait: seconds for the server to hold a long-poll. Has to be shorter than
+            the read timeout of the transport.
+        :param history_retention: seconds to keep recent values of every pathpoint for, to be
+            looked up with .history(). None to keep no history.
+        :param history_max_samples: maximum amount of recent values to keep per pathpoint
+        :param bulk_bandwidth: approximate bytes per second to upload samples of bulk pathpoints
+            at, or None for no limit. See longshot.priority.
+        :param group: a DeviceGroup to join. The device will be served by the group's thread and
+            transport, instead of by a thread of its own. longshot_path and transport are then ignored.
+        :param read_pool: a ReadPool to carry out server's read orders on. If None, they will be
+            carried out one after another by the Longshot thread.
+        :param read_timeout: seconds to wait for reads carried out on read_pool. Reads that take
+            longer are reported to the server as failed.
+        :param dispatcher: a Dispatcher to invoke pathpoint callbacks with. If None, they will be
+            invoked by the Longshot thread itself.
+        :param encodings: names of encodings from longshot.wire, other than JSON, to offer the server
+            for sync_values. Server picks one in its answer to redefine_paths. Until then, and if
+            it picks none, JSON is used.
         """
 
         self.device_id = device_id
@@ -194,9 +883,48 @@ class Device(object):
         self.pathpoints = {}  # path name (including prefix) => LongshotPathpoint
         self.done_registering = False       #: was .done() called?
         self.paths_synced = False           #: is there a need to synchronize patches?
-        self.thread = _LongshotThread(self, longshot_path, pathpoint_prefix)
+        self.order_interval = order_interval
+        self.upload_min_delay = upload_min_delay
+        self.upload_max_latency = upload_max_latency
+        self.retry = retry_policy or RetryPolicy()
+        self.chunk_samples = chunk_samples
+        self.chunk_bytes = chunk_bytes
+        self.upload_pipeline = upload_pipeline
+        self.push_orders = push_orders
+        self.push_wait = push_wait
+        self.history_retention = history_retention
+        self.history_max_samples = history_max_samples
+        self.bulk_budget = TokenBucket(bulk_bandwidth) if bulk_bandwidth else None
+        self.read_pool = read_pool
+        self.read_timeout = read_timeout
+        self.dispatcher = dispatcher
+        self.encodings = encodings
+
+        # Longshot thread sleeps on this until there's something to do
+        self.condition = threading.Condition()
+        self.pending_since = None           #: when was the first not yet uploaded value stored?
+        self.last_stored = None             #: when was the last value stored?
+        self.dirty = set()                  #: prefixed paths that have values awaiting upload
+        self.urgent = set()                 #: same, but of critical pathpoints
+        self.aggregating = set()            #: prefixed paths of pathpoints with aggregate buckets
+
+        # Synchronization of paths. All of these are guarded by condition.
+        self.paths_full_sync = True         #: do all paths need to be sent again?
+        self.paths_added = set()            #: paths registered since last synchronization
+        self.paths_removed = set()          #: paths unregistered since last synchronization
+        self.paths_hash = 0                 #: hash of paths registered here, see path_hash()
+        self.server_paths_hash = 0          #: hash of paths as last acknowledged by the server
+
+        self.group = group
+        if group is not None:
+            longshot_path = group.api_root
+            transport = group.transport
+
+        self.thread = self._runner_class(self, longshot_path, pathpoint_prefix)
 
         self.persistence = persistence_layer or NoPersistenceLayer()
+        self.transport = transport or Transport()
+        self.metrics = Metrics(self)        #: see longshot.metrics
 
     def unregister(self, path):
         """
@@ -214,23 +942,180 @@ class Device(object):
 
         self.persistence.del_current_value(path)
 
-        try:
-            del self.pathpoints[path]
-        except KeyError:
-            raise NameError
+        with self.condition:
+            try:
+                del self.pathpoints[path]
+            except KeyError:
+                raise NameError
+
+            self.paths_hash ^= path_hash(path)
+            self.aggregating.discard(path)
+            if path in self.paths_added:
+                self.paths_added.remove(path)
+            else:
+                self.paths_removed.add(path)
+            self.paths_synced = False
 
-        self.paths_synced = False
+        self.wake()
 
     def get(self, path):
         """Obtain a pathpoint. Path is unprefixed.
         Raises KeyError if does not exist"""
         return self.pathpoints[path[0] + self.prefix + path[1:]]
 
+    def history(self, path, t0=None, t1=None, aggregate=None):
+        """
+        Look up recent values of a pathpoint, as stored, written by the server or read.
+        The device has to be given history_retention=.
+
+        :param path: unprefixed path, or a pathpoint
+        :param t0: timestamp to start with, or None to start with the oldest value kept
+        :param t1: timestamp to end with (inclusive), or None to end with the newest value
+        :param aggregate: None, or one of 'min', 'max' or 'mean'
+        :return: list of (timestamp, value) in order of timestamps if aggregate is None, else
+            the aggregate of values, or None if there are none
+        :raises KeyError: there's no such pathpoint
+        :raises ValueError: this device keeps no history
+        """
+        from .pathpoints import BasePathpoint
+        if self.history_retention is None:
+            raise ValueError('device was not given history_retention')
+        pathpoint = path if isinstance(path, BasePathpoint) else self.get(path)
+        return pathpoint.history.query(t0, t1, aggregate)
+
+    def snapshot(self, filename):
+        """
+        Save paths, current values and samples awaiting upload to a file, so that the next
+        process can pick up where this one left off. See longshot.snapshot.
+        """
+        from .snapshot import write_snapshot
+        write_snapshot(self, filename)
+
+    def restore(self, filename):
+        """
+        Restore state saved by .snapshot() into pathpoints registered so far. If the server
+        already knows these paths, they won't be redefined. See longshot.snapshot.
+
+        :raises RuntimeError: called after .done()
+        :raises ValueError: file is not a snapshot of this device
+        """
+        from .snapshot import restore_snapshot
+        if self.done_registering:
+            raise RuntimeError('restore() has to be called before .done()')
+        restore_snapshot(self, filename)
+
+    def _add(self, pathpoint):
+        """Add a pathpoint to paths. Call with condition held."""
+        path = pathpoint.prefixed_path
+        if path not in self.pathpoints:
+            self.paths_hash ^= path_hash(path)
+            if path in self.paths_removed:
+                self.paths_removed.remove(path)
+            self.paths_added.add(path)
+
+        self.pathpoints[path] = pathpoint
+        if pathpoint.priority == CRITICAL:
+            self.thread._on_critical_registered()
+
     def register(self, pathpoint):
         """Register a Pathpoint object into this device"""
+        with self.condition:
+            self._add(pathpoint)
+            self.paths_synced = False
+
+        self.wake()
 
-        self.pathpoints[pathpoint.prefixed_path] = pathpoint
-        self.paths_synced = False
+    def register_many(self, specs):
+        """
+        Create and register many pathpoints at once.
+
+        Current values of all of them are looked up in the persistence layer at once, and
+        paths are synchronized once, after all of them were registered. Pathpoints are
+        CallbackPathpoints.
+
+        :param specs: iterable of either paths, or dicts of keyword arguments of
+            pathpoint_from_functions(), with path as 'path'. Paths are unprefixed.
+        :return: list of registered pathpoints, in order of specs
+        """
+        from .pathpoints import CallbackPathpoint
+
+        specs = [{'path': spec} if not isinstance(spec, dict) else spec for spec in specs]
+        prefixed = [spec['path'][0] + self.prefix + spec['path'][1:] for spec in specs]
+        persisted = self.persistence.get_current_values(prefixed)
+
+        pathpoints = []
+        for spec, path in zip(specs, prefixed):
+            kwargs = dict(spec)
+            kwargs['device'] = self
+            kwargs['persisted'] = persisted.get(path)
+            pathpoints.append(CallbackPathpoint(**kwargs))
+
+        with self.condition:
+            for pathpoint in pathpoints:
+                self._add(pathpoint)
+            self.paths_synced = False
+
+        self.wake()
+        return pathpoints
+
+    def deliver(self, pathpoint, callback, args):
+        """
+        Invoke a pathpoint callback, via the dispatcher if there's one. Without one, exceptions
+        it raises are counted in metrics.callback_errors.
+        :param args: tuple of arguments to invoke callback with
+        """
+        if self.dispatcher is None:
+            try:
+                callback(*args)
+            except Exception:
+                self.metrics.observe_callback_error()
+        else:
+            self.dispatcher.dispatch(pathpoint.prefixed_path, callback, args)
+
+    def wake(self):
+        """Wake the Longshot thread, so that it rechecks whether there's something to do"""
+        if self.group is not None:
+            self.group.wake()
+            return
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def _mark_dirty(self, path):
+        """Call with condition held"""
+        pathpoint = self.pathpoints.get(path)
+        if pathpoint is not None:
+            pathpoint.needs_sync = True
+
+    def notify_stored(self, path, priority=NORMAL):
+        """
+        Called by pathpoints when a new value awaits upload, and their needs_sync was not set.
+        Sets it, together with adding the path to dirty. Values stored while it's set only update
+        last_stored, without taking condition.
+
+        The Longshot thread is woken only by the first value of a batch, as it knows by itself
+        when the batch will be due. Values of critical pathpoints are due right away.
+
+        :param path: prefixed path of the pathpoint
+        :param priority: priority of the pathpoint
+        """
+        if priority == CRITICAL:
+            with self.condition:
+                self._mark_dirty(path)
+                self.urgent.add(path)
+            self.wake()
+            return
+
+        now = time.time()
+        with self.condition:
+            self._mark_dirty(path)
+            self.dirty.add(path)
+            self.last_stored = now
+            if self.pending_since is not None:
+                return
+            self.pending_since = now
+
+        self.wake()
 
     def done(self):
         """
@@ -250,12 +1135,49 @@ class Device(object):
             raise RuntimeError('called .done() twice')
 
         self.done_registering = True
-        self.thread.start()
 
-    def shutdown(self):
-        """Shut this device down"""
+        # Give back samples that were awaiting upload when the process went down
+        for path, samples in self.persistence.recover_samples().items():
+            try:
+                pathpoint = self.pathpoints[path]
+            except KeyError:
+                continue
+            pathpoint.stored_values.extend((to_server_time(ts), v) for ts, v in samples)
+            self.notify_stored(path, pathpoint.priority)
+
+        if self.group is not None:
+            self.group.attach(self)
+        else:
+            self.thread.start()
+
+    def shutdown(self, timeout=None):
+        """
+        Shut this device down
+        :param timeout: seconds to wait for the Longshot thread to finish. Default is to wait
+            as long as it takes.
+        """
+        if self.group is not None:
+            self.group.detach(self)
+            return
+
         self.thread.terminating = True
-        self.thread.join()
+        self.wake()
+        self.thread.join(timeout)
+
+    def flush(self, timeout):
+        """
+        Shut this device down, and upload the samples it still holds. Meant for when the process
+        is about to exit.
+        :param timeout: seconds to wait for the Longshot thread and the critical lane to finish.
+            If they are still stuck in calls to the server by then, nothing more is uploaded.
+        """
+        if self.group is not None:
+            self.group.detach(self)
+            return
+
+        deadline = time.time() + timeout
+        self.shutdown(timeout)
+        self.thread._final_upload(deadline)
 
     def __eq__(self, other):
         return self.device_id == other.device_id
@@ -343,7 +1265,7 @@ class LongshotPathpoint(object):
         self.timestamp = timestamp
 
         for listener in self.listeners:
-            listener(self.value)
+            self.device.deliver(self, listener, (self.value, ))
 
         self.device.persistence.set_current_value(self.path, value)
 
@@ -0,0 +1,127 @@
+import collections
+import threading
+import time
+
+
+class Dispatcher(object):
+    """
+    Delivers pathpoint callbacks off the Longshot thread, so that a slow callback does not
+    delay order confirmation and value uploads.
+
+    Give it to a Device as dispatcher=. One Dispatcher can be shared by many devices.
+
+    Callbacks are invoked either by worker threads of the dispatcher, or, if a loop is given,
+    on that asyncio event loop. Callbacks for a single path are always invoked in order, by the
+    same worker. If a callback still waits to be invoked for a path when another write to that
+    path arrives, the waiting invocation is given the newer arguments instead of queueing another
+    one - so a slow callback sees only the latest write, not every one that it missed.
+
+    If more than max_pending invocations are waiting, dispatching blocks until some are done.
+    When running on an event loop dispatching never blocks, as it's probably done from the loop itself.
+    """
+
+    def __init__(self, workers=1, max_pending=10000, loop=None):
+        """
+        :param workers: amount of worker threads. Ignored if loop is given.
+        :param max_pending: maximum amount of invocations waiting to be done
+        :param loop: asyncio event loop to invoke callbacks on, instead of worker threads
+        """
+        self.max_pending = max_pending
+        self.loop = loop
+        self.condition = threading.Condition()
+        self.terminating = False
+
+        # Shard of a path is hash(path) % len(self.shards), so a path is served by a single worker.
+        # Each shard is a deque of (path, callback) in order of arrival
+        self.shards = [collections.deque() for i in range(1 if loop is not None else workers)]
+        self.pending = {}           # (path, callback) => (args, time it was dispatched)
+
+        # Metrics
+        self.delivered = 0          #: amount of invocations done
+        self.coalesced = 0          #: amount of invocations superseded by newer ones
+        self.errors = 0             #: amount of invocations that raised
+        self.total_latency = 0.0    #: sum of times that invocations waited, in seconds
+        self.max_latency = 0.0      #: longest time that an invocation waited, in seconds
+
+        self.threads = []
+        if loop is None:
+            for shard in self.shards:
+                thread = threading.Thread(target=self._work, args=(shard, ))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    @property
+    def queue_depth(self):
+        """Amount of invocations waiting to be done"""
+        return len(self.pending)
+
+    @property
+    def mean_latency(self):
+        """Mean time in seconds that invocations waited, or None if none was done"""
+        if self.delivered == 0:
+            return None
+        return self.total_latency / self.delivered
+
+    def dispatch(self, path, callback, args):
+        """
+        Schedule callback(*args) to be invoked
+        :param path: path that the invocation concerns
+        """
+        key = path, callback
+        with self.condition:
+            if key in self.pending:
+                self.pending[key] = args, self.pending[key][1]
+                self.coalesced += 1
+                return
+
+            if self.loop is None:
+                while len(self.pending) >= self.max_pending and not self.terminating:
+                    self.condition.wait()
+
+            self.pending[key] = args, time.time()
+            self.shards[hash(path) % len(self.shards)].append(key)
+            self.condition.notify_all()
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._deliver, self.shards[0])
+
+    def _deliver(self, shard):
+        """Invoke the callback that waits longest in the shard"""
+        with self.condition:
+            key = shard.popleft()
+            args, dispatched_at = self.pending.pop(key)
+            self.condition.notify_all()
+
+        try:
+            key[1](*args)
+        except Exception:
+            failed = True
+        else:
+            failed = False
+
+        latency = time.time() - dispatched_at
+        with self.condition:
+            self.delivered += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+            if failed:
+                self.errors += 1
+
+    def _work(self, shard):
+        while True:
+            with self.condition:
+                while not shard and not self.terminating:
+                    self.condition.wait()
+                if self.terminating:
+                    return
+            self._deliver(shard)
+
+    def shutdown(self):
+        """Stop the worker threads. Invocations still waiting are dropped."""
+        with self.condition:
+            self.terminating = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,127 @@
+import threading
+
+
+AGGREGATES = {
+    'min': min,
+    'max': max,
+    'avg': lambda values: sum(values) / float(len(values)),
+}
+
+
+class Reduction(object):
+    """
+    Decides which stored values of a pathpoint are worth uploading.
+
+    Give it to a pathpoint as reduction=. Every value passed to .store() goes through it before
+    it's queued for upload, so the application calling .store() does not need to change.
+
+    A value is queued if it passes all of the conditions that were given:
+        - change_only: it's different from the last queued value
+        - deadband: it differs from the last queued value by more than this
+        - relative_deadband: it differs from the last queued value by more than this fraction of it
+        - min_interval: at least this many seconds passed since the last queued value
+
+    The first value is always queued. So is a value stored at least heartbeat seconds after
+    the last queued one, even if it doesn't pass the conditions. Note that no value is made up:
+    the heartbeat is only checked when a value is stored.
+
+    If aggregate is given, values are first collected into buckets that are bucket seconds long.
+    Once a value that falls into the next bucket is stored, the bucket is closed and its
+    minimum, maximum or average (as aggregate is 'min', 'max' or 'avg') is treated as if it was
+    stored, with the timestamp of the start of the bucket. A bucket is also closed once its end
+    has passed, when the Longshot thread next checks whether an upload is due, so that the last
+    bucket before the values stop coming is not held back. A value stored for a bucket that was
+    closed this way starts it anew.
+    """
+
+    def __init__(self, change_only=False, deadband=None, relative_deadband=None, min_interval=None,
+                 heartbeat=None, aggregate=None, bucket=None):
+        if aggregate is not None:
+            if aggregate not in AGGREGATES:
+                raise ValueError('unknown aggregate %s' % (aggregate, ))
+            if not bucket:
+                raise ValueError('bucket is required to aggregate')
+
+        self.change_only = change_only
+        self.deadband = deadband
+        self.relative_deadband = relative_deadband
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+        self.aggregate = AGGREGATES.get(aggregate)
+        self.bucket = bucket
+
+        self.lock = threading.Lock()
+        self.last_timestamp = None      # of last queued value
+        self.last_value = None
+        self.bucket_no = None           # number of currently open bucket
+        self.bucket_values = []
+
+    def _passes(self, timestamp, value):
+        if self.last_timestamp is None:
+            return True
+
+        if self.heartbeat is not None and timestamp - self.last_timestamp >= self.heartbeat:
+            return True
+
+        if self.min_interval is not None and timestamp - self.last_timestamp < self.min_interval:
+            return False
+
+        if self.change_only and value == self.last_value:
+            return False
+
+        if self.deadband is not None and abs(value - self.last_value) <= self.deadband:
+            return False
+
+        if self.relative_deadband is not None and \
+           abs(value - self.last_value) <= self.relative_deadband * abs(self.last_value):
+            return False
+
+        return True
+
+    def __call__(self, timestamp, value):
+        """
+        A value was stored
+        :return: list of (timestamp, value) to queue for upload
+        """
+        with self.lock:
+            if self.aggregate is None:
+                candidates = [(timestamp, value)]
+            else:
+                candidates = []
+                bucket_no = int(timestamp // self.bucket)
+                if bucket_no != self.bucket_no:
+                    if self.bucket_values:
+                        candidates.append((self.bucket_no * self.bucket, self.aggregate(self.bucket_values)))
+                    self.bucket_no = bucket_no
+                    self.bucket_values = []
+                self.bucket_values.append(value)
+
+            return self._queued(candidates)
+
+    @property
+    def closes_at(self):
+        """Timestamp of end of the open bucket, or None if there's none"""
+        bucket_no = self.bucket_no
+        return None if bucket_no is None else (bucket_no + 1) * self.bucket
+
+    def flush(self, now):
+        """
+        Close the open bucket, if it ended by now
+        :return: list of (timestamp, value) to queue for upload
+        """
+        with self.lock:
+            if self.bucket_no is None or now < (self.bucket_no + 1) * self.bucket:
+                return []
+            candidates = [(self.bucket_no * self.bucket, self.aggregate(self.bucket_values))]
+            self.bucket_no = None
+            self.bucket_values = []
+            return self._queued(candidates)
+
+    def _queued(self, candidates):
+        """Call with lock held. :return: candidates that pass the conditions"""
+        queued = []
+        for timestamp, value in candidates:
+            if self._passes(timestamp, value):
+                self.last_timestamp, self.last_value = timestamp, value
+                queued.append((timestamp, value))
+        return queued
@@ -0,0 +1,257 @@
+import time
+import threading
+from .transport import Transport
+
+
+class DeviceGroup(object):
+    """
+    Coordinates many Devices hosted by a single gateway, so that orders and values of
+    all of them are exchanged in a single request per cycle instead of one request per device.
+
+    Devices join a group by being constructed with group=. Instead of starting threads of their own,
+    they are served by a single thread of the group. All of them must use the same Longshot API.
+
+    Batched calls go to /v1/batch/get_orders/, /v1/batch/confirm_orders/ and /v1/batch/sync_values/.
+    Each of them takes {'devices': [payload, ...]}, where payload is what the device would send
+    to the non-batched endpoint, and answers {'results': [answer, ...]} in the same order, with None
+    in place of answers for devices whose calls failed. A device whose call failed is retried
+    on its own schedule, just like a standalone device would be. redefine_paths is not batched.
+
+    Batched calls are always JSON, whatever encoding of sync_values the devices negotiated.
+    An encoding such as LSC1 covers a whole request body, and has no way to carry payloads of many
+    devices in a single one.
+
+    If the Longshot API does not support batches, use a BatchFanOut as the transport.
+    """
+
+    def __init__(self, longshot_path='http://longshot.smok-serwis.pl/', transport=None):
+        """
+        :param longshot_path: Longshot API URL
+        :param transport: Transport to use. It will be shared by all devices of this group.
+        """
+        self.api_root = longshot_path
+        self.transport = transport or Transport()
+        self.devices = []
+        self.lock = threading.Lock()            # guards self.devices
+        self.condition = threading.Condition()
+        self.terminating = False
+        self.thread = None
+
+    def attach(self, device):
+        """Called by a device upon .done(). Starts serving it."""
+        with self.lock:
+            self.devices.append(device)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wake()
+
+    def detach(self, device):
+        """Called by a device upon .shutdown(). Stops serving it."""
+        with self.lock:
+            try:
+                self.devices.remove(device)
+            except ValueError:
+                pass
+
+    def wake(self):
+        """Wake the group thread, so that it rechecks whether there's something to do"""
+        with self.condition:
+            self.condition.notify()
+
+    def shutdown(self):
+        """Stop serving all devices"""
+        self.terminating = True
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _batch(self, endpoint, devices, payloads):
+        """
+        Call a batched endpoint. A device whose call failed gets its retry postponed.
+        :return: list of (device, answer) for devices whose calls succeeded
+        """
+        started = time.time()
+        try:
+            r = self.transport.post(self.api_root, endpoint, {'devices': payloads})
+            if r.status_code != 200:
+                results = [None] * len(devices)
+            else:
+                results = list(r.json()['results'])
+        except (IOError, ValueError, KeyError, TypeError):
+            results = [None] * len(devices)
+
+        duration = time.time() - started
+        succeeded = []
+        for device, result in zip(devices, results):
+            device.metrics.observe_call(endpoint, duration, result is not None)
+            if result is None:
+                device.thread._on_cycle_failed()
+            else:
+                succeeded.append((device, result))
+        return succeeded
+
+    def _check_order_queues(self, devices, now):
+        for device in devices:
+            device.thread.next_order_check = now + device.order_interval
+
+        answers = self._batch('/v1/batch/get_orders/', devices,
+                              [device.thread._orders_request() for device in devices])
+        started = time.time()
+
+        reads = []
+        for device, answer in answers:
+            try:
+                orders = device.thread._on_orders(answer)
+            except IOError:
+                device.thread._on_cycle_failed()
+                continue
+            reads.append((device, answer, device.thread._start_reads(orders)))
+
+        confirms = []
+        confirming = []
+        for device, answer, jobs in reads:
+            failed_reads = device.thread._finish_reads(jobs, started + device.read_timeout)
+            confirm = device.thread._confirm_request(answer, failed_reads)
+            if confirm is not None:
+                confirms.append(confirm)
+                confirming.append(device)
+
+        if confirms:
+            self.transport.post(self.api_root, '/v1/batch/confirm_orders/', {'devices': confirms})
+            duration = time.time() - started
+            for device in confirming:
+                device.metrics.observe_orders(duration)
+
+    def _syncvalues(self, devices):
+        """
+        Upload values of devices. Their n-th chunks go in the n-th batched call, to devices
+        that still have chunks left and whose previous chunks were acknowledged. The calls are
+        JSON, even for devices that negotiated another encoding - see DeviceGroup.
+        """
+        uploads = [(device, device.thread._values_chunks(), []) for device in devices]
+
+        n = 0
+        sending = [upload for upload in uploads if upload[1]]
+        while sending:
+            answers = self._batch('/v1/batch/sync_values/', [device for device, _, _ in sending],
+                                  [chunks[n].payload for _, chunks, _ in sending])
+            succeeded = set(id(device) for device, answer in answers)
+            for device, chunks, statuses in sending:
+                statuses.append(200 if id(device) in succeeded else 0)
+
+            n += 1
+            sending = [(device, chunks, statuses) for device, chunks, statuses in sending
+                       if id(device) in succeeded and len(chunks) > n]
+
+        for device, chunks, statuses in uploads:
+            statuses.extend([None] * (len(chunks) - len(statuses)))
+            device.thread._on_chunks_sent(chunks, statuses)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.terminating:
+                    now = time.time()
+                    with self.lock:
+                        devices = list(self.devices)
+
+                    deadline = now + 60
+                    for device in devices:
+                        with device.condition:
+                            deadline = min(deadline, device.thread._next_deadline(now))
+
+                    if deadline <= now:
+                        break
+                    self.condition.wait(deadline - now)
+
+            if self.terminating:
+                return
+
+            started = time.time()
+            ready = [device for device in devices if device.thread.retry_at <= now]
+
+            for device in ready:
+                if not device.paths_synced:
+                    try:
+                        device.thread._syncpaths()
+                    except IOError:
+                        device.thread._on_cycle_failed()
+
+            ready = [device for device in ready if device.paths_synced and device.thread.retry_at <= now]
+
+            try:
+                due = [device for device in ready if now >= device.thread.next_order_check]
+                if due:
+                    self._check_order_queues(due, now)
+
+                due = [device for device in ready
+                       if device.thread._is_upload_due(now) and device.thread._needs_upload()]
+                if due:
+                    self._syncvalues(due)
+            except IOError:
+                for device in ready:
+                    device.thread._on_cycle_failed()
+
+            duration = time.time() - started
+            for device in ready:
+                device.persistence.sync()
+                if device.thread.retry_at <= now:
+                    device.thread._on_cycle_succeeded()
+                device.metrics.observe_cycle(duration)
+
+
+class _Answer(object):
+    """Looks like requests' Response, as far as Longshot is concerned"""
+    def __init__(self, status_code, val=None):
+        self.status_code = status_code
+        self.val = val
+
+    def json(self):
+        return self.val
+
+
+class BatchFanOut(object):
+    """
+    A local stand-in for a Longshot API with batch support.
+
+    Use it as a transport of a DeviceGroup. Batched calls are fanned out into calls to
+    the non-batched endpoints, and their answers are assembled into a batch answer.
+    Other calls are passed through.
+    """
+
+    def __init__(self, transport=None):
+        """
+        :param transport: Transport to carry out the fanned out calls with
+        """
+        self.transport = transport or Transport()
+
+    @property
+    def stats(self):
+        return self.transport.stats
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        if not endpoint.startswith('/v1/batch/'):
+            return self.transport.post(api_root, endpoint, payload, encoding)
+
+        endpoint = '/v1/' + endpoint[len('/v1/batch/'):]
+        results = []
+        for device_payload in payload['devices']:
+            try:
+                r = self.transport.post(api_root, endpoint, device_payload)
+            except IOError:     # requests' exceptions descend from IOError
+                results.append(None)
+                continue
+
+            if r.status_code != 200:
+                results.append(None)
+            elif endpoint == '/v1/get_orders/':
+                results.append(r.json())
+            else:
+                results.append({})
+
+        return _Answer(200, {'results': results})
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,94 @@
+import bisect
+import threading
+from .filters import AGGREGATES
+
+HISTORY_AGGREGATES = {
+    'min': AGGREGATES['min'],
+    'max': AGGREGATES['max'],
+    'mean': AGGREGATES['avg'],
+}
+
+
+class History(object):
+    """
+    Recent values of a single pathpoint, kept in order of their timestamps.
+
+    Values older than retention seconds (counting from the newest one), and the oldest ones in
+    excess of max_samples, are forgotten. A value that arrives out of order is inserted where it
+    belongs. Looking up a range of timestamps takes O(log n).
+
+    Devices keep one for every pathpoint if given history_retention=, see Device.history().
+    """
+    __slots__ = ('retention', 'max_samples', 'lock', 'timestamps', 'values', 'start')
+
+    def __init__(self, retention, max_samples=None):
+        """
+        :param retention: seconds to keep values for
+        :param max_samples: maximum amount of values to keep, or None for no limit
+        """
+        self.retention = retention
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.timestamps = []
+        self.values = []
+        self.start = 0          # index of the oldest value not yet forgotten
+
+    def add(self, timestamp, value):
+        with self.lock:
+            timestamps = self.timestamps
+            if len(timestamps) == self.start or timestamp >= timestamps[-1]:
+                timestamps.append(timestamp)
+                self.values.append(value)
+            else:
+                i = bisect.bisect_right(timestamps, timestamp, self.start)
+                if i == self.start and timestamp < timestamps[-1] - self.retention:
+                    return      # too old to keep
+                timestamps.insert(i, timestamp)
+                self.values.insert(i, value)
+
+            self._forget()
+
+    def _forget(self):
+        """Forget values that are too old. Call with lock held."""
+        timestamps = self.timestamps
+        start = bisect.bisect_left(timestamps, timestamps[-1] - self.retention, self.start)
+        if self.max_samples is not None:
+            start = max(start, len(timestamps) - self.max_samples)
+        self.start = start
+
+        # Forgotten values are removed only once they are half of the lists, so that
+        # it's amortized O(1) per value
+        if start > 64 and start * 2 > len(timestamps):
+            del timestamps[:start]
+            del self.values[:start]
+            self.start = 0
+
+    def query(self, t0=None, t1=None, aggregate=None):
+        """
+        :param t0: timestamp to start with, or None to start with the oldest value
+        :param t1: timestamp to end with (inclusive), or None to end with the newest value
+        :param aggregate: None, or one of 'min', 'max' or 'mean'
+        :return: list of (timestamp, value) if aggregate is None, else the aggregate of values,
+            or None if there are none
+        """
+        if aggregate is not None and aggregate not in HISTORY_AGGREGATES:
+            raise ValueError('unknown aggregate %s' % (aggregate, ))
+
+        with self.lock:
+            lo = self.start
+            if t0 is not None:
+                lo = bisect.bisect_left(self.timestamps, t0, lo)
+            hi = len(self.timestamps)
+            if t1 is not None:
+                hi = bisect.bisect_right(self.timestamps, t1, lo)
+
+            if aggregate is None:
+                return list(zip(self.timestamps[lo:hi], self.values[lo:hi]))
+            values = self.values[lo:hi]
+
+        if not values:
+            return None
+        return HISTORY_AGGREGATES[aggregate](values)
+
+    def __len__(self):
+        return len(self.timestamps) - self.start
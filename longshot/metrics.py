@@ -0,0 +1,244 @@
+"""
+Instrumentation of devices.
+
+Every Device has a Metrics object as .metrics. It's updated by the Longshot thread as it goes,
+at the cost of a lock and a few additions per API call, so it can be left on in production.
+Gauges, such as the amount of samples awaiting upload, are computed only when asked for.
+
+Hooks are called with every observation, as hook(name, value, labels), where labels is a dict.
+Names are:
+    - 'api_call': seconds an API call took, labels are endpoint and ok (a bool)
+    - 'cycle': seconds a cycle of the Longshot thread took
+    - 'orders': seconds it took to handle orders, from answer of get_orders until they were
+      confirmed
+    - 'upload': amount of samples acknowledged by the server in an upload, labels are chunks
+      (amount of chunks sent) and ok (whether all of them were acknowledged)
+Hooks are called from the Longshot thread, so they should be quick. Exceptions they raise are
+counted in hook_errors and otherwise ignored.
+
+prometheus_text() renders metrics of any number of devices in Prometheus text exposition format.
+"""
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """Counts of observations falling into buckets, as Prometheus has them"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """:param buckets: upper bounds of buckets, in ascending order"""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # last one is for observations above all bounds
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Call with lock of the owning Metrics held"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """:return: list of (upper bound, amount of observations not above it), ending with +Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """
+    Metrics of a single device
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.lock = threading.Lock()
+        self.hooks = []
+
+        self.api_latency = {}               #: endpoint => Histogram of durations of calls
+        self.api_failures = {}              #: endpoint => amount of calls that failed
+        self.cycle_duration = Histogram()   #: durations of cycles of the Longshot thread
+        self.order_handling = Histogram()   #: durations of handling of orders
+        self.samples_uploaded = 0           #: amount of samples acknowledged by the server
+        self.chunks_sent = 0                #: amount of sync_values calls made
+        self.uploads_failed = 0             #: amount of uploads that were not fully acknowledged
+        self.callback_errors = 0            #: amount of pathpoint callbacks that raised
+        self.hook_errors = 0                #: amount of hook calls that raised
+
+    def add_hook(self, hook):
+        """
+        Call hook(name, value, labels) with every observation
+        :return: hook
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def _notify(self, name, value, labels):
+        for hook in self.hooks:
+            try:
+                hook(name, value, labels)
+            except Exception:
+                with self.lock:
+                    self.hook_errors += 1
+
+    def observe_call(self, endpoint, duration, ok):
+        with self.lock:
+            try:
+                histogram = self.api_latency[endpoint]
+            except KeyError:
+                histogram = self.api_latency[endpoint] = Histogram()
+                self.api_failures[endpoint] = 0
+            histogram.observe(duration)
+            if not ok:
+                self.api_failures[endpoint] += 1
+        if self.hooks:
+            self._notify('api_call', duration, {'endpoint': endpoint, 'ok': ok})
+
+    def observe_cycle(self, duration):
+        with self.lock:
+            self.cycle_duration.observe(duration)
+        if self.hooks:
+            self._notify('cycle', duration, {})
+
+    def observe_orders(self, duration):
+        with self.lock:
+            self.order_handling.observe(duration)
+        if self.hooks:
+            self._notify('orders', duration, {})
+
+    def observe_upload(self, samples, chunks, ok):
+        with self.lock:
+            self.samples_uploaded += samples
+            self.chunks_sent += chunks
+            if not ok:
+                self.uploads_failed += 1
+        if self.hooks:
+            self._notify('upload', samples, {'chunks': chunks, 'ok': ok})
+
+    def observe_callback_error(self):
+        with self.lock:
+            self.callback_errors += 1
+
+    # Gauges
+
+    @property
+    def samples_buffered(self):
+        """Amount of samples that await upload"""
+        return sum(len(pathpoint.stored_values)
+                   for pathpoint in list(self.device.pathpoints.values()))
+
+    @property
+    def lag(self):
+        """
+        Seconds since the timestamp of the oldest sample that awaits upload, or 0 if there's none.
+        It keeps growing while uploads fail.
+        """
+        oldest = [pathpoint.stored_values.oldest()
+                  for pathpoint in list(self.device.pathpoints.values())]
+        oldest = [timestamp for timestamp in oldest if timestamp is not None]
+        if not oldest:
+            return 0.0
+        return max(0.0, time.time() - min(oldest) / 1000.0)
+
+    @property
+    def bytes_sent(self):
+        """
+        endpoint => amount of request body bytes sent. These come from the device's transport,
+        so they cover all devices that share it.
+        """
+        stats = getattr(self.device.transport, 'stats', None)
+        if not isinstance(stats, dict):
+            return {}
+        return dict((endpoint, s.bytes_sent) for endpoint, s in list(stats.items()))
+
+    def prometheus(self):
+        """:return: metrics of this device in Prometheus text exposition format"""
+        return prometheus_text([self])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return '{%s}' % (','.join('%s="%s"' % (name, _escape(value)) for name, value in labels), )
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def prometheus_text(metrics):
+    """
+    Render metrics of devices in Prometheus text exposition format
+    :param metrics: iterable of Metrics
+    :return: text
+    """
+    families = {}       # name => (type, help, list of lines)
+    order = []
+
+    def add(name, kind, help, labels, value):
+        if name not in families:
+            families[name] = kind, help, []
+            order.append(name)
+        families[name][2].append('%s%s %s' % (name, _labels(labels), _value(value)))
+
+    def add_histogram(name, help, labels, histogram):
+        if name not in families:
+            families[name] = 'histogram', help, []
+            order.append(name)
+        lines = families[name][2]
+        for bound, count in histogram.cumulative():
+            lines.append('%s_bucket%s %s' % (name, _labels(labels + [('le', _value(bound))]),
+                                             _value(count)))
+        lines.append('%s_sum%s %s' % (name, _labels(labels), _value(histogram.sum)))
+        lines.append('%s_count%s %s' % (name, _labels(labels), _value(histogram.count)))
+
+    for m in metrics:
+        device = [('device', m.device.device_id)]
+        add('longshot_samples_buffered', 'gauge', 'Samples awaiting upload', device,
+            m.samples_buffered)
+        add('longshot_upload_lag_seconds', 'gauge',
+            'Age of the oldest value awaiting upload', device, m.lag)
+
+        with m.lock:
+            add('longshot_samples_uploaded_total', 'counter', 'Samples acknowledged by the server',
+                device, m.samples_uploaded)
+            add('longshot_chunks_sent_total', 'counter', 'sync_values calls made',
+                device, m.chunks_sent)
+            add('longshot_uploads_failed_total', 'counter', 'Uploads not fully acknowledged',
+                device, m.uploads_failed)
+            add('longshot_callback_errors_total', 'counter', 'Pathpoint callbacks that raised',
+                device, m.callback_errors)
+            add('longshot_hook_errors_total', 'counter', 'Metrics hook calls that raised',
+                device, m.hook_errors)
+            for endpoint, histogram in sorted(m.api_latency.items()):
+                labels = device + [('endpoint', endpoint)]
+                add_histogram('longshot_api_call_seconds', 'Durations of API calls', labels,
+                              histogram)
+                add('longshot_api_failures_total', 'counter', 'API calls that failed', labels,
+                    m.api_failures[endpoint])
+            add_histogram('longshot_cycle_seconds', 'Durations of cycles of the Longshot thread',
+                          device, m.cycle_duration)
+            add_histogram('longshot_order_handling_seconds', 'Durations of handling of orders',
+                          device, m.order_handling)
+
+        for endpoint, sent in sorted(m.bytes_sent.items()):
+            add('longshot_transport_bytes_sent_total', 'counter',
+                'Request body bytes sent by the transport', device + [('endpoint', endpoint)], sent)
+
+    text = []
+    for name in order:
+        kind, help, lines = families[name]
+        text.append('# HELP %s %s' % (name, help))
+        text.append('# TYPE %s %s' % (name, kind))
+        text.extend(lines)
+    return '\n'.join(text) + '\n'
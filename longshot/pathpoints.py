@@ -1,36 +1,68 @@
 import time
+import threading
+from .buffers import ListBuffer, to_server_time
+from .history import History
+from .priority import NORMAL, PRIORITIES
+
+_LOOKUP = object()      # look the current value up in device's persistence layer
+
 
 class BasePathpoint(object):
     """
     A pathpoint you can register for a LongshotDevice.
     All registered pathpoints must descend from this.
+
+    State is kept in __slots__, so that hundreds of thousands of pathpoints don't each carry
+    a __dict__. Subclasses that don't declare __slots__ of their own get one, as usual.
     """
+    __slots__ = ('device', 'path', 'prefixed_path', 'lock', 'value', 'timestamp',
+                 'stored_values', 'listeners', 'reduction', 'needs_sync', 'declared', 'synced',
+                 'history', 'priority')
 
     def __init__(self, path, device, default_value=None,
-                             default_timestamp=None):
+                             default_timestamp=None,
+                             buffer=None,
+                             reduction=None,
+                             persisted=_LOOKUP,
+                             priority=NORMAL):
         """
         Create a pathpoint.
         :param path: Name of the path, BEFORE applying prefix
         :param device: Longshot Device
         :param default_timestamp: timestamp in seconds, or 'now' for current
+        :param buffer: buffer to keep values awaiting upload in, eg. an ArrayBuffer for numeric
+            pathpoints. If None, an unbounded ListBuffer will be used.
+        :param reduction: a Reduction that decides which stored values are queued for upload.
+            If None, all of them are.
+        :param persisted: tuple of (timestamp, value) from device's persistence layer, or None
+            if it has none. Looked up if not given. Device.register_many() looks values of all
+            its pathpoints up at once, and passes them here.
+        :param priority: one of CRITICAL, NORMAL or BULK from longshot.priority
         """
+        if priority not in PRIORITIES:
+            raise ValueError('unknown priority %s' % (priority, ))
+
         self.device = device
         self.path = path
         self.prefixed_path = path[0] + device.prefix + path[1:]
+        self.lock = threading.Lock()        # guards value and timestamp, so they change together
 
         if default_timestamp == 'now':
             default_timestamp = time.time()
 
         # Try to ascertain current value and timestamp. It's our defaults against device's Persistence
 
+        if persisted is _LOOKUP:
+            persisted = self.device.persistence.get_current_value(self.prefixed_path)
+
         try:
-            timestamp, value = self.device.persistence.get_current_value(path)
+            timestamp, value = persisted
         except TypeError:   # None can't be unpacked. Use provided defaults
             # We MUST use out defaults
             self.value = default_value
             self.timestamp = default_timestamp
         else:
-            if timestamp > default_timestamp:   # PL provided value won
+            if default_timestamp is None or timestamp > default_timestamp:   # PL provided value won
                 self.value = value
                 self.timestamp = timestamp
             else:   # default values won
@@ -38,9 +70,20 @@ class BasePathpoint(object):
                 self.timestamp = default_timestamp
 
 
-        self.stored_values = []     # awaiting to send to server
+        self.stored_values = buffer if buffer is not None else ListBuffer()     # awaiting to send to server
+        self.listeners = []         # callable(timestamp, value) to invoke when server writes
+        self.reduction = reduction
+        self.priority = priority
         self.needs_sync = False     # do we need synchronizing with the server?
         self.declared = False       # is it registered on the server?
+        self.synced = False         # has the server acknowledged any of its values?
+
+        # recent values, if the device keeps them
+        self.history = None
+        if device.history_retention is not None:
+            self.history = History(device.history_retention, device.history_max_samples)
+            if self.timestamp is not None:
+                self.history.add(self.timestamp, self.value)
 
     def on_write_arrived(self, timestamp, value):
         """
@@ -51,24 +94,84 @@ class BasePathpoint(object):
         :param timestamp: Server demands to write this timestamp
         :param value: Server demands to write this value
         """
-        self.value = value
-        self.timestamp = timestamp
+        with self.lock:
+            self.value = value
+            self.timestamp = timestamp
+
+        if self.history is not None:
+            self.history.add(timestamp, value)
+
+        for listener in self.listeners:
+            self.device.deliver(self, listener, (timestamp, value))
+
+    def listen(self, callable):
+        """
+        Register callable(timestamp, value) to be invoked when the server writes this pathpoint.
+
+        It will be invoked by device's dispatcher, if it has one, or by the Longshot thread.
+        :return: self
+        """
+        self.listeners.append(callable)
+        return self
+
+    def current(self):
+        """
+        :return: tuple of (timestamp, value), consistent with each other
+        """
+        with self.lock:
+            return self.timestamp, self.value
 
     def store(self, value, timestamp=None):
         """
         Request to send a value to server.
+
+        Can be called from any thread. See longshot.buffers on how this is kept thread-safe.
+
         :param value: value to send
         :param timestamp: optional timestamp to use. If None specified, current will be used
         """
-        self.stored_values.append((timestamp or time.time(), value))
-        self.device.persistence.set_current_value(self.prefixed_path, value, timestamp or time.time())
-        self.needs_sync = True
+        timestamp = timestamp or time.time()
+
+        if self.history is not None:
+            self.history.add(timestamp, value)
+
+        if self.reduction is None:
+            self._queue(timestamp, value)
+        else:
+            for ts, v in self.reduction(timestamp, value):
+                self._queue(ts, v)
+            if self.reduction.aggregate is not None and \
+               self.prefixed_path not in self.device.aggregating:
+                with self.device.condition:
+                    self.device.aggregating.add(self.prefixed_path)
+                self.device.wake()
+
+        self.device.persistence.set_current_value(self.prefixed_path, value, timestamp)
+
+    def _close_bucket(self, now):
+        """Queue the aggregate of the reduction's open bucket, if it ended by now"""
+        for ts, v in self.reduction.flush(now):
+            self._queue(ts, v)
+
+    def _queue(self, timestamp, value):
+        """Queue a value for upload"""
+        self.stored_values.append((to_server_time(timestamp), value))
+        if self.needs_sync:
+            # Path is still dirty, so the sample will be peeked at - just hold the batch open
+            self.device.last_stored = time.time()
+        else:
+            self.device.notify_stored(self.prefixed_path, self.priority)
+        # Logged once the path is dirty, so that a checkpoint that covers it precedes the peek
+        self.device.persistence.log_sample(self.prefixed_path, timestamp, value)
 
     def obtain_value(self):
         """
         Server required us to read the value.
 
-        Longshot will call this, so this should not block
+        Longshot will call this, so this should not block, unless the device was given a read pool.
+
+        Pathpoints of an AsyncDevice can define a coroutine method obtain_value_async() instead,
+        which will be awaited on the event loop.
 
         :return: current value of this sensor, or None if nothing could be obtained
         """
@@ -91,23 +194,41 @@ class BasePathpoint(object):
         self.device.unregister(self.prefixed_path)
 
 
+class CallbackPathpoint(BasePathpoint):
+    """
+    A pathpoint that calls functions it was given, instead of overriding methods.
+
+    :param on_write_arrived: callable(timestamp, value) to invoke when the server writes
+    :param on_read_requested: callable() that returns the value when the server orders a read,
+        or 'self' to return the current value
+    """
+    __slots__ = ('on_write', 'on_read')
+
+    def __init__(self, path, device, on_write_arrived=None, on_read_requested=None, **kwargs):
+        BasePathpoint.__init__(self, path, device, **kwargs)
+        self.on_write = on_write_arrived
+        self.on_read = on_read_requested
+
+    def on_write_arrived(self, timestamp, value):
+        BasePathpoint.on_write_arrived(self, timestamp, value)
+        if self.on_write is not None:
+            self.device.deliver(self, self.on_write, (timestamp, value))
+
+    def obtain_value(self):
+        if self.on_read == 'self':
+            return self.value
+        elif self.on_read is not None:
+            return self.on_read()
+
+
 def pathpoint_from_functions(path, device,
-                                on_write_arrived=lambda timestamp, value: None,
-                                on_read_requested=lambda: None,
+                                on_write_arrived=None,
+                                on_read_requested=None,
                                 default_value=None,
-                                default_timestamp=None):
-    class FuncPathpoint(BasePathpoint):
-        def __init__(self, dt):
-            BasePathpoint.__init__(self, path, device, default_value, dt)
-
-        def on_write_arrived(self, timestamp, value):
-            BasePathpoint.on_write_arrived(self, timestamp, value)
-            on_write_arrived(timestamp, value)
-
-        def obtain_value(self):
-            if on_read_requested == 'self':
-                return self.value
-            else:
-                return on_read_requested()
-
-    return FuncPathpoint(default_timestamp if default_timestamp != 'now' else time.time())
+                                default_timestamp=None,
+                                buffer=None,
+                                reduction=None,
+                                priority=NORMAL):
+    return CallbackPathpoint(path, device, on_write_arrived, on_read_requested,
+                             default_value=default_value, default_timestamp=default_timestamp,
+                             buffer=buffer, reduction=reduction, priority=priority)
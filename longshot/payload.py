@@ -0,0 +1,97 @@
+"""
+Building uploads of values out of buffers of pathpoints.
+
+Buffers keep samples the way the server wants them - integer ms timestamps, in order - so
+building an upload is a single pass over what they hold: samples are split into chunks, and
+every chunk refers to slices of the buffers' sequences as Samples, which codecs encode directly.
+Nothing is sorted, converted or copied into pairs of (timestamp, value).
+
+Samples stay in buffers until the chunk carrying them is acknowledged, see
+_LongshotProtocol._on_chunks_sent().
+"""
+import json
+from .wire import Samples
+
+SAMPLE_SIZE = 32        # bytes that JSON of a sample takes, not counting its value if it's not a number
+
+
+class Chunk(object):
+    """A part of an upload, that is sent in a single sync_values call"""
+
+    def __init__(self, device):
+        self.payload = {'device_id': device.device_id,
+                        'secret': device.secret,
+                        'values': {}}
+        self.marks = []         # list of (pathpoint, sequence number to trim its buffer up to)
+        self.samples = 0
+        self.size = 0           # estimated size of JSON of payload, in bytes
+
+    def add(self, pathpoint, samples, upto, sample_size):
+        path = pathpoint.prefixed_path
+        self.payload['values'][path] = samples
+        self.marks.append((pathpoint, upto))
+        self.samples += len(samples)
+        self.size += len(path) + len(samples) * sample_size
+
+
+class PayloadBuilder(object):
+    """
+    Splits samples awaiting upload into chunks of at most device.chunk_samples samples and
+    about device.chunk_bytes bytes.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.chunks = [Chunk(device)]
+
+    def add(self, pathpoint, max_bytes=None):
+        """
+        Add samples that the pathpoint's buffer holds, oldest first
+        :param max_bytes: approximate maximum amount of bytes to add, or None to add all of them
+        :return: tuple of (approximate amount of bytes added, whether all samples were added)
+        """
+        device = self.device
+        limit = None if max_bytes is None else max_bytes // SAMPLE_SIZE
+        if limit == 0:
+            return 0, not pathpoint.stored_values
+
+        head, timestamps, values = pathpoint.stored_values.peek(limit)
+        count = len(timestamps)
+        if not count:
+            return 0, True
+
+        sample_size = SAMPLE_SIZE
+        if not isinstance(values[0], (int, float)):
+            sample_size += len(json.dumps(values[0]))
+
+        if max_bytes is not None and count * sample_size > max_bytes:
+            count = max(1, max_bytes // sample_size)
+            complete = False
+        else:
+            complete = limit is None or len(pathpoint.stored_values) <= count
+
+        path_size = len(pathpoint.prefixed_path)
+        start = 0
+        while start < count:
+            chunk = self.chunks[-1]
+            room = min(device.chunk_samples - chunk.samples,
+                       (device.chunk_bytes - chunk.size - path_size) // sample_size)
+            if room <= 0:
+                if chunk.samples:
+                    self.chunks.append(Chunk(device))
+                    continue
+                room = 1        # a single sample that is bigger than a chunk
+
+            end = min(start + room, count)
+            if start == 0 and end == len(timestamps):
+                samples = Samples(timestamps, values)
+            else:
+                samples = Samples(timestamps[start:end], values[start:end])
+            chunk.add(pathpoint, samples, head + end, sample_size)
+            start = end
+
+        return count * sample_size, complete
+
+    def build(self):
+        """:return: list of Chunk that have any samples"""
+        return [chunk for chunk in self.chunks if chunk.samples]
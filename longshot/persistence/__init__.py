@@ -6,7 +6,7 @@ class NoPersistenceLayer(object):
     This is a base persistence layer for storing data. It stores current value of a sensor,
     and its historic value (in case net is broken and we need to restore later
 
-    Paths are to be stored WITHOUT prefix
+    Paths are stored with prefix, same as the pathpoints are registered in a Device
     """
     def __init__(self):
         pass
@@ -18,6 +18,20 @@ class NoPersistenceLayer(object):
         """
         return None
 
+    def get_current_values(self, paths):
+        """
+        Obtain current values of many sensors at once. Override if it can be done faster than
+        one by one.
+        :param paths: iterable of paths
+        :return: dict of path => (timestamp, value), for paths that have values
+        """
+        values = {}
+        for path in paths:
+            value = self.get_current_value(path)
+            if value is not None:
+                values[path] = value
+        return values
+
     def set_current_value(self, path, value, timestamp=None):
         """
         Set the value of a sensor.
@@ -39,8 +53,39 @@ class NoPersistenceLayer(object):
         """
         pass
 
+    def log_sample(self, path, timestamp, value):
+        """
+        A sample was queued for upload to the server.
+        :param path: path of the sensor, with prefix
+        :param timestamp: timestamp of the sample
+        :param value: value of the sample
+        """
+        pass
+
+    def checkpoint(self):
+        """
+        Samples logged so far are about to be uploaded. Can be called from more than one thread.
+        :return: a mark, to pass to .acknowledge() once the server confirmed the upload. Marks
+            of later checkpoints compare greater.
+        """
+        return None
+
+    def acknowledge(self, mark):
+        """
+        Server confirmed the upload of samples logged before .checkpoint() returned mark,
+        so they can be forgotten.
+        """
+        pass
+
+    def recover_samples(self):
+        """
+        Obtain samples that were logged, but not acknowledged, before the process restarted.
+        :return: dict of path => list of (timestamp, value)
+        """
+        return {}
+
 
-class ShelfPersistenceLayer(object):
+class ShelfPersistenceLayer(NoPersistenceLayer):
     def __init__(self, filename):
         self.shelf = shelve.open(str(filename), protocol=-1)
 
@@ -78,3 +123,7 @@ class ShelfPersistenceLayer(object):
             del self.shelf[path]
         except KeyError:
             pass
+
+
+from .wal import WALPersistenceLayer
+from .sqlite import SQLitePersistenceLayer
@@ -0,0 +1,92 @@
+import sqlite3
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import NoPersistenceLayer
+
+
+class SQLitePersistenceLayer(NoPersistenceLayer):
+    """
+    A persistence layer that keeps current values of sensors in memory, and writes them
+    to an SQLite database in WAL mode.
+
+    set_current_value only updates memory and marks the path as dirty, so repeated writes
+    to the same path are coalesced. Marking takes a lock that all paths share, for every
+    store. Dirty paths are written to the database in a single transaction by sync(), which
+    the Longshot thread calls every cycle. All values are loaded with a single query upon
+    construction, so lookups during pathpoint creation never touch the disk.
+
+    Values have to be picklable.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(str(filename), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS current_values '
+                        '(path TEXT PRIMARY KEY, timestamp REAL, value BLOB)')
+        self.db.commit()
+
+        self.values = {}            # path => (timestamp, value)
+        for path, timestamp, value in self.db.execute('SELECT path, timestamp, value '
+                                                      'FROM current_values'):
+            self.values[path] = timestamp, pickle.loads(bytes(value))
+
+        self.lock = threading.Lock()        # guards dirty and deleted
+        self.dirty = set()                  # paths to write
+        self.deleted = set()                # paths to delete
+
+    def get_current_value(self, path):
+        """
+        Obtain current value of a sensor
+        :param path: path of the value
+        :return: timestamp, value
+        """
+        return self.values.get(path)
+
+    def get_current_values(self, paths):
+        values = self.values
+        return dict((path, values[path]) for path in paths if path in values)
+
+    def set_current_value(self, path, value, timestamp=None):
+        self.values[path] = timestamp or time.time(), value
+        with self.lock:
+            self.dirty.add(path)
+            self.deleted.discard(path)
+
+    def del_current_value(self, path):
+        self.values.pop(path, None)
+        with self.lock:
+            self.dirty.discard(path)
+            self.deleted.add(path)
+
+    def sync(self):
+        """Write dirty values to disk"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            deleted, self.deleted = self.deleted, set()
+
+        if not (dirty or deleted):
+            return
+
+        rows = []
+        for path in dirty:
+            try:
+                timestamp, value = self.values[path]
+            except KeyError:    # deleted in the meantime
+                continue
+            rows.append((path, timestamp, sqlite3.Binary(pickle.dumps(value, -1))))
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO current_values (path, timestamp, value) '
+                                'VALUES (?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM current_values WHERE path=?',
+                                [(path, ) for path in deleted])
+
+    def close(self):
+        """Write dirty values and close the database"""
+        self.sync()
+        self.db.close()
@@ -0,0 +1,164 @@
+import errno
+import os
+import struct
+import threading
+import time
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import NoPersistenceLayer
+
+_HEADER = struct.Struct('!II')      # length of record, crc32 of record
+
+
+class WALPersistenceLayer(NoPersistenceLayer):
+    """
+    A persistence layer that keeps samples awaiting upload in an append-only write-ahead log,
+    so that they survive a restart of the process.
+
+    The log is a directory of segment files. Logged samples are collected in memory and written
+    to the current segment in a single record, followed by a single fsync, either during sync()
+    or once fsync_interval seconds or batch_size samples have been collected. A crash can
+    therefore lose at most that many of the most recent samples.
+
+    Segments whose samples were acknowledged by the server are deleted. On startup, samples from
+    the remaining segments are given back to the pathpoints by Device.done().
+
+    Current values of sensors are kept by another persistence layer, given as current_values.
+
+    Every sample is logged under a lock that all pathpoints share, and the sample that fills
+    a batch is written and fsynced by the thread that stored it.
+    """
+
+    def __init__(self, directory, current_values=None, segment_size=16*1024*1024,
+                 fsync_interval=1.0, batch_size=10000):
+        """
+        :param directory: directory to keep the segments in. Will be created if it does not exist.
+        :param current_values: persistence layer to keep current values of sensors in.
+            Default is not to keep them.
+        :param segment_size: a new segment is started once the current one exceeds this many bytes
+        :param fsync_interval: maximum time in seconds that a logged sample can wait to reach
+            the disk
+        :param batch_size: maximum amount of samples that can wait to reach the disk
+        """
+        NoPersistenceLayer.__init__(self)
+        self.directory = directory
+        self.current_values = current_values or NoPersistenceLayer()
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.pending = []               # list of (path, timestamp, value) not yet written
+        self.last_flush = time.time()
+
+        segments = self._segments()
+        self.segment_no = segments[-1] + 1 if segments else 0
+        self.segment = None             # file object of current segment, opened when needed
+        self.segment_length = 0
+
+    def _segment_path(self, segment_no):
+        return os.path.join(self.directory, 'wal-%010d.log' % (segment_no, ))
+
+    def _segments(self):
+        """:return: sorted list of numbers of segments on disk"""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal-') and name.endswith('.log'):
+                segments.append(int(name[4:-4]))
+        return sorted(segments)
+
+    # Current values are delegated
+
+    def get_current_value(self, path):
+        return self.current_values.get_current_value(path)
+
+    def get_current_values(self, paths):
+        return self.current_values.get_current_values(paths)
+
+    def set_current_value(self, path, value, timestamp=None):
+        self.current_values.set_current_value(path, value, timestamp)
+
+    def del_current_value(self, path):
+        self.current_values.del_current_value(path)
+
+    # The log
+
+    def log_sample(self, path, timestamp, value):
+        with self.lock:
+            self.pending.append((path, timestamp, value))
+            if len(self.pending) < self.batch_size and \
+               time.time() - self.last_flush < self.fsync_interval:
+                return
+            self._flush()
+
+    def _flush(self):
+        """Write pending samples to the current segment. Call with lock held."""
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+
+        record = pickle.dumps(self.pending, -1)
+        self.pending = []
+
+        if self.segment is None:
+            self.segment = open(self._segment_path(self.segment_no), 'ab')
+
+        self.segment.write(_HEADER.pack(len(record), zlib.crc32(record) & 0xFFFFFFFF) + record)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment_length += _HEADER.size + len(record)
+
+        if self.segment_length >= self.segment_size:
+            self._roll()
+
+    def _roll(self):
+        """Start a new segment. Call with lock held."""
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        self.segment_no += 1
+        self.segment_length = 0
+
+    def checkpoint(self):
+        with self.lock:
+            self._flush()
+            mark = self.segment_no
+            self._roll()
+            return mark
+
+    def acknowledge(self, mark):
+        for segment_no in self._segments():
+            if segment_no <= mark:
+                try:
+                    os.unlink(self._segment_path(segment_no))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:     # else acknowledged by another thread
+                        raise
+
+    def recover_samples(self):
+        samples = {}
+        for segment_no in self._segments():
+            with open(self._segment_path(segment_no), 'rb') as f:
+                while True:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    length, crc = _HEADER.unpack(header)
+                    record = f.read(length)
+                    if len(record) < length or zlib.crc32(record) & 0xFFFFFFFF != crc:
+                        break       # torn write - the rest of this segment never made it to disk
+
+                    for path, timestamp, value in pickle.loads(record):
+                        samples.setdefault(path, []).append((timestamp, value))
+        return samples
+
+    def sync(self):
+        with self.lock:
+            self._flush()
+        self.current_values.sync()
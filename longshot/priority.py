@@ -0,0 +1,67 @@
+"""
+Priority classes of pathpoints, given to them as priority=.
+
+    - CRITICAL: alarms and other latency-sensitive signals. A Device uploads their samples as
+      soon as they are stored, on a lane of its own - a thread, started with the first critical
+      pathpoint, that sends them through the device's transport so they don't wait behind other
+      uploads. It waits for paths to be synchronized, and backs off as the retry policy says.
+      Devices in a group and AsyncDevices have no such lane: there, a critical sample makes an
+      upload due right away, and goes first in it.
+    - NORMAL: the default. Samples are uploaded as upload_min_delay and upload_max_latency say.
+    - BULK: telemetry that can wait. Samples go after the normal ones, and no faster than
+      bulk_bandwidth of the device allows.
+
+Orders are not held up by uploads either: an upload that is still sending chunks when the next
+order check is due sends no more of them. Orders are handled, and the rest follows.
+"""
+import threading
+import time
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+BULK = 'bulk'
+PRIORITIES = (CRITICAL, NORMAL, BULK)       #: most urgent first
+
+
+class TokenBucket(object):
+    """
+    Budget of bytes per second.
+
+    It refills at rate bytes per second, up to burst bytes. Spending more than there is
+    leaves it in debt, which is paid back by refilling.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: bytes per second
+        :param burst: maximum amount of bytes to accumulate. Default is rate.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def _refill(self):
+        """Call with lock held"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """:return: amount of bytes that can be spent now"""
+        with self.lock:
+            self._refill()
+            return max(0, int(self.tokens))
+
+    def take(self, amount):
+        """Spend amount of bytes"""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+    def delay(self):
+        """:return: seconds until half of burst can be spent"""
+        with self.lock:
+            self._refill()
+            return max(0.0, (self.burst / 2 - self.tokens) / self.rate)
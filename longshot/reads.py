@@ -0,0 +1,82 @@
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class _ReadJob(object):
+    """A single call to obtain_value() of a pathpoint"""
+
+    def __init__(self, pathpoint, callback):
+        self.pathpoint = pathpoint
+        self.callback = callback        # callable(pathpoint, value), invoked in worker thread
+        self.done = threading.Event()
+        self.failed = False             # did obtain_value() raise?
+
+
+class ReadPool(object):
+    """
+    A pool of threads that carry out read orders of the server, so that a slow sensor does not
+    stall the Longshot thread.
+
+    Give it to a Device as read_pool=. One ReadPool can be shared by many devices.
+    The Longshot thread waits for the reads at most read_timeout seconds, and reports reads that did
+    not complete by then to the server as failed. A read that completes later still has its value
+    stored.
+    """
+
+    def __init__(self, workers=4):
+        """
+        :param workers: amount of reads that can be in progress at once
+        """
+        self.queue = queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            try:
+                value = job.pathpoint.obtain_value()
+                job.callback(job.pathpoint, value)
+            except Exception:
+                job.failed = True
+            finally:
+                job.done.set()
+
+    def submit(self, pathpoint, callback):
+        """
+        Order a read of a pathpoint
+        :param callback: callable(pathpoint, value) to call with the value that was read
+        :return: a job, to pass to .wait()
+        """
+        job = _ReadJob(pathpoint, callback)
+        self.queue.put(job)
+        return job
+
+    @staticmethod
+    def wait(jobs, deadline):
+        """
+        Wait until jobs are done, but no longer than until deadline
+        :param deadline: UNIX timestamp
+        :return: list of jobs that did not succeed by the deadline
+        """
+        failed = []
+        for job in jobs:
+            if not job.done.wait(max(0, deadline - time.time())) or job.failed:
+                failed.append(job)
+        return failed
+
+    def shutdown(self):
+        """Stop the worker threads once they are done with reads already ordered"""
+        for thread in self.threads:
+            self.queue.put(None)
@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter.
+
+    n-th consecutive failure is followed by a delay of initial * multiplier ** (n-1), capped at
+    maximum, and then randomly shortened by up to jitter of itself, so that many devices that
+    failed at once do not all come back at once.
+    """
+
+    def __init__(self, initial=1, maximum=300, multiplier=2, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.failures = 0
+
+    def next_delay(self):
+        """A failure happened. :return: seconds to wait before retrying"""
+        delay = min(self.maximum, self.initial * self.multiplier ** self.failures)
+        self.failures += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.failures = 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a server that keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens, and no calls are made for
+    reset_timeout seconds. After that a single trial is allowed (the circuit is half-open).
+    If it succeeds the circuit closes, otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def remaining(self):
+        """:return: seconds until a call may be made"""
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+
+class RetryPolicy(object):
+    """
+    Decides what a device does when calls to Longshot API fail.
+
+    After a failed cycle the device waits for the delay given by backoff, or until the circuit
+    breaker lets it try again, whichever is longer. Values stored in the meantime accumulate in
+    pathpoint buffers. Once calls succeed again, the backlog is uploaded in chunks, as bounded
+    by Device's chunk_samples and chunk_bytes.
+
+    Give it to a device as retry_policy=. A policy can be shared by devices that talk to the
+    same server, so that they all back off and trip the breaker together.
+    """
+
+    def __init__(self, backoff=None, breaker=None):
+        """
+        :param backoff: a Backoff. Default is Backoff().
+        :param breaker: a CircuitBreaker, or None to never stop trying
+        """
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker
+        self.lock = threading.Lock()
+
+    def failed(self):
+        """
+        A cycle failed
+        :return: seconds to wait before the next try
+        """
+        with self.lock:
+            delay = self.backoff.next_delay()
+            if self.breaker is not None:
+                self.breaker.record_failure()
+                delay = max(delay, self.breaker.remaining())
+            return delay
+
+    def succeeded(self):
+        """A cycle succeeded"""
+        with self.lock:
+            self.backoff.reset()
+            if self.breaker is not None:
+                self.breaker.record_success()
@@ -0,0 +1,274 @@
+"""
+Hosting devices in a pool of worker processes.
+
+A single process is bound by the GIL, so encoding uploads of many devices competes with
+the application for one core. A Supervisor spreads devices across worker processes, and
+gives the application proxies to store values with:
+
+    supervisor = Supervisor(workers=4, longshot_path='http://longshot.smok-serwis.pl/')
+    gateway = supervisor.add_device('dev1', 'secret', ['Waccess', 'Wtemperature'])
+    temperature = gateway.get('Wtemperature').listen(on_write)
+    supervisor.start()
+
+    temperature.store(21.5)
+    ...
+    supervisor.shutdown()
+
+A device lives in the worker picked by CRC32 of its ID. Stores are sent to workers over pipes in
+batches, as often as batch_interval allows, so that pickling and the system call are paid once per
+batch and not once per value. Writes ordered by the server are sent back to the supervisor, which
+invokes listeners of the proxies on a thread of its own, one per worker. Reads ordered by the
+server are answered in the worker with the last value stored. When the supervisor shuts down,
+workers make a final upload of whatever their devices still hold.
+
+Keyword arguments of devices are passed to workers, so they have to be picklable.
+"""
+import multiprocessing
+import threading
+import time
+import zlib
+
+_STORE = 'store'
+_STOP = 'stop'
+_WRITE = 'write'
+_STOPPED = 'stopped'
+
+
+def _worker(devices, commands, events, flush_timeout):
+    """
+    Main function of a worker process
+    :param devices: list of (device_id, secret, paths, kwargs)
+    :param commands: Connection to receive commands from
+    :param events: Connection to send events to
+    :param flush_timeout: seconds to give every device for its final upload
+    """
+    from .device import Device
+
+    events_lock = threading.Lock()
+    last_stored = {}        # (device_id, path) => last value stored
+    pathpoints = {}         # (device_id, path) => pathpoint
+    hosted = []
+
+    def on_write(device_id, path):
+        def on_write_arrived(timestamp, value):
+            with events_lock:
+                events.send((_WRITE, (device_id, path, timestamp, value)))
+        return on_write_arrived
+
+    def on_read(key):
+        return lambda: last_stored.get(key)
+
+    for device_id, secret, paths, kwargs in devices:
+        device = Device(device_id, secret, **kwargs)
+        specs = [{'path': path,
+                  'on_write_arrived': on_write(device_id, path),
+                  'on_read_requested': on_read((device_id, path))} for path in paths]
+        for path, pathpoint in zip(paths, device.register_many(specs)):
+            pathpoints[device_id, path] = pathpoint
+        device.done()
+        hosted.append(device)
+
+    while True:
+        kind, body = commands.recv()
+        if kind == _STOP:
+            break
+
+        for device_id, path, value, timestamp in body:
+            key = device_id, path
+            last_stored[key] = value
+            pathpoints[key].store(value, timestamp)
+
+    for device in hosted:
+        device.flush(flush_timeout)
+    with events_lock:
+        events.send((_STOPPED, None))
+
+
+class _Shard(object):
+    """A worker process, as seen by the supervisor"""
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.devices = []           # list of (device_id, secret, paths, kwargs)
+        self.condition = threading.Condition()
+        self.pending = []           # stores to send, as (device_id, path, value, timestamp)
+        self.terminating = False
+        self.process = None
+        self.flusher = None
+        self.reader = None
+
+    def start(self):
+        commands_out, self.commands = multiprocessing.Pipe(False)
+        self.events, events_in = multiprocessing.Pipe(False)
+
+        self.process = multiprocessing.Process(target=_worker,
+                                               args=(self.devices, commands_out, events_in,
+                                                     self.supervisor.flush_timeout))
+        self.process.daemon = True
+        self.process.start()
+        commands_out.close()
+        events_in.close()
+
+        self.flusher = threading.Thread(target=self._flush)
+        self.reader = threading.Thread(target=self._read)
+        for thread in (self.flusher, self.reader):
+            thread.daemon = True
+            thread.start()
+
+    def store(self, device_id, path, value, timestamp):
+        with self.condition:
+            while len(self.pending) >= self.supervisor.max_pending and not self.terminating:
+                self.condition.wait()
+            self.pending.append((device_id, path, value, timestamp))
+            if len(self.pending) == 1:
+                self.condition.notify_all()
+
+    def _flush(self):
+        """Send pending stores to the worker, in batches"""
+        interval = self.supervisor.batch_interval
+        while True:
+            with self.condition:
+                while not self.pending and not self.terminating:
+                    self.condition.wait()
+                if self.terminating and not self.pending:
+                    break
+                batch, self.pending = self.pending, []
+                self.condition.notify_all()     # stores waiting for room
+
+            self.commands.send((_STORE, batch))
+            time.sleep(interval)                # let the next batch build up
+
+        self.commands.send((_STOP, None))
+
+    def _read(self):
+        """Deliver writes ordered by the server to listeners"""
+        while True:
+            try:
+                kind, body = self.events.recv()
+            except EOFError:        # worker died
+                return
+            if kind == _STOPPED:
+                return
+            device_id, path, timestamp, value = body
+            self.supervisor._deliver(device_id, path, timestamp, value)
+
+    def shutdown(self):
+        with self.condition:
+            self.terminating = True
+            self.condition.notify_all()
+        self.flusher.join()
+        self.reader.join()
+        self.process.join()
+
+
+class PathpointProxy(object):
+    """Stands in for a pathpoint of a device hosted in a worker process"""
+    __slots__ = ('shard', 'device_id', 'path', 'listeners')
+
+    def __init__(self, shard, device_id, path):
+        self.shard = shard
+        self.device_id = device_id
+        self.path = path
+        self.listeners = []
+
+    def store(self, value, timestamp=None):
+        """
+        Request to send a value to server. Can be called from any thread.
+        :param timestamp: optional timestamp to use. If None specified, current will be used
+        """
+        self.shard.store(self.device_id, self.path, value, timestamp or time.time())
+
+    def listen(self, callable):
+        """
+        Register callable(timestamp, value) to be invoked when the server writes this pathpoint.
+        It will be invoked by a thread of the supervisor. Exceptions it raises are counted in
+        Supervisor.listener_errors.
+        :return: self
+        """
+        self.listeners.append(callable)
+        return self
+
+
+class DeviceProxy(object):
+    """Stands in for a device hosted in a worker process"""
+
+    def __init__(self, device_id, pathpoints):
+        self.device_id = device_id
+        self.pathpoints = pathpoints        # unprefixed path => PathpointProxy
+
+    def get(self, path):
+        """Obtain a pathpoint. Path is unprefixed.
+        Raises KeyError if does not exist"""
+        return self.pathpoints[path]
+
+
+class Supervisor(object):
+    """
+    Hosts devices in a pool of worker processes. See longshot.sharding.
+    """
+
+    def __init__(self, workers=None, batch_interval=0.005, max_pending=100000, flush_timeout=10,
+                 **device_kwargs):
+        """
+        :param workers: amount of worker processes. Default is the amount of CPUs.
+        :param batch_interval: seconds to wait after sending a batch of stores to a worker,
+            so that the next one is bigger
+        :param max_pending: maximum amount of stores waiting to be sent to a single worker.
+            Storing blocks while there are as many.
+        :param flush_timeout: seconds that every device gets to upload what it holds on shutdown
+        :param device_kwargs: keyword arguments to pass to all devices, eg. longshot_path
+        """
+        self.shards = [_Shard(self) for i in range(workers or multiprocessing.cpu_count())]
+        self.batch_interval = batch_interval
+        self.max_pending = max_pending
+        self.flush_timeout = flush_timeout
+        self.device_kwargs = device_kwargs
+        self.devices = {}           # device_id => DeviceProxy
+        self.started = False
+        self.lock = threading.Lock()
+        self.listener_errors = 0    #: amount of listener invocations that raised
+
+    def _shard(self, device_id):
+        return self.shards[zlib.crc32(device_id.encode('utf8')) % len(self.shards)]
+
+    def add_device(self, device_id, secret, paths, **kwargs):
+        """
+        Define a device to host. Has to be called before .start().
+
+        :param paths: unprefixed paths of its pathpoints
+        :param kwargs: keyword arguments of Device, in addition to those given to the supervisor
+        :return: a DeviceProxy
+        """
+        if self.started:
+            raise RuntimeError('devices have to be added before start()')
+
+        device_kwargs = dict(self.device_kwargs)
+        device_kwargs.update(kwargs)
+        paths = list(paths)
+
+        shard = self._shard(device_id)
+        shard.devices.append((device_id, secret, paths, device_kwargs))
+        proxy = self.devices[device_id] = DeviceProxy(
+            device_id, dict((path, PathpointProxy(shard, device_id, path)) for path in paths))
+        return proxy
+
+    def start(self):
+        """Start worker processes. Devices are registered and started in them."""
+        self.started = True
+        for shard in self.shards:
+            if shard.devices:
+                shard.start()
+
+    def _deliver(self, device_id, path, timestamp, value):
+        for listener in self.devices[device_id].pathpoints[path].listeners:
+            try:
+                listener(timestamp, value)
+            except Exception:
+                with self.lock:
+                    self.listener_errors += 1
+
+    def shutdown(self):
+        """Send all pending stores, shut devices down and stop worker processes"""
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.shutdown()
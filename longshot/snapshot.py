@@ -0,0 +1,202 @@
+"""
+Snapshots of state of a Device, for warm restarts.
+
+    device = Device('dev1', 'secret')
+    ... register pathpoints ...
+    if os.path.exists('dev1.snapshot'):
+        device.restore('dev1.snapshot')
+    device.done()
+    ...
+    device.shutdown()
+    device.snapshot('dev1.snapshot')
+
+A snapshot holds the paths as the server knows them, which pathpoints were declared, current
+values and samples awaiting upload. Once restored, a device that has the same paths as the server
+skips redefine_paths altogether, and one whose paths changed sends just the difference with
+update_paths. Pathpoints themselves carry callbacks, so they are not restored - the application
+registers them as usual, and restore() fills them in. Paths that are in the snapshot but were not
+registered are left out.
+
+Samples awaiting upload are restored as well, so do not restore a snapshot into a device whose
+persistence layer recovers samples by itself, or they will be sent twice.
+
+Snapshot file is:
+    b'LSS1'
+    uint32 length + JSON of the header: device ID, prefix, encoding of sync_values, state of
+        synchronization of paths, paths of all n pathpoints, and their current values
+    float64 * n timestamps of current values (NaN if there's none)
+    uint8 * n flags: 1 if the pathpoint was declared, 2 if its pending values are floats
+    uint32 * n counts of pending samples
+    int64 timestamps of all pending samples, in ms
+    float64 values of all pending samples of pathpoints flagged 2
+    uint32 length + JSON list of values of all the other pending samples
+All numbers are little endian. Columns hold everything in bulk, so that taking and restoring
+a snapshot costs a few operations per pathpoint, and not a few per sample. The file is
+read in a single call when it's restored.
+"""
+import array
+import json
+import math
+import os
+import struct
+import time
+from .buffers import _MS
+from .priority import CRITICAL
+from .wire import _are_floats, _tobytes, _frombytes
+
+_MAGIC = b'LSS1'
+_DECLARED = 1
+_FLOATS = 2
+_U32 = struct.Struct('<I')
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def write_snapshot(device, filename):
+    """
+    Save state of a device. Can be called while the device runs, but the snapshot is best taken
+    after it was shut down. The file is replaced atomically.
+    """
+    with device.condition:
+        pathpoints = list(device.pathpoints.values())
+        header = {'device_id': device.device_id,
+                  'prefix': device.prefix,
+                  'encoding': device.thread.values_encoding,
+                  'full_sync': device.paths_full_sync,
+                  'server_hash': '%016x' % (device.server_paths_hash, ),
+                  'paths_added': list(device.paths_added),
+                  'paths_removed': list(device.paths_removed),
+                  'paths': [pathpoint.prefixed_path for pathpoint in pathpoints],
+                  'current': []}
+
+    current = header['current']
+    current_timestamps = array.array('d')
+    flags = array.array('B')
+    counts = array.array('I')
+    timestamps = array.array(_MS)
+    floats = array.array('d')
+    others = []
+
+    for pathpoint in pathpoints:
+        timestamp, value = pathpoint.current()
+        current.append(value)
+        current_timestamps.append(float('nan') if timestamp is None else timestamp)
+
+        head, pending_timestamps, values = pathpoint.stored_values.peek()
+        flag = _DECLARED if pathpoint.declared else 0
+        if _are_floats(values):
+            floats.extend(values)
+            flag |= _FLOATS
+        else:
+            others.extend(values)
+        timestamps.extend(pending_timestamps)
+        counts.append(len(pending_timestamps))
+        flags.append(flag)
+
+    header = json.dumps(header).encode('utf8')
+    others = json.dumps(others).encode('utf8')
+
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(_MAGIC)
+        f.write(_U32.pack(len(header)))
+        f.write(header)
+        for column in (current_timestamps, flags, counts, timestamps, floats):
+            f.write(_tobytes(column))
+        f.write(_U32.pack(len(others)))
+        f.write(others)
+    _replace(filename + '.tmp', filename)
+
+
+def restore_snapshot(device, filename):
+    """
+    Restore state of a device. Has to be called after pathpoints were registered, and before
+    .done().
+
+    :raises ValueError: file is not a snapshot of this device
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if data[:4] != _MAGIC:
+        raise ValueError('not a Longshot snapshot')
+    length, = _U32.unpack(data[4:8])
+    header = json.loads(data[8:8 + length].decode('utf8'))
+    if (header['device_id'], header['prefix']) != (device.device_id, device.prefix):
+        raise ValueError('snapshot of %s with prefix %s' % (header['device_id'],
+                                                            header['prefix']))
+
+    n = len(header['paths'])
+    offset = [8 + length]
+
+    def column(typecode, count):
+        size = array.array(typecode).itemsize * count
+        start = offset[0]
+        offset[0] += size
+        return _frombytes(typecode, data[start:start + size])
+
+    current_timestamps = column('d', n)
+    flags = column('B', n)
+    counts = column('I', n)
+    timestamps = column(_MS, sum(counts))
+    floats = column('d', sum(count for count, flag in zip(counts, flags) if flag & _FLOATS))
+    size, = _U32.unpack(data[offset[0]:offset[0] + 4])
+    others = json.loads(data[offset[0] + 4:offset[0] + 4 + size].decode('utf8'))
+
+    pathpoints = device.pathpoints
+    dirty = []
+    urgent = []
+    at = at_floats = at_others = 0
+
+    for path, value, timestamp, flag, count in zip(header['paths'], header['current'],
+                                                   current_timestamps, flags, counts):
+        if flag & _FLOATS:
+            values = floats[at_floats:at_floats + count]
+            at_floats += count
+        else:
+            values = others[at_others:at_others + count]
+            at_others += count
+        pending = timestamps[at:at + count]
+        at += count
+
+        try:
+            pathpoint = pathpoints[path]
+        except KeyError:
+            continue
+
+        if flag & _DECLARED:
+            pathpoint.declared = True
+
+        if not math.isnan(timestamp):
+            with pathpoint.lock:
+                if pathpoint.timestamp is None or pathpoint.timestamp < timestamp:
+                    pathpoint.value, pathpoint.timestamp = value, timestamp
+
+        if count:
+            pathpoint.stored_values.extend(zip(pending, values))
+            pathpoint.needs_sync = True
+            (urgent if pathpoint.priority == CRITICAL else dirty).append(path)
+
+    if header['encoding'] == 'json' or header['encoding'] in device.encodings:
+        device.thread.values_encoding = header['encoding']
+
+    with device.condition:
+        device.urgent.update(urgent)
+        if dirty:
+            device.dirty.update(dirty)
+            device.last_stored = time.time()
+            if device.pending_since is None:
+                device.pending_since = device.last_stored
+
+        if not header['full_sync']:
+            server_paths = set(header['paths'])
+            server_paths.difference_update(header['paths_added'])
+            server_paths.update(header['paths_removed'])
+            registered = set(pathpoints)
+
+            device.paths_added = registered - server_paths
+            device.paths_removed = server_paths - registered
+            device.server_paths_hash = int(header['server_hash'], 16)
+            device.paths_full_sync = False
+            device.paths_synced = not (device.paths_added or device.paths_removed)
+
+    device.wake()
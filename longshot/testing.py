@@ -0,0 +1,238 @@
+"""
+An in-process stand-in for the Longshot API, for tests and benchmarks.
+
+    server = FakeServer().start()
+    device = Device('dev1', 'secret', longshot_path=server.url)
+    ...
+    server.write('dev1', 'Wlaccess', 5)     # order a write
+    server.stop()
+"""
+import json
+import random
+import threading
+import time
+import zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from .device import path_hash
+from .wire import BY_CONTENT_TYPE
+
+
+class FakeDevice(object):
+    """What the server knows about a device"""
+
+    def __init__(self):
+        self.paths = set()
+        self.values = {}        # path => list of [timestamp in ms, value], in order of arrival
+        self.writes = {}        # path => [timestamp in ms, value] to order
+        self.reads = set()      # paths to order reads of
+        self.pot = 0            # number of last batch of orders
+        self.confirmations = []     # payloads of confirm_orders
+
+    def last_value(self, path):
+        try:
+            return self.values[path][-1]
+        except (KeyError, IndexError):
+            return None
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """
+    A Longshot API, serving on a random port of localhost.
+
+    It understands redefine_paths, update_paths, get_orders, confirm_orders and sync_values,
+    their batched variants, JSON (plain and gzipped) and LSC1 bodies.
+
+    get_orders with 'wait' in the payload is a long-poll: if there are no orders, it's held for
+    up to that many seconds until there are, and the answer has 'wait': True. Set long_poll to
+    False to make it answer right away, as a server that does not support long-polls would.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, encodings=('lsc1', 'json')):
+        """
+        :param latency: seconds to wait before answering every request
+        :param failure_rate: fraction of requests to fail with HTTP 500
+        :param encodings: encodings of sync_values the server understands, most preferred first
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.encodings = encodings
+        self.lock = threading.Lock()
+        self.orders = threading.Condition(self.lock)        # notified when orders are issued
+        self.long_poll = True
+        self.devices = {}       # device_id => FakeDevice
+        self.requests = {}      # endpoint => amount of requests
+        self.samples = 0        # amount of samples received
+        self.bytes = 0          # amount of request body bytes received
+        self.arrivals = []      # list of (time of arrival, timestamp of sample) if record_arrivals
+        self.record_arrivals = False
+        self.http = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % (self.http.server_address[1], )
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status, answer = server.handle(self.path, body, self.headers.get('Content-Type'),
+                                               self.headers.get('Content-Encoding'))
+                answer = json.dumps(answer).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+        self.http = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.http.serve_forever, args=(0.05, ))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+    def device(self, device_id):
+        """:return: FakeDevice"""
+        with self.lock:
+            try:
+                return self.devices[device_id]
+            except KeyError:
+                device = self.devices[device_id] = FakeDevice()
+                return device
+
+    def write(self, device_id, path, value, timestamp=None):
+        """Order a device to write a value to a (prefixed) path"""
+        device = self.device(device_id)
+        with self.lock:
+            device.writes[path] = [(timestamp or time.time()) * 1000, value]
+            self.orders.notify_all()
+
+    def read(self, device_id, path):
+        """Order a device to read a (prefixed) path"""
+        device = self.device(device_id)
+        with self.lock:
+            device.reads.add(path)
+            self.orders.notify_all()
+
+    # Request handling
+
+    def handle(self, endpoint, body, content_type, content_encoding):
+        """:return: tuple of (HTTP status, answer)"""
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes += len(body)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.failure_rate and random.random() < self.failure_rate:
+            return 500, None
+
+        if content_encoding == 'gzip':
+            body = zlib.decompress(body, 31)
+
+        try:
+            codec = BY_CONTENT_TYPE[content_type or 'application/json']
+        except KeyError:
+            return 415, None
+
+        if codec.name != 'json' and codec.name not in self.encodings:
+            return 415, None
+
+        payload = codec.decode(body)
+
+        if endpoint.startswith('/v1/batch/'):
+            endpoint = '/v1/' + endpoint[len('/v1/batch/'):]
+            results = []
+            for device_payload in payload['devices']:
+                status, answer = self._handle(endpoint, device_payload)
+                results.append(answer if status == 200 else None)
+            return 200, {'results': results}
+
+        return self._handle(endpoint, payload)
+
+    def _handle(self, endpoint, payload):
+        try:
+            handler = {
+                '/v1/redefine_paths/': self._redefine_paths,
+                '/v1/update_paths/': self._update_paths,
+                '/v1/get_orders/': self._get_orders,
+                '/v1/confirm_orders/': self._confirm_orders,
+                '/v1/sync_values/': self._sync_values,
+            }[endpoint]
+        except KeyError:
+            return 404, None
+
+        device = self.device(payload['device_id'])
+        with self.lock:
+            return handler(device, payload)
+
+    def _hash(self, device):
+        h = 0
+        for path in device.paths:
+            h ^= path_hash(path)
+        return '%016x' % (h, )
+
+    def _redefine_paths(self, device, payload):
+        device.paths = set(payload['paths'])
+        answer = {'values': dict((path, device.last_value(path)) for path in device.paths),
+                  'hash': self._hash(device)}
+
+        for encoding in self.encodings:
+            if encoding in payload.get('encodings', ()):
+                answer['encoding'] = encoding
+                break
+        return 200, answer
+
+    def _update_paths(self, device, payload):
+        if payload['base_hash'] != self._hash(device):
+            return 409, None
+        device.paths.difference_update(payload['remove'])
+        device.paths.update(payload['add'])
+        return 200, {'values': dict((path, device.last_value(path)) for path in payload['add']),
+                     'hash': self._hash(device)}
+
+    def _get_orders(self, device, payload):
+        wait = payload.get('wait') if self.long_poll else None
+        if wait:
+            deadline = time.time() + wait
+            while not (device.writes or device.reads) and time.time() < deadline:
+                self.orders.wait(deadline - time.time())
+
+        answer = {'writes': device.writes, 'reads': list(device.reads), 'pot': device.pot}
+        if wait:
+            answer['wait'] = True
+        device.writes = {}
+        device.reads = set()
+        device.pot += 1
+        return 200, answer
+
+    def _confirm_orders(self, device, payload):
+        device.confirmations.append(payload)
+        return 200, {}
+
+    def _sync_values(self, device, payload):
+        now = time.time()
+        for path, samples in payload['values'].items():
+            device.values.setdefault(path, []).extend(list(sample) for sample in samples)
+            self.samples += len(samples)
+            if self.record_arrivals:
+                self.arrivals.extend((now, sample[0] / 1000.0) for sample in samples)
+        return 200, {}
@@ -0,0 +1,115 @@
+from unittest import TestCase
+import asyncio
+import threading
+from longshot import pathpoint_from_functions
+from longshot.persistence import NoPersistenceLayer
+from longshot.aio import AsyncDevice, AsyncTransport
+from longshot.tests.test_device import FakeTransport
+
+
+class TestAsyncDevice(TestCase):
+
+    def testManyDevicesOnOneLoop(self):
+        transport = AsyncTransport(max_in_flight=4, transport=FakeTransport())
+
+        async def scenario():
+            devices = [AsyncDevice('dev%s' % i, 'xx', transport=transport,
+                                   upload_min_delay=0.01, upload_max_latency=0.05) for i in range(50)]
+            for device in devices:
+                pathpoint_from_functions('Waccess', device).register().store(1, 1000)
+                device.done()
+
+            for i in range(100):
+                await asyncio.sleep(0.02)
+                if transport.transport.endpoints().count('/v1/sync_values/') == 50:
+                    break
+
+            await asyncio.gather(*[device.shutdown() for device in devices])
+
+        asyncio.get_event_loop_policy().new_event_loop().run_until_complete(scenario())
+
+        endpoints = transport.transport.endpoints()
+        self.assertEqual(endpoints.count('/v1/redefine_paths/'), 50)
+        self.assertEqual(endpoints.count('/v1/sync_values/'), 50)
+
+    def testInFlightLimit(self):
+        in_flight = []
+        peak = []
+
+        class SlowTransport(FakeTransport):
+            def post(self, api_root, endpoint, payload, encoding='json'):
+                import time
+                in_flight.append(1)
+                peak.append(len(in_flight))
+                time.sleep(0.01)
+                in_flight.pop()
+                return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+        transport = AsyncTransport(max_in_flight=2, transport=SlowTransport())
+
+        async def scenario():
+            await asyncio.gather(*[transport.post('http://api', '/v1/get_orders/', {}) for i in range(10)])
+
+        asyncio.get_event_loop_policy().new_event_loop().run_until_complete(scenario())
+        self.assertLessEqual(max(peak), 2)
+
+    def testPersistenceIsKeptOffTheLoop(self):
+        calls = []
+
+        class RecordingLayer(NoPersistenceLayer):
+            def checkpoint(self):
+                calls.append(('checkpoint', threading.current_thread()))
+                return 1
+
+            def acknowledge(self, mark):
+                calls.append(('acknowledge', threading.current_thread()))
+
+            def sync(self):
+                calls.append(('sync', threading.current_thread()))
+
+        transport = AsyncTransport(transport=FakeTransport())
+
+        async def scenario():
+            device = AsyncDevice('dev', 'xx', transport=transport, persistence_layer=RecordingLayer(),
+                                 upload_min_delay=0.01)
+            pathpoint_from_functions('Waccess', device).register().store(1, 1000)
+            device.done()
+            for i in range(100):
+                await asyncio.sleep(0.02)
+                if 'acknowledge' in [name for name, thread in calls]:
+                    break
+            await device.shutdown()
+
+        asyncio.get_event_loop_policy().new_event_loop().run_until_complete(scenario())
+        self.assertEqual(set(name for name, thread in calls), set(['checkpoint', 'acknowledge', 'sync']))
+        self.assertNotIn(threading.current_thread(), [thread for name, thread in calls])
+
+    def testFailedAcknowledgeFailsTheCycle(self):
+        acknowledged = []
+
+        class FailingLayer(NoPersistenceLayer):
+            def checkpoint(self):
+                return 1
+
+            def acknowledge(self, mark):
+                acknowledged.append(mark)
+                raise IOError('disk full')
+
+        transport = AsyncTransport(transport=FakeTransport())
+
+        async def scenario():
+            device = AsyncDevice('dev', 'xx', transport=transport, persistence_layer=FailingLayer(),
+                                 upload_min_delay=0.01)
+            pathpoint_from_functions('Waccess', device).register().store(1, 1000)
+            device.done()
+            for i in range(100):
+                await asyncio.sleep(0.02)
+                if acknowledged:
+                    break
+            await asyncio.sleep(0.05)
+            await device.shutdown()
+            return device
+
+        device = asyncio.get_event_loop_policy().new_event_loop().run_until_complete(scenario())
+        self.assertTrue(acknowledged)
+        self.assertGreater(device.thread.retry_at, 0)
@@ -0,0 +1,13 @@
+from unittest import TestCase
+from longshot import benchmark
+
+
+class TestBenchmark(TestCase):
+
+    def testScenariosReport(self):
+        results = benchmark.run(['high_rate', 'memory'], scale=0.01)
+        self.assertEqual(results['high_rate']['samples'], 4 * 500)
+        self.assertGreater(results['high_rate']['samples_per_s'], 0)
+        self.assertIsNotNone(results['high_rate']['p99_latency_s'])
+        self.assertGreater(results['memory']['bytes_per_sample_list'],
+                           results['memory']['bytes_per_sample_array'])
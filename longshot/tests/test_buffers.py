@@ -0,0 +1,149 @@
+from unittest import TestCase
+import array
+import os
+import tempfile
+from longshot.buffers import ListBuffer, ArrayBuffer, DROP_OLDEST, DOWNSAMPLE, SPILL, _MS
+
+
+class TestBuffers(TestCase):
+
+    def testListBufferDrain(self):
+        b = ListBuffer()
+        b.append((1, 'a'))
+        b.extend([(2, 'b'), (3, 'c')])
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b.drain(), ([1, 2, 3], ['a', 'b', 'c']))
+        self.assertFalse(b)
+
+    def testDropOldest(self):
+        b = ArrayBuffer(capacity=3, overflow=DROP_OLDEST)
+        b.extend((ts, ts * 10) for ts in range(5))
+        self.assertEqual(len(b), 3)
+        self.assertEqual(list(b), [(2, 20), (3, 30), (4, 40)])
+        self.assertEqual(b.oldest(), 2)
+        timestamps, values = b.drain()
+        self.assertEqual(list(timestamps), [2, 3, 4])
+        self.assertEqual(list(values), [20, 30, 40])
+        self.assertEqual(len(b), 0)
+
+    def testDownsample(self):
+        b = ArrayBuffer(capacity=4, overflow=DOWNSAMPLE)
+        b.extend((ts, ts) for ts in range(5))
+        self.assertEqual(list(b.drain()[0]), [0, 2, 4])
+
+    def testSpill(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'spill')
+        b = ArrayBuffer(capacity=2, overflow=SPILL, spill_path=spill_path)
+        b.extend((ts, ts * 10) for ts in range(5))
+        self.assertEqual(len(b), 5)
+        self.assertTrue(os.path.exists(spill_path))
+        self.assertEqual(b.oldest(), 0)
+
+        timestamps, values = b.drain()
+        self.assertEqual(list(timestamps), [0, 1, 2, 3, 4])
+        self.assertEqual(list(values), [0, 10, 20, 30, 40])
+        self.assertFalse(os.path.exists(spill_path))
+        self.assertEqual(len(b), 0)
+        self.assertIsNone(b.oldest())
+
+    def testPeekReadsBackOnlyWhatItReturns(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'spill')
+        b = ArrayBuffer(capacity=2, overflow=SPILL, spill_path=spill_path)
+        b.extend((ts, ts * 10) for ts in range(7))      # 0-5 spilled, 6 in memory
+
+        head, timestamps, values = b.peek(3)
+        self.assertEqual((head, list(timestamps), list(values)), (0, [0, 1, 2], [0, 10, 20]))
+        self.assertEqual(list(b), [(6, 60)])
+        b.trim(head + len(timestamps))
+        self.assertEqual((len(b), b.oldest()), (4, 3))
+
+        head, timestamps, values = b.peek()
+        self.assertEqual((head, list(timestamps)), (3, [3, 4, 5, 6]))
+        b.trim(head + 3)
+        self.assertFalse(os.path.exists(spill_path))
+        self.assertEqual(b.peek(), (6, array.array(_MS, [6]), array.array('d', [60])))
+
+    def testDownsampleSparesPeekedSamples(self):
+        b = ArrayBuffer(capacity=4, overflow=DOWNSAMPLE)
+        b.extend((ts, ts) for ts in range(4))
+        head, timestamps, values = b.peek(2)
+        b.append((4, 4))
+        b.trim(head + len(timestamps))
+        self.assertEqual(list(b), [(2, 2), (4, 4)])
+
+    def testPeekAndTrim(self):
+        b = ListBuffer()
+        b.extend((ts, ts) for ts in range(5))
+        head, timestamps, values = b.peek(3)
+        self.assertEqual((head, timestamps), (0, [0, 1, 2]))
+        b.append((5, 5))
+        b.trim(head + len(timestamps))
+        self.assertEqual(b.peek(), (3, [3, 4, 5], [3, 4, 5]))
+
+    def testTrimAfterDropOldest(self):
+        b = ArrayBuffer(capacity=3, overflow=DROP_OLDEST)
+        b.extend((ts, ts) for ts in range(3))
+        head, timestamps, values = b.peek(2)
+        b.extend((ts, ts) for ts in range(3, 5))    # drops 0 and 1, which were peeked at
+        b.trim(head + len(timestamps))
+        self.assertEqual(list(b), [(2, 2), (3, 3), (4, 4)])
+
+    def testOutOfOrderSamplesAreInsertedInOrder(self):
+        for b in (ListBuffer(), ArrayBuffer(capacity=10)):
+            b.extend([(1000, 1), (3000, 3), (2000, 2), (3000, 4), (500, 0)])
+            self.assertEqual(list(b), [(500, 0), (1000, 1), (2000, 2), (3000, 3), (3000, 4)])
+
+            # but never in front of samples already peeked at
+            head, timestamps, values = b.peek()
+            b.append((1500, 5))
+            b.append((4000, 6))
+            b.trim(head + len(timestamps))
+            self.assertEqual(list(b), [(1500, 5), (4000, 6)])
+
+    def testOutOfOrderSampleInFullRing(self):
+        b = ArrayBuffer(capacity=3, overflow=DROP_OLDEST)
+        b.extend([(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
+        b.append((3, 6))
+        self.assertEqual(list(b), [(3, 6), (4, 4), (5, 5)])
+        self.assertEqual(b.head, 3)
+
+    def testSpillRequiresPath(self):
+        self.assertRaises(ValueError, ArrayBuffer, overflow=SPILL)
+
+
+class TestConcurrentIngestion(TestCase):
+
+    def check_no_sample_lost(self, buffer):
+        import threading
+        producers, per_producer = 8, 5000
+        drained = []
+        finished = threading.Event()
+
+        def produce(n):
+            for i in range(per_producer):
+                buffer.append((n * per_producer + i, i))
+
+        def consume():
+            while not finished.is_set():
+                drained.extend(zip(*buffer.drain()))
+            drained.extend(zip(*buffer.drain()))
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        threads = [threading.Thread(target=produce, args=(n, )) for n in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        finished.set()
+        consumer.join()
+
+        self.assertEqual(sorted(ts for ts, v in drained), list(range(producers * per_producer)))
+        for ts, v in drained:
+            self.assertEqual(ts % per_producer, v)
+
+    def testListBuffer(self):
+        self.check_no_sample_lost(ListBuffer())
+
+    def testArrayBuffer(self):
+        self.check_no_sample_lost(ArrayBuffer(capacity=10 ** 6))
@@ -0,0 +1,361 @@
+from unittest import TestCase
+import threading
+import time
+from longshot import Device, pathpoint_from_functions
+from longshot.device import path_hash
+from longshot.persistence import NoPersistenceLayer
+from longshot.testing import FakeServer
+from longshot.wire import JSONCodec
+
+
+class FakeResponse(object):
+    def __init__(self, val, status_code=200):
+        self.val = val
+        self.status_code = status_code
+
+    def json(self):
+        return self.val
+
+
+class FakeTransport(object):
+    """Answers like an empty Longshot server would, and records the calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.called = threading.Event()
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        self.calls.append((endpoint, payload))
+        self.called.set()
+        if endpoint in ('/v1/redefine_paths/', '/v1/update_paths/'):
+            return FakeResponse({'values': {}})
+        elif endpoint == '/v1/get_orders/':
+            return FakeResponse({'writes': {}, 'reads': [], 'pot': 0})
+        return FakeResponse({})
+
+    def endpoints(self):
+        return [endpoint for endpoint, payload in self.calls]
+
+
+class HashingTransport(FakeTransport):
+    """A FakeTransport that echoes hash of the paths, like a server that accepts update_paths"""
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        response = FakeTransport.post(self, api_root, endpoint, payload, encoding)
+        if endpoint == '/v1/redefine_paths/':
+            h = 0
+            for path in payload['paths']:
+                h ^= path_hash(path)
+            response.val['hash'] = '%016x' % (h, )
+        elif endpoint == '/v1/update_paths/':
+            response.val['hash'] = payload['hash']
+        return response
+
+
+class WaitingTestCase(TestCase):
+    """A TestCase that waits for what other threads do"""
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+
+class TestScheduling(TestCase):
+
+    def testStoredValueIsUploadedPromptly(self):
+        transport = FakeTransport()
+        d1 = Device('dupa', 'xx', transport=transport, upload_min_delay=0.05, upload_max_latency=0.1)
+        p = pathpoint_from_functions('Waccess', d1).register()
+        d1.done()
+
+        p.store(5, 1000)
+        for i in range(100):
+            if '/v1/sync_values/' in transport.endpoints():
+                break
+            time.sleep(0.01)
+
+        d1.shutdown()
+
+        payload = [pl for ep, pl in transport.calls if ep == '/v1/sync_values/'][0]
+        self.assertEqual(payload['values'], {'Wlaccess': [(1000000, 5)]})
+
+    def testShutdownDoesNotWaitForCycle(self):
+        transport = FakeTransport()
+        d1 = Device('dupa', 'xx', transport=transport)
+        d1.done()
+        transport.called.wait(1)
+
+        started = time.time()
+        d1.shutdown()
+        self.assertLess(time.time() - started, 1)
+
+    def testFlushUploadsWhatIsLeft(self):
+        transport = FakeTransport()
+        d1 = Device('dupa', 'xx', transport=transport)
+        p = pathpoint_from_functions('Waccess', d1).register()
+        d1.done()
+        p.store(5, 1000)
+
+        d1.flush(5)
+        self.assertFalse(d1.thread.is_alive())
+        payload = [pl for ep, pl in transport.calls if ep == '/v1/sync_values/'][-1]
+        self.assertEqual(payload['values'], {'Wlaccess': [(1000000, 5)]})
+
+    def testFlushGivesUpOnStuckThread(self):
+        class StuckTransport(FakeTransport):
+            def post(self, api_root, endpoint, payload, encoding='json'):
+                self.called.set()
+                time.sleep(2)
+                return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+        transport = StuckTransport()
+        d1 = Device('dupa', 'xx', transport=transport)
+        d1.done()
+        transport.called.wait(1)
+
+        started = time.time()
+        d1.flush(0.2)
+        self.assertLess(time.time() - started, 1)
+
+    def testRegisterWakesThread(self):
+        transport = HashingTransport()
+        d1 = Device('dupa', 'xx', transport=transport)
+        d1.done()
+        transport.called.wait(1)
+        time.sleep(0.05)
+
+        pathpoint_from_functions('Wnew', d1).register()
+        for i in range(100):
+            if '/v1/update_paths/' in transport.endpoints():
+                break
+            time.sleep(0.01)
+
+        d1.shutdown()
+        self.assertEqual(transport.calls[-1], ('/v1/update_paths/', {
+            'device_id': 'dupa', 'secret': 'xx', 'prefix': 'l',
+            'add': ['Wlnew'], 'remove': [],
+            'base_hash': '0000000000000000', 'hash': '%016x' % (path_hash('Wlnew'), )}))
+
+
+class TestDirtyTracking(TestCase):
+
+    def testOnlyChangedPathpointsAreDrained(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        pathpoints = [pathpoint_from_functions('Wp%s' % i, d1).register() for i in range(100)]
+        self.assertFalse(d1.thread._needs_upload())
+
+        pathpoints[7].store(1, 1000)
+        self.assertEqual(d1.dirty, set(['Wlp7']))
+        self.assertTrue(d1.thread._needs_upload())
+
+        chunks = d1.thread._values_chunks()
+        self.assertEqual(list(chunks[0].payload['values'].keys()), ['Wlp7'])
+        self.assertFalse(d1.thread._needs_upload())
+
+    def testOnlyFirstSampleOfBatchNotifies(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        p = pathpoint_from_functions('Waccess', d1).register()
+        notified = []
+        notify_stored = d1.notify_stored
+        d1.notify_stored = lambda path, priority: notified.append(path) or notify_stored(path, priority)
+
+        p.store(1, 1000)
+        p.store(2, 1001)
+        self.assertEqual(notified, ['Wlaccess'])
+
+        d1.dirty.add('Wlaccess')
+        d1.thread._values_chunks()
+        p.store(3, 1002)
+        self.assertEqual(notified, ['Wlaccess', 'Wlaccess'])
+
+    def testSampleIsLoggedOnceItsPathIsDirty(self):
+        logged = []
+
+        class CheckingLayer(NoPersistenceLayer):
+            def log_sample(self, path, timestamp, value):
+                logged.append(path in d1.dirty)
+
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), persistence_layer=CheckingLayer())
+        p = pathpoint_from_functions('Waccess', d1).register()
+        p.store(1, 1000)
+        p.store(2, 1001)
+        self.assertEqual(logged, [True, True])
+
+    def testFailedUploadMarksPathpointDirtyAgain(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        p = pathpoint_from_functions('Waccess', d1).register()
+        p.store(1, 1000)
+
+        chunks = d1.thread._values_chunks()
+        self.assertFalse(d1.thread._on_chunks_sent(chunks, [0]))
+        self.assertEqual(d1.dirty, set(['Wlaccess']))
+        self.assertEqual(list(p.stored_values), [(1000000, 1)])
+
+
+class TestChunkedUpload(TestCase):
+
+    def store(self, device, amount):
+        pathpoints = [pathpoint_from_functions('Wp%s' % i, device).register() for i in range(2)]
+        for p in pathpoints:
+            for i in range(amount):
+                p.store(i, 1000 + i)
+        return pathpoints
+
+    def testBacklogIsSplitIntoChunks(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), chunk_samples=3)
+        self.store(d1, 5)
+        chunks = d1.thread._values_chunks()
+        self.assertEqual([chunk.samples for chunk in chunks], [3, 3, 3, 1])
+        for chunk in chunks:
+            for samples in chunk.payload['values'].values():
+                self.assertEqual(samples, sorted(samples))
+
+    def testChunksAreBoundedByBytes(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), chunk_bytes=1000)
+        p = pathpoint_from_functions('Wtext', d1).register()
+        for i in range(100):
+            p.store('x' * 100, 1000 + i)
+        chunks = d1.thread._values_chunks()
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks:
+            self.assertLess(len(JSONCodec().encode(chunk.payload)), 2000)
+
+    def testAcknowledgedChunksAreTrimmed(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), chunk_samples=3)
+        p0, p1 = self.store(d1, 5)
+        chunks = d1.thread._values_chunks()
+        p0.store(100, 2000)     # while uploading
+
+        self.assertFalse(d1.thread._on_chunks_sent(chunks, [200, 0, None, None]))
+        self.assertEqual(d1.dirty, set(['Wlp0', 'Wlp1']))
+        remaining = len(p0.stored_values) + len(p1.stored_values)
+        self.assertEqual(remaining, 10 - 3 + 1)
+        self.assertIn((2000000, 100), list(p0.stored_values))
+
+        chunks = d1.thread._values_chunks()
+        self.assertTrue(d1.thread._on_chunks_sent(chunks, [200] * len(chunks)))
+        self.assertEqual(len(p0.stored_values) + len(p1.stored_values), 0)
+
+    def testPipelinedUpload(self):
+        server = FakeServer().start()
+        try:
+            d1 = Device('dupa', 'xx', longshot_path=server.url, chunk_samples=100,
+                        upload_pipeline=3)
+            p0, p1 = self.store(d1, 500)
+            d1.thread.next_order_check = time.time() + 60
+            d1.thread._syncpaths()
+            d1.thread._syncvalues()
+        finally:
+            server.stop()
+
+        self.assertEqual(server.requests['/v1/sync_values/'], 10)
+        values = server.device('dupa').values
+        self.assertEqual(sorted(v for ts, v in values['Wlp0']), list(range(500)))
+        self.assertEqual(len(p0.stored_values) + len(p1.stored_values), 0)
+
+
+class TestBulkRegistration(TestCase):
+
+    def testValuesAreLookedUpAtOnce(self):
+        class Persistence(NoPersistenceLayer):
+            lookups = []
+
+            def get_current_value(self, path):
+                raise AssertionError('looked up one by one')
+
+            def get_current_values(self, paths):
+                self.lookups.append(list(paths))
+                return {'Wla': (1000, 5)}
+
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), persistence_layer=Persistence())
+        written = []
+        a, b = d1.register_many(['Wa', {'path': 'Wb', 'default_value': 3,
+                                        'on_write_arrived': lambda ts, v: written.append(v)}])
+
+        self.assertEqual(Persistence.lookups, [['Wla', 'Wlb']])
+        self.assertEqual(a.current(), (1000, 5))
+        self.assertEqual(b.current(), (None, 3))
+        b.on_write_arrived(2000, 7)
+        self.assertEqual(written, [7])
+        self.assertFalse(hasattr(a, '__dict__'))
+
+    def testPathsAreSynchronizedOnce(self):
+        transport = FakeTransport()
+        d1 = Device('dupa', 'xx', transport=transport)
+        d1.register_many('Wp%s' % i for i in range(1000))
+
+        d2 = Device('dupa', 'xx', transport=FakeTransport())
+        for i in range(1000):
+            pathpoint_from_functions('Wp%s' % i, d2).register()
+        self.assertEqual(d1.paths_hash, d2.paths_hash)
+
+        d1.thread._syncpaths()
+        self.assertEqual(transport.endpoints(), ['/v1/redefine_paths/'])
+        self.assertEqual(len(transport.calls[0][1]['paths']), 1000)
+
+
+class TestPathSynchronization(TestCase):
+
+    def setUp(self):
+        self.transport = HashingTransport()
+        self.device = Device('dupa', 'xx', transport=self.transport)
+        self.p1 = pathpoint_from_functions('Wp1', self.device).register()
+        self.p2 = pathpoint_from_functions('Wp2', self.device).register()
+        self.device.thread._syncpaths()
+
+    def testFirstSynchronizationIsFull(self):
+        endpoint, payload = self.transport.calls[0]
+        self.assertEqual(endpoint, '/v1/redefine_paths/')
+        self.assertEqual(sorted(payload['paths']), ['Wlp1', 'Wlp2'])
+
+    def testOnlyDeltaIsSent(self):
+        self.p1.unregister()
+        pathpoint_from_functions('Wp3', self.device).register()
+        self.device.thread._syncpaths()
+
+        endpoint, payload = self.transport.calls[-1]
+        self.assertEqual(endpoint, '/v1/update_paths/')
+        self.assertEqual((payload['add'], payload['remove']), (['Wlp3'], ['Wlp1']))
+        self.assertEqual(payload['base_hash'], '%016x' % (path_hash('Wlp1') ^ path_hash('Wlp2')))
+        self.assertEqual(payload['hash'], '%016x' % (path_hash('Wlp2') ^ path_hash('Wlp3')))
+
+    def testFallbackToFullRedefine(self):
+        original_post = self.transport.post
+
+        def post(api_root, endpoint, payload, encoding='json'):
+            if endpoint == '/v1/update_paths/':
+                self.transport.calls.append((endpoint, payload))
+                return FakeResponse(None, 404)
+            return original_post(api_root, endpoint, payload, encoding)
+
+        self.transport.post = post
+        pathpoint_from_functions('Wp3', self.device).register()
+        self.device.thread._syncpaths()
+
+        self.assertEqual(self.transport.endpoints()[-2:], ['/v1/update_paths/', '/v1/redefine_paths/'])
+        self.assertEqual(sorted(self.transport.calls[-1][1]['paths']), ['Wlp1', 'Wlp2', 'Wlp3'])
+        self.assertTrue(self.device.paths_synced)
+
+    def testServerWithoutHashGetsFullRedefines(self):
+        transport = FakeTransport()
+        device = Device('dupa', 'xx', transport=transport)
+        pathpoint_from_functions('Wp1', device).register()
+        device.thread._syncpaths()
+        self.assertTrue(device.paths_full_sync)
+
+        pathpoint_from_functions('Wp2', device).register()
+        device.thread._syncpaths()
+        self.assertEqual(transport.endpoints(), ['/v1/redefine_paths/', '/v1/redefine_paths/'])
+        self.assertEqual(sorted(transport.calls[-1][1]['paths']), ['Wlp1', 'Wlp2'])
+        self.assertTrue(device.paths_synced)
+
+    def testHashMismatchForcesFullRedefine(self):
+        self.transport.post = lambda api_root, endpoint, payload, encoding='json': \
+            FakeResponse({'values': {}, 'hash': 'nope'})
+        pathpoint_from_functions('Wp3', self.device).register()
+        self.device.thread._syncpaths()
+
+        self.assertFalse(self.device.paths_synced)
+        self.assertTrue(self.device.paths_full_sync)
@@ -0,0 +1,74 @@
+import threading
+from longshot import Device, Dispatcher, BasePathpoint, pathpoint_from_functions
+from longshot.tests.test_device import FakeTransport, WaitingTestCase
+
+
+class TestDispatcher(WaitingTestCase):
+
+    def testWritesAreDeliveredOffThread(self):
+        dispatcher = Dispatcher(workers=2)
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), dispatcher=dispatcher)
+        threads = []
+        p = pathpoint_from_functions('Waccess', d1,
+                                     on_write_arrived=lambda ts, v: threads.append(threading.current_thread()))
+        p.on_write_arrived(1000, 5)
+
+        self.wait_for(lambda: dispatcher.delivered == 1)
+        self.assertNotEqual(threads, [threading.current_thread()])
+        self.assertEqual(p.value, 5)
+        dispatcher.shutdown()
+
+    def testSupersededWritesAreCoalesced(self):
+        release = threading.Event()
+        seen = []
+
+        def slow(timestamp, value):
+            release.wait(5)
+            seen.append(value)
+
+        dispatcher = Dispatcher(workers=1)
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), dispatcher=dispatcher)
+        p = BasePathpoint('Waccess', d1).listen(slow)
+
+        p.on_write_arrived(1000, 1)
+        self.wait_for(lambda: dispatcher.queue_depth == 0)     # first one is being delivered
+        for v in range(2, 10):
+            p.on_write_arrived(1000 + v, v)
+        self.assertEqual(dispatcher.queue_depth, 1)
+        release.set()
+
+        self.wait_for(lambda: dispatcher.delivered == 2)
+        self.assertEqual(seen, [1, 9])
+        self.assertEqual(dispatcher.coalesced, 7)
+        self.assertIsNotNone(dispatcher.mean_latency)
+        dispatcher.shutdown()
+
+    def testOrderIsKeptPerPath(self):
+        seen = []
+        dispatcher = Dispatcher(workers=4)
+        for i in range(100):
+            dispatcher.dispatch('Wlp%s' % (i % 5), seen.append, ((i % 5, i), ))
+
+        self.wait_for(lambda: dispatcher.delivered + dispatcher.coalesced == 100)
+        for path in range(5):
+            delivered = [i for p, i in seen if p == path]
+            self.assertEqual(delivered, sorted(delivered))
+        dispatcher.shutdown()
+
+    def testBackPressure(self):
+        release = threading.Event()
+        dispatcher = Dispatcher(workers=1, max_pending=2)
+        dispatcher.dispatch('Wla', lambda: release.wait(5), ())
+        self.wait_for(lambda: dispatcher.queue_depth == 0)
+        dispatcher.dispatch('Wlb', lambda: None, ())
+        dispatcher.dispatch('Wlc', lambda: None, ())
+
+        blocked = threading.Thread(target=dispatcher.dispatch, args=('Wld', lambda: None, ()))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        dispatcher.shutdown()
@@ -0,0 +1,72 @@
+from unittest import TestCase
+from longshot import Device, Reduction, pathpoint_from_functions
+from longshot.tests.test_device import FakeTransport
+
+
+def feed(reduction, samples):
+    queued = []
+    for ts, v in samples:
+        queued.extend(reduction(ts, v))
+    return queued
+
+
+class TestReduction(TestCase):
+
+    def testChangeOnly(self):
+        r = Reduction(change_only=True)
+        self.assertEqual(feed(r, [(1, 5), (2, 5), (3, 6), (4, 6)]), [(1, 5), (3, 6)])
+
+    def testDeadband(self):
+        r = Reduction(deadband=0.5)
+        self.assertEqual(feed(r, [(1, 10), (2, 10.3), (3, 10.6), (4, 10.2)]), [(1, 10), (3, 10.6)])
+
+    def testRelativeDeadband(self):
+        r = Reduction(relative_deadband=0.1)
+        self.assertEqual(feed(r, [(1, 100), (2, 105), (3, 111)]), [(1, 100), (3, 111)])
+
+    def testMinIntervalAndHeartbeat(self):
+        r = Reduction(min_interval=10)
+        self.assertEqual(feed(r, [(0, 1), (5, 2), (10, 3)]), [(0, 1), (10, 3)])
+
+        r = Reduction(change_only=True, heartbeat=60)
+        self.assertEqual(feed(r, [(0, 1), (30, 1), (61, 1)]), [(0, 1), (61, 1)])
+
+    def testAggregation(self):
+        r = Reduction(aggregate='avg', bucket=10)
+        self.assertEqual(feed(r, [(0, 1), (5, 3), (12, 10), (25, 0)]), [(0, 2), (10, 10)])
+
+        r = Reduction(aggregate='max', bucket=10)
+        self.assertEqual(feed(r, [(0, 1), (5, 3), (12, 10)]), [(0, 3)])
+
+    def testEndedBucketIsClosed(self):
+        r = Reduction(aggregate='avg', bucket=10)
+        self.assertEqual(feed(r, [(0, 1), (5, 3)]), [])
+        self.assertEqual(r.closes_at, 10)
+        self.assertEqual(r.flush(9), [])
+        self.assertEqual(r.flush(10), [(0, 2)])
+        self.assertIsNone(r.closes_at)
+
+    def testLongshotThreadClosesBuckets(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        p = pathpoint_from_functions('Waccess', d1,
+                                     reduction=Reduction(aggregate='max', bucket=10)).register()
+        p.store(1, 1000)
+        p.store(3, 1005)
+        self.assertEqual(d1.aggregating, set(['Wlaccess']))
+        d1.paths_synced, d1.thread.next_order_check = True, 2000
+        with d1.condition:
+            self.assertEqual(d1.thread._next_deadline(0), 1010)
+
+        d1.thread._is_upload_due(1010)
+        self.assertEqual(list(p.stored_values), [(1000000, 3)])
+
+    def testInvalidPolicy(self):
+        self.assertRaises(ValueError, Reduction, aggregate='median', bucket=10)
+        self.assertRaises(ValueError, Reduction, aggregate='avg')
+
+    def testPathpointAppliesReductionOnStore(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        p = pathpoint_from_functions('Waccess', d1, reduction=Reduction(change_only=True)).register()
+        for ts, v in [(1, 5), (2, 5), (3, 6)]:
+            p.store(v, ts)
+        self.assertEqual(list(p.stored_values), [(1000, 5), (3000, 6)])
@@ -0,0 +1,58 @@
+from longshot import Device, DeviceGroup, BatchFanOut, pathpoint_from_functions
+from longshot.tests.test_device import FakeTransport, WaitingTestCase
+
+
+class TestDeviceGroup(WaitingTestCase):
+
+    def testOneRequestPerCycle(self):
+        transport = FakeTransport()
+        group = DeviceGroup('http://api', transport=BatchFanOut(transport))
+        devices = [Device('dev%s' % i, 'xx', group=group,
+                          upload_min_delay=0.01, upload_max_latency=0.05) for i in range(10)]
+        pathpoints = [pathpoint_from_functions('Waccess', device).register() for device in devices]
+        for device in devices:
+            device.done()
+
+        self.wait_for(lambda: transport.endpoints().count('/v1/get_orders/') == 10)
+
+        batches = []
+        group.transport.post = lambda api_root, endpoint, payload, encoding='json': \
+            batches.append(endpoint) or BatchFanOut.post(group.transport, api_root, endpoint, payload, encoding)
+
+        for i, pathpoint in enumerate(pathpoints):
+            pathpoint.store(i, 1000)
+
+        self.wait_for(lambda: transport.endpoints().count('/v1/sync_values/') == 10)
+        group.shutdown()
+
+        self.assertEqual(batches, ['/v1/batch/sync_values/'])
+        synced = [payload for endpoint, payload in transport.calls if endpoint == '/v1/sync_values/']
+        self.assertEqual(sorted(payload['values']['Wlaccess'][0][1] for payload in synced), list(range(10)))
+
+    def testFailureOfOneDeviceDoesNotAffectOthers(self):
+        class FlakyTransport(FakeTransport):
+            def post(self, api_root, endpoint, payload, encoding='json'):
+                if endpoint == '/v1/sync_values/' and payload['device_id'] == 'dev0':
+                    self.calls.append((endpoint, payload))
+                    from longshot.tests.test_device import FakeResponse
+                    return FakeResponse(None, 500)
+                return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+        transport = FlakyTransport()
+        group = DeviceGroup('http://api', transport=BatchFanOut(transport))
+        d0 = Device('dev0', 'xx', group=group, upload_min_delay=0.01, upload_max_latency=0.05)
+        d1 = Device('dev1', 'xx', group=group, upload_min_delay=0.01, upload_max_latency=0.05)
+        p0 = pathpoint_from_functions('Waccess', d0).register()
+        p1 = pathpoint_from_functions('Waccess', d1).register()
+        d0.done()
+        d1.done()
+        p0.store(1, 1000)
+        p1.store(2, 1000)
+
+        self.wait_for(lambda: transport.endpoints().count('/v1/sync_values/') == 2)
+        group.shutdown()
+
+        self.assertEqual(list(p0.stored_values), [(1000000, 1)])
+        self.assertTrue(p0.needs_sync)
+        self.assertEqual(list(p1.stored_values), [])
+        self.assertGreater(d0.thread.retry_at, d1.thread.retry_at)
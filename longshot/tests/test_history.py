@@ -0,0 +1,56 @@
+from unittest import TestCase
+import time
+from longshot import Device, pathpoint_from_functions
+from longshot.history import History
+from longshot.tests.test_device import FakeTransport
+
+
+class TestHistory(TestCase):
+
+    def testRangeLookup(self):
+        h = History(retention=100)
+        for ts in (10, 20, 15, 30):
+            h.add(ts, ts * 2)
+        self.assertEqual(h.query(), [(10, 20), (15, 30), (20, 40), (30, 60)])
+        self.assertEqual(h.query(15, 20), [(15, 30), (20, 40)])
+        self.assertEqual(h.query(15, 20, 'mean'), 35)
+        self.assertEqual(h.query(t0=16, aggregate='max'), 60)
+        self.assertIsNone(h.query(40, 50, 'min'))
+        self.assertRaises(ValueError, h.query, aggregate='median')
+
+    def testRetention(self):
+        h = History(retention=100, max_samples=150)
+        for ts in range(1000):
+            h.add(ts, ts)
+        self.assertEqual(len(h), 101)
+        self.assertEqual(h.query()[0], (899, 899))
+        self.assertLess(len(h.timestamps), 300)
+
+        h.add(10, 10)       # too old
+        self.assertEqual(len(h), 101)
+
+        h = History(retention=1000, max_samples=50)
+        for ts in range(100):
+            h.add(ts, ts)
+        self.assertEqual(h.query(aggregate='min'), 50)
+
+
+class TestDeviceHistory(TestCase):
+
+    def testFedByStoresWritesAndReads(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), history_retention=60)
+        p = pathpoint_from_functions('Waccess', d1, on_read_requested=lambda: 3).register()
+        now = time.time()
+        p.store(1, now - 20)
+        p.on_write_arrived(now - 10, 2)
+        d1.thread._on_read(p, p.obtain_value())
+
+        self.assertEqual(d1.history('Waccess', now - 20, now - 10), [(now - 20, 1), (now - 10, 2)])
+        self.assertEqual(len(d1.history(p)), 3)
+        self.assertEqual(d1.history('Waccess', t1=now - 10, aggregate='max'), 2)
+
+    def testNoHistoryByDefault(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        pathpoint_from_functions('Waccess', d1).register()
+        self.assertRaises(ValueError, d1.history, 'Waccess')
+        self.assertRaises(KeyError, Device('x', 'y', history_retention=1).history, 'Wnone')
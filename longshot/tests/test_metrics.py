@@ -0,0 +1,83 @@
+from unittest import TestCase
+import time
+from longshot import Device, pathpoint_from_functions, Transport
+from longshot.metrics import Histogram, prometheus_text
+from longshot.testing import FakeServer
+from longshot.tests.test_device import FakeTransport
+
+
+class TestHistogram(TestCase):
+
+    def testCumulativeCounts(self):
+        h = Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [(1, 2), (5, 3), (float('inf'), 4)])
+        self.assertEqual((h.count, h.sum), (4, 14.5))
+
+
+class TestDeviceMetrics(TestCase):
+
+    def setUp(self):
+        self.d1 = Device('dupa', 'xx', transport=FakeTransport())
+        self.p = pathpoint_from_functions('Waccess', self.d1).register()
+        self.observed = []
+        self.d1.metrics.add_hook(lambda name, value, labels: self.observed.append((name, labels)))
+
+    def testUploadIsCounted(self):
+        self.p.store(1, 1000)
+        self.p.store(2, 1001)
+        self.assertEqual(self.d1.metrics.samples_buffered, 2)
+        self.assertGreater(self.d1.metrics.lag, time.time() - 1001)
+
+        self.d1.thread._syncpaths()
+        self.d1.thread._syncvalues()
+
+        metrics = self.d1.metrics
+        self.assertEqual(metrics.samples_buffered, 0)
+        self.assertEqual(metrics.lag, 0)
+        self.assertEqual((metrics.samples_uploaded, metrics.chunks_sent), (2, 1))
+        self.assertEqual(sorted(metrics.api_latency), ['/v1/redefine_paths/', '/v1/sync_values/'])
+        self.assertEqual(metrics.api_latency['/v1/sync_values/'].count, 1)
+        self.assertIn(('upload', {'chunks': 1, 'ok': True}), self.observed)
+        self.assertIn(('api_call', {'endpoint': '/v1/sync_values/', 'ok': True}), self.observed)
+
+    def testLagGrowsWhileUploadsFail(self):
+        self.p.store(1, time.time() - 20)
+        for i in range(2):
+            self.assertTrue(self.d1.thread._is_upload_due(time.time() + 60))
+            chunks = self.d1.thread._values_chunks()
+            self.assertFalse(self.d1.thread._on_chunks_sent(chunks, [0]))
+        self.assertGreater(self.d1.metrics.lag, 10)
+
+    def testPrometheusText(self):
+        self.d1.thread._syncpaths()
+        text = prometheus_text([self.d1.metrics])
+        self.assertIn('# TYPE longshot_api_call_seconds histogram\n', text)
+        self.assertIn('longshot_api_call_seconds_bucket{device="dupa",endpoint="/v1/redefine_paths/",'
+                      'le="+Inf"} 1.0\n', text)
+        self.assertIn('longshot_samples_buffered{device="dupa"} 0.0\n', text)
+        self.assertEqual(text.count('# TYPE longshot_cycle_seconds'), 1)
+
+    def testRaisingHookIsCounted(self):
+        def hook(name, value, labels):
+            raise ValueError('dupa')
+        self.d1.metrics.hooks.insert(0, hook)
+        self.d1.thread._syncpaths()
+        self.assertEqual(self.d1.metrics.hook_errors, 1)
+        self.assertEqual(len(self.observed), 1)        # hooks after the raising one still run
+
+    def testLabelsAreEscaped(self):
+        d1 = Device('du"pa\\\n', 'xx', transport=FakeTransport())
+        text = prometheus_text([d1.metrics])
+        self.assertIn('longshot_samples_buffered{device="du\\"pa\\\\\\n"} 0.0\n', text)
+
+    def testTransportCountsBytes(self):
+        server = FakeServer().start()
+        try:
+            d1 = Device('dupa', 'xx', longshot_path=server.url, transport=Transport())
+            pathpoint_from_functions('Waccess', d1).register()
+            d1.thread._syncpaths()
+        finally:
+            server.stop()
+        self.assertEqual(d1.metrics.bytes_sent, {'/v1/redefine_paths/': server.bytes})
@@ -0,0 +1,131 @@
+from unittest import TestCase
+import time
+from longshot import Device, pathpoint_from_functions
+from longshot.priority import CRITICAL, BULK, TokenBucket
+from longshot.testing import FakeServer
+from longshot.tests.test_device import FakeTransport, WaitingTestCase
+
+
+class TestTokenBucket(TestCase):
+
+    def testRefillsUpToBurst(self):
+        bucket = TokenBucket(rate=1000, burst=2000)
+        self.assertEqual(bucket.available(), 2000)
+        self.assertEqual(bucket.delay(), 0)
+
+        bucket.take(2500)       # in debt
+        self.assertEqual(bucket.available(), 0)
+        self.assertAlmostEqual(bucket.delay(), 1.5, places=1)
+
+
+class TestPriorities(TestCase):
+
+    def testUnknownPriority(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport())
+        self.assertRaises(ValueError, pathpoint_from_functions, 'Waccess', d1, priority='urgent')
+
+    def testBulkIsThrottledAndGoesLast(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), bulk_bandwidth=3200)
+        bulk = pathpoint_from_functions('Wbulk', d1, priority=BULK).register()
+        normal = pathpoint_from_functions('Wnormal', d1).register()
+        for i in range(1000):
+            bulk.store(i, 1000 + i)
+            normal.store(i, 1000 + i)
+
+        chunks = d1.thread._values_chunks()
+        self.assertEqual([pathpoint.path for pathpoint, upto in chunks[0].marks], ['Wnormal', 'Wbulk'])
+        self.assertEqual(len(chunks[0].payload['values']['Wlnormal']), 1000)
+        self.assertEqual(len(chunks[0].payload['values']['Wlbulk']), 100)
+        self.assertEqual(d1.thread.deferred, set(['Wlbulk']))
+
+        self.assertTrue(d1.thread._on_chunks_sent(chunks, [200]))
+        self.assertEqual(len(bulk.stored_values), 900)
+        self.assertEqual(d1.thread._values_chunks(), [])        # budget is spent
+
+        # so the next upload waits until it refills
+        d1.paths_synced, d1.pending_since = True, None
+        d1.thread.next_order_check = time.time() + 60
+        self.assertGreater(d1.thread._next_deadline(time.time()), time.time() + 0.3)
+        self.assertFalse(d1.thread._is_upload_due(time.time()))
+
+    def testCriticalGoesFirstWithoutLane(self):
+        d1 = Device('dupa', 'xx', transport=FakeTransport(), upload_min_delay=60)
+        normal = pathpoint_from_functions('Wnormal', d1).register()
+        alarm = pathpoint_from_functions('Walarm', d1, priority=CRITICAL).register()
+        normal.store(1)
+        self.assertFalse(d1.thread._is_upload_due(time.time()))
+
+        alarm.store(2)
+        self.assertEqual(d1.urgent, set(['Wlalarm']))
+        self.assertTrue(d1.thread._is_upload_due(time.time()))
+        chunks = d1.thread._values_chunks()
+        self.assertEqual([pathpoint.path for pathpoint, upto in chunks[0].marks], ['Walarm', 'Wnormal'])
+
+
+class SlowPaths(FakeTransport):
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        if endpoint == '/v1/redefine_paths/':
+            time.sleep(0.2)
+        return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+
+class TestLanes(WaitingTestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+
+    def tearDown(self):
+        if self.device.thread.is_alive():
+            self.device.shutdown()
+        self.server.stop()
+
+    def testCriticalSkipsTheQueue(self):
+        self.device = Device('dupa', 'xx', longshot_path=self.server.url, upload_min_delay=30,
+                             upload_max_latency=60)
+        normal = pathpoint_from_functions('Wnormal', self.device).register()
+        alarm = pathpoint_from_functions('Walarm', self.device, priority=CRITICAL).register()
+        self.device.done()
+        self.wait_for(lambda: self.device.paths_synced)
+
+        normal.store(1)
+        stored = time.time()
+        alarm.store(2)
+        values = self.server.device('dupa').values
+        self.wait_for(lambda: values.get('Wlalarm'), timeout=1)
+        self.assertLess(time.time() - stored, 1)
+        self.assertNotIn('Wlnormal', values)
+        self.wait_for(lambda: not self.device.urgent)
+
+    def testUploadsYieldToOrders(self):
+        self.device = Device('dupa', 'xx', longshot_path=self.server.url, chunk_samples=10)
+        normal = pathpoint_from_functions('Wnormal', self.device).register()
+        for i in range(50):
+            normal.store(i, 1000 + i)
+
+        thread = self.device.thread
+        thread._syncpaths()
+        thread.next_order_check = 0      # orders are due
+        thread._syncvalues()        # no IOError - the rest was not sent, but nothing failed
+
+        self.assertEqual(self.server.requests['/v1/sync_values/'], 1)
+        self.assertEqual(len(normal.stored_values), 40)
+        self.assertEqual(self.device.dirty, set(['Wlnormal']))
+
+    def testLaneStartsWithFirstCriticalPathpoint(self):
+        self.device = Device('dupa', 'xx', longshot_path=self.server.url)
+        pathpoint_from_functions('Wnormal', self.device).register()
+        self.device.done()
+        self.assertIsNone(self.device.thread.lane)
+
+        pathpoint_from_functions('Walarm', self.device, priority=CRITICAL).register()
+        self.assertTrue(self.device.thread.lane.is_alive())
+
+    def testLaneWaitsForPaths(self):
+        transport = SlowPaths()
+        self.device = Device('dupa', 'xx', transport=transport)
+        alarm = pathpoint_from_functions('Walarm', self.device, priority=CRITICAL).register()
+        alarm.store(1)
+        self.device.done()
+
+        self.wait_for(lambda: '/v1/sync_values/' in transport.endpoints())
+        self.assertEqual(transport.endpoints()[0], '/v1/redefine_paths/')
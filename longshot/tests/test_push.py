@@ -0,0 +1,54 @@
+import time
+from longshot import Device, pathpoint_from_functions, Backoff
+from longshot.testing import FakeServer
+from longshot.tests.test_device import WaitingTestCase
+
+
+class TestPushedOrders(WaitingTestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+        self.written = []
+
+    def tearDown(self):
+        self.device.shutdown()
+        self.server.stop()
+
+    def start(self, **kwargs):
+        self.device = Device('dupa', 'xx', longshot_path=self.server.url, push_orders=True,
+                             push_wait=0.3, **kwargs)
+        pathpoint_from_functions('Waccess', self.device,
+                                 on_write_arrived=lambda ts, v: self.written.append(v)).register()
+        self.device.done()
+
+    def testWriteArrivesPromptly(self):
+        self.start(order_interval=30)
+        self.wait_for(lambda: self.device.thread.listener.connected)
+
+        issued = time.time()
+        self.server.write('dupa', 'Wlaccess', 5)
+        self.wait_for(lambda: self.written == [5], timeout=1)
+        self.assertLess(time.time() - issued, 1)
+        self.wait_for(lambda: len(self.server.device('dupa').confirmations) == 1)
+
+    def testPollingGoesOnWithoutLongPolls(self):
+        self.server.long_poll = False
+        self.start(order_interval=0.1)
+        self.wait_for(lambda: not self.device.thread.listener.is_alive())
+
+        self.server.write('dupa', 'Wlaccess', 5)
+        self.wait_for(lambda: self.written == [5])
+
+    def testReconnectsAfterDrop(self):
+        self.start(order_interval=30)
+        listener = self.device.thread.listener
+        listener.backoff = Backoff(initial=0.05, maximum=0.1)
+        self.wait_for(lambda: listener.connected)
+
+        self.server.failure_rate = 1.0
+        self.wait_for(lambda: not listener.connected)
+
+        self.server.failure_rate = 0
+        self.wait_for(lambda: listener.connected)
+        self.server.write('dupa', 'Wlaccess', 7)
+        self.wait_for(lambda: self.written == [7], timeout=1)
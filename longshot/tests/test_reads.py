@@ -0,0 +1,99 @@
+from unittest import TestCase
+import asyncio
+import threading
+import time
+from longshot import Device, ReadPool, BasePathpoint, pathpoint_from_functions
+from longshot.aio import AsyncDevice, AsyncTransport
+from longshot.tests.test_device import FakeTransport, FakeResponse
+
+
+class OrdersTransport(FakeTransport):
+    def __init__(self, reads):
+        FakeTransport.__init__(self)
+        self.reads = reads
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        if endpoint == '/v1/get_orders/':
+            self.calls.append((endpoint, payload))
+            return FakeResponse({'writes': {}, 'reads': self.reads, 'pot': 7})
+        return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+
+class TestReadPool(TestCase):
+
+    def testSlowReadIsReportedAndStoredLater(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return 2
+
+        pool = ReadPool(workers=2)
+        transport = OrdersTransport(['Wlfast', 'Wlslow'])
+        d1 = Device('dupa', 'xx', transport=transport, read_pool=pool, read_timeout=0.1)
+        fast = pathpoint_from_functions('Wfast', d1, on_read_requested=lambda: 1).register()
+        slow = pathpoint_from_functions('Wslow', d1, on_read_requested=slow).register()
+
+        started = time.time()
+        d1.thread._check_order_queue()
+        self.assertLess(time.time() - started, 1)
+
+        self.assertEqual(transport.calls[-1], ('/v1/confirm_orders/', {
+            'device_id': 'dupa', 'secret': 'xx', 'pot': 7, 'failed_reads': ['Wlslow']}))
+        self.assertEqual([v for ts, v in fast.stored_values], [1])
+        self.assertEqual(list(slow.stored_values), [])
+
+        release.set()
+        for i in range(100):
+            if slow.stored_values:
+                break
+            time.sleep(0.01)
+        self.assertEqual([v for ts, v in slow.stored_values], [2])
+        self.assertIn('Wlslow', d1.dirty)
+        pool.shutdown()
+
+    def testFailingReadIsReported(self):
+        def broken():
+            raise ValueError()
+
+        pool = ReadPool(workers=1)
+        transport = OrdersTransport(['Wlbroken'])
+        d1 = Device('dupa', 'xx', transport=transport, read_pool=pool)
+        pathpoint_from_functions('Wbroken', d1, on_read_requested=broken).register()
+        d1.thread._check_order_queue()
+
+        self.assertEqual(transport.calls[-1][1]['failed_reads'], ['Wlbroken'])
+        pool.shutdown()
+
+
+class TestAsyncReads(TestCase):
+
+    def testObtainValueAsync(self):
+        class AsyncPathpoint(BasePathpoint):
+            async def obtain_value_async(self):
+                await asyncio.sleep(0)
+                return 3
+
+        class HangingPathpoint(BasePathpoint):
+            async def obtain_value_async(self):
+                await asyncio.sleep(5)
+
+        transport = OrdersTransport(['Wlquick', 'Wlhanging'])
+
+        async def scenario():
+            d1 = AsyncDevice('dupa', 'xx', transport=AsyncTransport(transport=transport), read_timeout=0.1)
+            quick = AsyncPathpoint('Wquick', d1).register()
+            HangingPathpoint('Whanging', d1).register()
+            d1.thread.loop = asyncio.get_event_loop()
+            d1.thread.event = asyncio.Event()
+            await d1.thread._check_order_queue()
+
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            return quick
+
+        quick = asyncio.get_event_loop_policy().new_event_loop().run_until_complete(scenario())
+
+        self.assertEqual([v for ts, v in quick.stored_values], [3])
+        self.assertEqual(transport.calls[-1][1]['failed_reads'], ['Wlhanging'])
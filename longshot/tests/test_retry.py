@@ -0,0 +1,105 @@
+from unittest import TestCase
+import time
+import requests
+from longshot import Device, pathpoint_from_functions, RetryPolicy, Backoff, CircuitBreaker
+from longshot.tests.test_device import FakeTransport, FakeResponse
+
+
+class FailingTransport(FakeTransport):
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        FakeTransport.post(self, api_root, endpoint, payload, encoding)
+        raise requests.ConnectionError('server is down')
+
+
+class ErrorAnswers(FakeTransport):
+    """Answers get_orders with an error, and orders a write now and then"""
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        if endpoint == '/v1/get_orders/':
+            self.calls.append((endpoint, payload))
+            if len(self.calls) % 2:
+                return FakeResponse({'error': 'no such device'})
+            return FakeResponse({'writes': {'Wlaccess': [1000, 5]}, 'reads': [], 'pot': 1})
+        return FakeTransport.post(self, api_root, endpoint, payload, encoding)
+
+
+class TestBackoff(TestCase):
+
+    def testDelaysGrowUpToMaximum(self):
+        backoff = Backoff(initial=1, maximum=10, multiplier=2, jitter=0)
+        self.assertEqual([backoff.next_delay() for i in range(6)], [1, 2, 4, 8, 10, 10])
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 1)
+
+    def testJitterOnlyShortens(self):
+        backoff = Backoff(initial=4, jitter=0.5)
+        for i in range(100):
+            backoff.reset()
+            self.assertTrue(2 <= backoff.next_delay() <= 4)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def testOpensAfterThresholdAndHalfOpens(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        breaker.record_failure()        # trial failed
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def testPolicyWaitsForOpenCircuit(self):
+        policy = RetryPolicy(Backoff(initial=1, jitter=0), CircuitBreaker(2, reset_timeout=30))
+        self.assertEqual(policy.failed(), 1)
+        self.assertGreater(policy.failed(), 29)
+        policy.succeeded()
+        self.assertEqual(policy.failed(), 1)
+
+
+class TestDeviceRetries(TestCase):
+
+    def testConnectionErrorKeepsSamples(self):
+        d1 = Device('dupa', 'xx', transport=FailingTransport())
+        p = pathpoint_from_functions('Waccess', d1).register()
+        p.store(1, 1000)
+
+        self.assertRaises(IOError, d1.thread._syncvalues)
+        self.assertEqual(list(p.stored_values), [(1000000, 1)])
+        self.assertEqual(d1.dirty, set(['Wlaccess']))
+
+    def testThreadBacksOffAndSurvives(self):
+        transport = FailingTransport()
+        d1 = Device('dupa', 'xx', transport=transport,
+                    retry_policy=RetryPolicy(Backoff(initial=0.01, maximum=0.02, jitter=0)))
+        pathpoint_from_functions('Waccess', d1).register()
+        d1.done()
+        time.sleep(0.2)
+        self.assertTrue(d1.thread.is_alive())
+        d1.shutdown()
+        self.assertGreater(len(transport.calls), 3)
+
+    def testUnexpectedAnswersAndRaisingCallbacks(self):
+        transport = ErrorAnswers()
+        d1 = Device('dupa', 'xx', transport=transport, order_interval=0.01,
+                    retry_policy=RetryPolicy(Backoff(initial=0.01, maximum=0.02, jitter=0)))
+
+        def on_write(timestamp, value):
+            raise ValueError()
+
+        pathpoint_from_functions('Waccess', d1, on_write_arrived=on_write).register()
+        self.assertRaises(IOError, d1.thread._on_orders, {'error': 'no such device'})
+        self.assertRaises(IOError, d1.thread._on_paths, {'error': 'no such device'})
+        self.assertFalse(d1.paths_synced)
+
+        d1.done()
+        time.sleep(0.2)
+        self.assertTrue(d1.thread.is_alive())
+        d1.shutdown()
+        self.assertGreater(d1.metrics.callback_errors, 1)
+        self.assertGreater(transport.endpoints().count('/v1/get_orders/'), 3)
@@ -0,0 +1,75 @@
+from longshot.sharding import Supervisor
+from longshot.testing import FakeServer
+from longshot.tests.test_device import WaitingTestCase
+
+
+class TestSupervisor(WaitingTestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testStoresAndWritesCrossProcesses(self):
+        supervisor = Supervisor(workers=2, longshot_path=self.server.url,
+                                upload_min_delay=0.01, order_interval=0.1)
+        devices = [supervisor.add_device('dev%s' % i, 'xx', ['Waccess', 'Wtemp'])
+                   for i in range(8)]
+        written = []
+        devices[3].get('Waccess').listen(lambda ts, v: written.append(v))
+        supervisor.start()
+        try:
+            self.assertEqual(len([shard for shard in supervisor.shards if shard.process]), 2)
+            for i in range(100):
+                for device in devices:
+                    device.get('Wtemp').store(i, 1000 + i)
+
+            self.wait_for(lambda: self.server.samples == 800)
+            self.assertEqual([v for ts, v in self.server.device('dev2').values['Wltemp']],
+                             list(range(100)))
+
+            self.server.write('dev3', 'Wlaccess', 5)
+            self.wait_for(lambda: written == [5])
+        finally:
+            supervisor.shutdown()
+
+        for shard in supervisor.shards:
+            if shard.process is not None:
+                self.assertFalse(shard.process.is_alive())
+
+    def testDevicesAreAddedBeforeStart(self):
+        supervisor = Supervisor(workers=1)
+        supervisor.start()
+        self.assertRaises(RuntimeError, supervisor.add_device, 'dev', 'xx', [])
+        supervisor.shutdown()
+
+    def testShutdownUploadsWhatIsLeft(self):
+        supervisor = Supervisor(workers=1, longshot_path=self.server.url,
+                                upload_min_delay=60, upload_max_latency=60)
+        device = supervisor.add_device('dev', 'xx', ['Waccess'])
+        supervisor.start()
+        for i in range(10):
+            device.get('Waccess').store(i, 1000 + i)
+        supervisor.shutdown()
+        self.assertEqual(self.server.samples, 10)
+
+    def testRaisingListenerIsCounted(self):
+        supervisor = Supervisor(workers=1, longshot_path=self.server.url, order_interval=0.1)
+        device = supervisor.add_device('dev', 'xx', ['Waccess'])
+        written = []
+
+        def listener(timestamp, value):
+            written.append(value)
+            raise ValueError()
+
+        device.get('Waccess').listen(listener)
+        supervisor.start()
+        try:
+            self.server.write('dev', 'Wlaccess', 5)
+            self.wait_for(lambda: written == [5])
+            self.server.write('dev', 'Wlaccess', 6)
+            self.wait_for(lambda: written == [5, 6])
+            self.wait_for(lambda: supervisor.listener_errors == 2)
+        finally:
+            supervisor.shutdown()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+from longshot import Device, pathpoint_from_functions, ArrayBuffer, RetryPolicy, Backoff
+from longshot.testing import FakeServer
+from longshot.tests.test_device import WaitingTestCase
+
+
+class TestSnapshot(WaitingTestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'dupa.snapshot')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def device(self, paths):
+        device = Device('dupa', 'xx', longshot_path=self.server.url,
+                        retry_policy=RetryPolicy(Backoff(0.05, 0.1)))
+        for path in paths:
+            kwargs = {'buffer': ArrayBuffer()} if path == 'Wfloat' else {}
+            pathpoint_from_functions(path, device, **kwargs).register()
+        return device
+
+    def run_until_synced(self):
+        d1 = self.device(['Waccess', 'Wfloat'])
+        d1.done()
+        self.wait_for(lambda: d1.paths_synced and all(p.declared for p in d1.pathpoints.values()))
+
+        self.server.failure_rate = 1.0
+        d1.get('Waccess').store('on', 1000)
+        d1.get('Wfloat').store(1.5, 1000)
+        d1.get('Wfloat').store(2.5, 1001)
+        d1.get('Wfloat').on_write_arrived(1001, 2.5)
+        d1.shutdown()
+        d1.snapshot(self.filename)
+        self.server.failure_rate = 0
+        self.server.requests.clear()
+
+    def testUnchangedPathsAreNotRedefined(self):
+        self.run_until_synced()
+
+        d2 = self.device(['Waccess', 'Wfloat'])
+        d2.restore(self.filename)
+        self.assertTrue(d2.paths_synced)
+        self.assertTrue(d2.get('Waccess').declared)
+        self.assertEqual(d2.get('Wfloat').current(), (1001, 2.5))
+        d2.done()
+
+        device = self.server.device('dupa')
+        self.wait_for(lambda: len(device.values.get('Wlfloat', ())) == 2)
+        self.wait_for(lambda: device.values.get('Wlaccess') == [[1000000, 'on']])
+        self.assertEqual(device.values['Wlfloat'], [[1000000, 1.5], [1001000, 2.5]])
+        d2.shutdown()
+
+        self.assertNotIn('/v1/redefine_paths/', self.server.requests)
+        self.assertNotIn('/v1/update_paths/', self.server.requests)
+
+    def testChangedPathsAreUpdated(self):
+        self.run_until_synced()
+
+        d2 = self.device(['Waccess', 'Wnew'])
+        d2.restore(self.filename)
+        self.assertEqual((d2.paths_added, d2.paths_removed), (set(['Wlnew']), set(['Wlfloat'])))
+        d2.done()
+
+        self.wait_for(lambda: self.server.device('dupa').paths == set(['Wlaccess', 'Wlnew']))
+        d2.shutdown()
+        self.assertNotIn('/v1/redefine_paths/', self.server.requests)
+
+    def testIntegersKeepTheirType(self):
+        d1 = self.device(['Waccess', 'Wfloat'])
+        d1.get('Waccess').store(7, 1000)
+        d1.get('Waccess').store(2 ** 60, 1001)
+        d1.get('Wfloat').store(1.5, 1000)
+        d1.snapshot(self.filename)
+
+        d2 = self.device(['Waccess', 'Wfloat'])
+        d2.restore(self.filename)
+        values = [v for ts, v in d2.get('Waccess').stored_values]
+        self.assertEqual(values, [7, 2 ** 60])
+        self.assertTrue(all(type(v) is int for v in values))
+        self.assertEqual(list(d2.get('Wfloat').stored_values), [(1000000, 1.5)])
+
+    def testRestoreChecksDevice(self):
+        self.run_until_synced()
+        other = Device('other', 'xx')
+        self.assertRaises(ValueError, other.restore, self.filename)
+
+        d2 = self.device(['Waccess'])
+        d2.thread.start = lambda: None
+        d2.done()
+        self.assertRaises(RuntimeError, d2.restore, self.filename)
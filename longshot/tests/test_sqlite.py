@@ -0,0 +1,43 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from longshot import Device, pathpoint_from_functions
+from longshot.persistence import SQLitePersistenceLayer
+
+
+class TestSQLitePersistence(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'values.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testWritesAreCoalescedUntilSync(self):
+        pl = SQLitePersistenceLayer(self.filename)
+        for i in range(100):
+            pl.set_current_value('Wlaccess', i, 1000 + i)
+        self.assertEqual(pl.get_current_value('Wlaccess'), (1099, 99))
+        self.assertIsNone(SQLitePersistenceLayer(self.filename).get_current_value('Wlaccess'))
+
+        pl.sync()
+        self.assertEqual(SQLitePersistenceLayer(self.filename).get_current_value('Wlaccess'), (1099, 99))
+
+    def testDelete(self):
+        pl = SQLitePersistenceLayer(self.filename)
+        pl.set_current_value('Wlaccess', 'x', 1000)
+        pl.sync()
+        pl.del_current_value('Wlaccess')
+        pl.sync()
+        self.assertIsNone(SQLitePersistenceLayer(self.filename).get_current_value('Wlaccess'))
+
+    def testPathpointPicksUpPersistedValue(self):
+        pl = SQLitePersistenceLayer(self.filename)
+        pl.set_current_value('Wlaccess', 5, 1000)
+        pl.close()
+
+        d1 = Device('dupa', 'xx', persistence_layer=SQLitePersistenceLayer(self.filename))
+        p = pathpoint_from_functions('Waccess', d1)
+        self.assertEqual((p.timestamp, p.value), (1000, 5))
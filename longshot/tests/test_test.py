@@ -1,46 +1,37 @@
 from unittest import TestCase
-import mock
 import time
-from longshot import LongshotDevice, LongshotPathpoint
-import requests
+from longshot import Device, BasePathpoint, pathpoint_from_functions
+from longshot.testing import FakeServer
 
-class TestRegistering(TestCase):
 
-    class FakeResponse(object):
-        def __init__(self, val):
-            self.val = val
-            self.status_code == 200 if val is not None else 500
+class TestRegistering(TestCase):
 
-        def json(self):
-            return self.val
+    def setUp(self):
+        self.server = FakeServer().start()
 
+    def tearDown(self):
+        self.server.stop()
 
-    @mock.patch('requests.post')
-    def testRegister1(self, rpo):
-        rpo = lambda *args, **kwargs: self.FakeResponse({'values': []})
+    def wait_for_paths(self, paths):
+        deadline = time.time() + 5
+        while self.server.device('dupa').paths != paths and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.device('dupa').paths, paths)
 
-        d1 = LongshotDevice('dupa', 'xx')
-        d1.register('lel')
+    def testRegister1(self):
+        d1 = Device('dupa', 'xx', longshot_path=self.server.url)
+        pathpoint_from_functions('Wlel', d1).register()
         d1.done()
 
-        time.sleep(3)
+        self.wait_for_paths(set(['Wllel']))
 
         d1.shutdown()
 
-        assert requests.post.called
-
-
-    @mock.patch('requests.post')
-    def testRegister2(self, rpo):
-        rpo = lambda *args, **kwargs: self.FakeResponse({'values': []})
-
-        d1 = LongshotDevice('dupa', 'xx')
-        LongshotPathpoint('lel').register(d1)
+    def testRegister2(self):
+        d1 = Device('dupa', 'xx', longshot_path=self.server.url)
+        d1.register(BasePathpoint('Wlel', d1))
         d1.done()
 
-        time.sleep(3)
+        self.wait_for_paths(set(['Wllel']))
 
         d1.shutdown()
-
-        assert requests.post.called
-
@@ -0,0 +1,46 @@
+from unittest import TestCase
+import json
+import zlib
+import mock
+from longshot import Transport
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+
+class TestTransport(TestCase):
+
+    def testSmallBodyIsNotCompressed(self):
+        t = Transport(compress_threshold=1024)
+        with mock.patch.object(t.session, 'post', return_value=FakeResponse()) as post:
+            t.post('http://api', '/v1/get_orders/', {'device_id': 'dupa'})
+
+        args, kwargs = post.call_args
+        self.assertEqual(args[0], 'http://api/v1/get_orders/')
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertEqual(json.loads(kwargs['data'].decode('utf8')), {'device_id': 'dupa'})
+
+    def testLargeBodyIsGzipped(self):
+        t = Transport(compress_threshold=16)
+        payload = {'values': {'Wlaccess': [[1000, 1]] * 100}}
+        with mock.patch.object(t.session, 'post', return_value=FakeResponse()) as post:
+            t.post('http://api', '/v1/sync_values/', payload)
+
+        kwargs = post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        body = zlib.decompress(kwargs['data'], 31)
+        self.assertEqual(json.loads(body.decode('utf8')), payload)
+
+    def testLatencyCounters(self):
+        t = Transport()
+        with mock.patch.object(t.session, 'post', side_effect=[FakeResponse(), FakeResponse(500)]):
+            t.post('http://api', '/v1/get_orders/', {})
+            t.post('http://api', '/v1/get_orders/', {})
+
+        stats = t.stats['/v1/get_orders/']
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.failures, 1)
+        self.assertGreaterEqual(stats.max_time, 0)
+        self.assertIsNotNone(stats.mean_time)
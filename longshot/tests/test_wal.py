@@ -0,0 +1,103 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from longshot import Device, pathpoint_from_functions
+from longshot.priority import CRITICAL, BULK
+from longshot.persistence import WALPersistenceLayer
+
+
+class TestWAL(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRecovery(self):
+        wal = WALPersistenceLayer(self.directory)
+        wal.log_sample('Wlaccess', 1000, 5)
+        wal.log_sample('Wlaccess', 1001, 6)
+        wal.log_sample('Wlother', 1000, 'x')
+        wal.sync()
+
+        recovered = WALPersistenceLayer(self.directory).recover_samples()
+        self.assertEqual(recovered, {'Wlaccess': [(1000, 5), (1001, 6)],
+                                     'Wlother': [(1000, 'x')]})
+
+    def testAcknowledgedSegmentsAreDeleted(self):
+        wal = WALPersistenceLayer(self.directory)
+        wal.log_sample('Wlaccess', 1000, 5)
+        mark = wal.checkpoint()
+        wal.log_sample('Wlaccess', 1001, 6)
+        wal.acknowledge(mark)
+        wal.sync()
+
+        self.assertEqual(WALPersistenceLayer(self.directory).recover_samples(),
+                         {'Wlaccess': [(1001, 6)]})
+
+    def testTornRecordIsSkipped(self):
+        wal = WALPersistenceLayer(self.directory)
+        wal.log_sample('Wlaccess', 1000, 5)
+        wal.sync()
+        wal.log_sample('Wlaccess', 1001, 6)
+        wal.sync()
+
+        segment = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 3)
+
+        self.assertEqual(WALPersistenceLayer(self.directory).recover_samples(),
+                         {'Wlaccess': [(1000, 5)]})
+
+    def testDeviceRecoversPendingSamples(self):
+        wal = WALPersistenceLayer(self.directory)
+        d1 = Device('dupa', 'xx', persistence_layer=wal)
+        pathpoint_from_functions('Waccess', d1).register().store(5, 1000)
+        wal.sync()
+
+        d2 = Device('dupa', 'xx', persistence_layer=WALPersistenceLayer(self.directory))
+        p = pathpoint_from_functions('Waccess', d2).register()
+        d2.thread.start = lambda: None
+        d2.done()
+
+        self.assertEqual(list(p.stored_values), [(1000000, 5)])
+        self.assertTrue(p.needs_sync)
+
+    def recovered(self):
+        return WALPersistenceLayer(self.directory).recover_samples()
+
+    def testDeferredBulkIsNotAcknowledged(self):
+        wal = WALPersistenceLayer(self.directory)
+        d1 = Device('dupa', 'xx', persistence_layer=wal, bulk_bandwidth=320)
+        bulk = pathpoint_from_functions('Wbulk', d1, priority=BULK).register()
+        for i in range(20):
+            bulk.store(i, 1000 + i)
+
+        chunks = d1.thread._values_chunks()
+        self.assertTrue(d1.thread._on_chunks_sent(chunks, [200]))
+        self.assertEqual(len(self.recovered()['Wlbulk']), 20)
+
+    def testCriticalLaneAcknowledges(self):
+        wal = WALPersistenceLayer(self.directory)
+        d1 = Device('dupa', 'xx', persistence_layer=wal)
+        alarm = pathpoint_from_functions('Walarm', d1, priority=CRITICAL).register()
+        normal = pathpoint_from_functions('Wnormal', d1).register()
+        thread = d1.thread
+        thread.lane = object()      # as if it was running
+
+        alarm.store(1, 1000)
+        normal.store(2, 1000)
+        checkpoint, paths, chunks = thread._urgent_chunks()
+        self.assertTrue(thread._on_urgent_sent(checkpoint, paths, chunks, [200]))
+        self.assertIn('Wlalarm', self.recovered())        # the normal sample holds it back
+
+        chunks = thread._values_chunks()
+        alarm.store(3, 1001)
+        self.assertTrue(thread._on_chunks_sent(chunks, [200]))
+        wal.sync()
+        self.assertEqual(self.recovered(), {'Wlalarm': [(1001, 3)]})
+        checkpoint, paths, chunks = thread._urgent_chunks()
+        self.assertTrue(thread._on_urgent_sent(checkpoint, paths, chunks, [200]))
+        self.assertEqual(self.recovered(), {})
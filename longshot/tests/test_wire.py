@@ -0,0 +1,89 @@
+from unittest import TestCase
+from longshot import Device, pathpoint_from_functions
+import array
+from longshot.wire import JSONCodec, LSC1Codec, Samples
+from longshot.testing import FakeServer
+
+
+class TestLSC1(TestCase):
+
+    def testRoundTrip(self):
+        payload = {'device_id': 'dupa', 'secret': 'xx', 'values': {
+            'Wlfloat': [(1000000 + i * 1000, 20.0 + i * 0.125) for i in range(100)],
+            'Wlirregular': [(1000, -1.5), (1003, 2.5), (2000, 1e300)],
+            'Wlsingle': [(5000, 1.0)],
+            'Wltext': [(1000, 'ok'), (2000, None), (3000, True)],
+        }}
+        decoded = LSC1Codec().decode(LSC1Codec().encode(payload))
+
+        self.assertEqual(decoded['device_id'], 'dupa')
+        self.assertEqual(decoded['secret'], 'xx')
+        for path, samples in payload['values'].items():
+            self.assertEqual(decoded['values'][path], [[ts, v] for ts, v in samples])
+
+    def testIntegersAndBooleansKeepTheirType(self):
+        payload = {'device_id': 'dupa', 'secret': 'xx', 'values': {
+            'Wlint': [(1000, 7), (2000, 2 ** 60 + 1)],
+            'Wlhuge': [(1000, 10 ** 400)],
+            'Wlbool': [(1000, True), (2000, False)],
+        }}
+        decoded = LSC1Codec().decode(LSC1Codec().encode(payload))
+        for path, samples in payload['values'].items():
+            values = [v for ts, v in decoded['values'][path]]
+            self.assertEqual(values, [v for ts, v in samples])
+            self.assertEqual([type(v) for v in values], [type(v) for ts, v in samples])
+
+    def testSamplesAreEncodedFromColumns(self):
+        samples = Samples(array.array('q', [1000, 2000, 4000]), array.array('d', [1.5, 2.5, 3.5]))
+        payload = {'device_id': 'dupa', 'secret': 'xx', 'values': {'Wlfloat': samples}}
+        expected = [[1000, 1.5], [2000, 2.5], [4000, 3.5]]
+
+        for codec in (JSONCodec(), LSC1Codec()):
+            self.assertEqual(codec.decode(codec.encode(payload))['values']['Wlfloat'], expected)
+
+    def testSmallerThanJSON(self):
+        payload = {'device_id': 'dupa', 'secret': 'xx', 'values': dict(
+            ('Wlsensor%s' % p, [(1476000000000 + i * 1000, 21.5 + (i % 7) * 0.1) for i in range(1000)])
+            for p in range(10))}
+
+        self.assertLess(len(LSC1Codec().encode(payload)) * 4, len(JSONCodec().encode(payload)))
+
+
+class TestNegotiation(TestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sync(self, device):
+        p = pathpoint_from_functions('Waccess', device).register()
+        device.thread._syncpaths()
+        p.store(1.5, 1000)
+        device.thread._syncvalues()
+
+    def testServerPicksLSC1(self):
+        d1 = Device('dupa', 'xx', longshot_path=self.server.url)
+        self.sync(d1)
+        self.assertEqual(d1.thread.values_encoding, 'lsc1')
+        self.assertEqual(self.server.device('dupa').values, {'Wlaccess': [[1000000, 1.5]]})
+
+    def testServerWithoutLSC1(self):
+        self.server.encodings = ('json', )
+        d1 = Device('dupa', 'xx', longshot_path=self.server.url)
+        self.sync(d1)
+        self.assertEqual(d1.thread.values_encoding, 'json')
+        self.assertEqual(self.server.device('dupa').values, {'Wlaccess': [[1000000, 1.5]]})
+
+    def testFallbackOnUnsupportedMediaType(self):
+        d1 = Device('dupa', 'xx', longshot_path=self.server.url)
+        p = pathpoint_from_functions('Waccess', d1).register()
+        d1.thread._syncpaths()
+        self.server.encodings = ('json', )
+
+        p.store(1.5, 1000)
+        self.assertRaises(IOError, d1.thread._syncvalues)
+        self.assertEqual(d1.thread.values_encoding, 'json')
+        d1.thread._syncvalues()
+        self.assertEqual(self.server.device('dupa').values, {'Wlaccess': [[1000000, 1.5]]})
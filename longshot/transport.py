@@ -0,0 +1,118 @@
+import time
+import threading
+import zlib
+import requests
+import requests.adapters
+from .wire import CODECS
+
+
+class EndpointStats(object):
+    """
+    Latency counters for a single Longshot API endpoint
+    """
+
+    def __init__(self):
+        self.calls = 0              #: amount of requests made
+        self.failures = 0           #: amount of requests that raised or returned non-200
+        self.total_time = 0.0       #: sum of request durations, in seconds
+        self.max_time = 0.0         #: longest request duration, in seconds
+        self.bytes_sent = 0         #: sum of request body sizes, in bytes
+
+    @property
+    def mean_time(self):
+        """Mean request duration in seconds, or None if no requests were made"""
+        if self.calls == 0:
+            return None
+        return self.total_time / self.calls
+
+
+class Transport(object):
+    """
+    HTTP transport used to talk to Longshot API.
+
+    It keeps a pool of persistent connections, so that consecutive cycles reuse them instead
+    of making a new TCP/TLS handshake each time. A single Transport can be shared by any number
+    of Devices in the same process - pass it as transport= when constructing them.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, compress_threshold=4096,
+                 timeout=(10, 60)):
+        """
+        :param pool_connections: amount of distinct hosts to keep connection pools for
+        :param pool_maxsize: maximum amount of connections kept alive per host. Should be
+            at least the amount of Devices that share this transport.
+        :param compress_threshold: request bodies that are at least this many bytes long will be
+            gzip-compressed. None to never compress.
+        :param timeout: seconds to wait for a connection to be made, and then for the server to
+            answer, as a tuple. A call that takes longer raises requests' Timeout, which is an
+            IOError. None to wait forever.
+        """
+        self.compress_threshold = compress_threshold
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats = {}         # endpoint => EndpointStats
+        self.stats_lock = threading.Lock()
+
+    def _encode(self, payload, encoding):
+        """
+        Serialize payload to a request body
+        :return: tuple of (body, headers)
+        """
+        codec = CODECS[encoding]
+        body = codec.encode(payload)
+        headers = {'Content-Type': codec.content_type}
+
+        # LSC1 is compressed already
+        if encoding == 'json' and self.compress_threshold is not None and \
+           len(body) >= self.compress_threshold:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)    # 31 means gzip container
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+
+        return body, headers
+
+    def _record(self, endpoint, duration, failed, size):
+        with self.stats_lock:
+            try:
+                stats = self.stats[endpoint]
+            except KeyError:
+                stats = self.stats[endpoint] = EndpointStats()
+
+            stats.calls += 1
+            stats.bytes_sent += size
+            stats.total_time += duration
+            if duration > stats.max_time:
+                stats.max_time = duration
+            if failed:
+                stats.failures += 1
+
+    def post(self, api_root, endpoint, payload, encoding='json'):
+        """
+        POST a payload to an endpoint
+
+        :param api_root: Longshot API URL
+        :param endpoint: endpoint to call, eg. '/v1/get_orders/'
+        :param payload: object to serialize
+        :param encoding: name of encoding to serialize payload with, see longshot.wire
+        :return: requests' Response
+        """
+        body, headers = self._encode(payload, encoding)
+
+        failed = True
+        started = time.time()
+        try:
+            r = self.session.post(api_root + endpoint, data=body, headers=headers,
+                                  timeout=self.timeout)
+            failed = r.status_code != 200
+            return r
+        finally:
+            self._record(endpoint, time.time() - started, failed, len(body))
+
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
@@ -0,0 +1,208 @@
+"""
+Encodings of request bodies.
+
+JSON is understood by every Longshot API. LSC1 is a compact, columnar binary encoding of
+sync_values, that is used once the server says in its answer to redefine_paths that it
+understands it. It's meant for numeric sensors - samples of other values, integers and booleans
+included, are still carried as JSON inside it, so that they arrive as they were.
+
+LSC1 body is:
+    b'LSC1'
+    uint32 length + JSON of the payload with 'values' left out
+    for every path:
+        uint16 length + UTF-8 of path
+        uint32 count of samples
+        uint8 kind of values: 0 for float64 column (all of them are floats), 1 for JSON
+        int64 timestamp of first sample, in ms
+        int64 * (count-1) delta-of-deltas of timestamps (so that regular sampling gives zeros)
+        for float64 column: uint64 bits of the first value, then uint64 * (count-1) of bits of
+            every value XOR-ed with bits of previous value (so that slowly changing values give
+            mostly zero bytes)
+        for JSON: uint32 length + JSON list of values
+All numbers are little endian. The whole body is then compressed with zlib.
+
+Encoding is done in bulk with array and struct, without per-sample formatting, which is what makes
+JSON expensive.
+
+Samples of a path can be given either as a list of [timestamp, value] or as Samples, which both
+codecs encode straight from its columns.
+"""
+import array
+import json
+import struct
+import sys
+import zlib
+
+_LITTLE = sys.byteorder == 'little'
+
+
+class Samples(object):
+    """
+    Samples of a single path, as two parallel sequences of timestamps in ms and values, the way
+    buffers keep them. Iterating gives (timestamp, value).
+    """
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        return iter(zip(self.timestamps, self.values))
+
+    def __getitem__(self, i):
+        return self.timestamps[i], self.values[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Samples(%r)' % (list(self), )
+
+
+def _are_floats(values):
+    """Can values go in a float64 column without changing? Integers and booleans can't."""
+    if isinstance(values, array.array):
+        return values.typecode == 'd'
+    return all(isinstance(v, float) for v in values)
+
+
+def _encode_samples(o):
+    if isinstance(o, Samples):
+        return list(zip(o.timestamps, o.values))
+    raise TypeError('%r is not JSON serializable' % (o, ))
+
+
+class JSONCodec(object):
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, payload):
+        return json.dumps(payload, default=_encode_samples).encode('utf8')
+
+    def decode(self, body):
+        return json.loads(body.decode('utf8'))
+
+
+def _tobytes(a):
+    if not _LITTLE:
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _frombytes(typecode, data):
+    a = array.array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if not _LITTLE:
+        a.byteswap()
+    return a
+
+
+_FLOATS = 0
+_JSON = 1
+
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_PATH_HEAD = struct.Struct('<IBq')      # count, kind, first timestamp
+
+
+class LSC1Codec(object):
+    name = 'lsc1'
+    content_type = 'application/x-longshot-lsc1'
+
+    def encode(self, payload):
+        envelope = dict(payload)
+        values = envelope.pop('values', {})
+        envelope = json.dumps(envelope).encode('utf8')
+
+        parts = [b'LSC1', _U32.pack(len(envelope)), envelope]
+
+        for path, samples in values.items():
+            if not samples:
+                continue
+            path = path.encode('utf8')
+            if isinstance(samples, Samples):
+                timestamps, vals = samples.timestamps, samples.values
+            else:
+                timestamps = [int(sample[0]) for sample in samples]
+                vals = [sample[1] for sample in samples]
+
+            deltas = [b - a for a, b in zip(timestamps, timestamps[1:])]
+            dods = array.array('q', [b - a for a, b in zip([0] + deltas, deltas)])
+
+            if _are_floats(vals):
+                kind = _FLOATS
+                bits = array.array('q', _tobytes(array.array('d', vals)))
+                xors = array.array('q', [bits[0]] + [b ^ a for a, b in zip(bits, bits[1:])])
+                column = _tobytes(xors)
+            else:
+                kind = _JSON
+                column = json.dumps(list(vals)).encode('utf8')
+                column = _U32.pack(len(column)) + column
+
+            parts.append(_U16.pack(len(path)))
+            parts.append(path)
+            parts.append(_PATH_HEAD.pack(len(samples), kind, int(timestamps[0])))
+            parts.append(_tobytes(dods))
+            parts.append(column)
+
+        return zlib.compress(b''.join(parts))
+
+    def decode(self, body):
+        body = zlib.decompress(body)
+        if body[:4] != b'LSC1':
+            raise ValueError('not an LSC1 body')
+
+        length, = _U32.unpack_from(body, 4)
+        offset = 8 + length
+        payload = json.loads(body[8:offset].decode('utf8'))
+        values = payload['values'] = {}
+
+        while offset < len(body):
+            length, = _U16.unpack_from(body, offset)
+            offset += 2
+            path = body[offset:offset+length].decode('utf8')
+            offset += length
+            count, kind, first = _PATH_HEAD.unpack_from(body, offset)
+            offset += _PATH_HEAD.size
+
+            dods = _frombytes('q', body[offset:offset+8*(count-1)])
+            offset += 8 * (count-1)
+            timestamps = [first]
+            delta = 0
+            for dod in dods:
+                delta += dod
+                timestamps.append(timestamps[-1] + delta)
+
+            if kind == _FLOATS:
+                xors = _frombytes('q', body[offset:offset+8*count])
+                offset += 8 * count
+                bits = array.array('q', [xors[0]])
+                for x in xors[1:]:
+                    bits.append(bits[-1] ^ x)
+                vals = _frombytes('d', _tobytes(bits))
+            else:
+                length, = _U32.unpack_from(body, offset)
+                offset += 4
+                vals = json.loads(body[offset:offset+length].decode('utf8'))
+                offset += length
+
+            values[path] = [[ts, v] for ts, v in zip(timestamps, vals)]
+
+        return payload
+
+
+CODECS = dict((codec.name, codec) for codec in (JSONCodec(), LSC1Codec()))
+BY_CONTENT_TYPE = dict((codec.content_type, codec) for codec in CODECS.values())